@@ -3,6 +3,7 @@ from teafacto.util import tokenize, ticktock, isstring, argprun
 from nltk.corpus import stopwords
 from nltk.stem import porter
 from teafacto.procutil import wordids2string
+from teafacto.datahelp.subjectindex import SubjectIndex
 from IPython import embed
 
 class Processor(object):
@@ -27,16 +28,14 @@ class SubjectSearch(object):
     customstops = set("the a an of on is at in by did do not does had has have for what which when where why who whom how".split())
     smallstops = set("the a an of on at by".split())
 
-    def __init__(self, subjinfop="subjs-counts-labels-types.fb2m.tsv", revind=None):
-        self.indexdict = {}
+    def __init__(self, subjinfop="subjs-counts-labels-types.fb2m.tsv", index=None):
         self.ignoresubgrams = True
         self.processor = Processor()
-        self.revind = revind
         self.maxeditdistance = 1
-        if isstring(subjinfop):
+        if index is not None:
+            self.index = index
+        elif isstring(subjinfop):
             self.build(subjinfop)
-        elif isinstance(subjinfop, dict):
-            self.indexdict = subjinfop
         else:
             raise Exception("unknown stuff")
 
@@ -44,6 +43,8 @@ class SubjectSearch(object):
         i = 0
         tt = ticktock("builder")
         tt.tick("building")
+        cols = [[] for _ in SubjectIndex.columns]
+        names = []
         for line in open(p):
             sline = line[:-1].split("\t")
             fb_id = sline[0]
@@ -53,93 +54,53 @@ class SubjectSearch(object):
             type_id = type_id if type_id != "<UNK>" else None
             type_name = " ".join(tokenize(sline[5]))
             type_name = type_name if type_name != " ".join(tokenize("<UNK>")) else None
-            if name not in self.indexdict:
-                self.indexdict[name] = []
-            self.indexdict[name].append({"fb_id": fb_id,
-                    "triplecount": triplecount, "type_id": type_id,
-                    "type_name": type_name})
+            names.append(name)
+            for col, x in zip(cols, [fb_id, triplecount, type_id, type_name]):
+                col.append(x)
             i += 1
             if i % 1000 == 0:
                 tt.live("{}k".format(i//1000))
+        self.index = SubjectIndex.build(names, *cols)
         tt.tock("built")
 
     def save(self, p):
-        with open(p, "w", 1) as f:
-            for item in self.indexdict.items():
-                f.write("::{}\n".format(item[0]))
-                for ve in item[1]:
-                    f.write("{}\t{}\t{}\t{}\n".format(
-                        *[ve[x] for x in "fb_id triplecount type_id type_name".split()]
-                    ))
+        self.index.save(p)
 
     @staticmethod
     def load(p):
         tt = ticktock("SubjectSearch")
         tt.tick("loading")
-        d = {}
-        l = []
-        k = None
-        with open(p) as f:
-            for line in f:
-                if line[:2] == "::":
-                    if k is None:
-                        assert(l == [])
-                    else:
-                        d[k] = l
-                        l = []
-                    k = line[2:-1]
-                else:
-                    splits = line[:-1].split("\t")
-                    le = dict(zip("fb_id triplecount type_id type_name".split(),
-                          [splits[0], int(splits[1])] + splits[2:]))
-                    l.append(le)
-        d[k] = l
+        ret = SubjectSearch(index=SubjectIndex.load(p))
         tt.tock("loaded")
-        ret = SubjectSearch(subjinfop=d, revind=SubjectSearch.buildrevindex(d))
         return ret
 
-    @staticmethod
-    def buildrevindex(d):
-        revind = {}
-        for k in d.keys():
-            words = k.split()
-            for word in words:
-                if len(word) < 2:
-                    continue
-                if word not in revind:
-                    revind[word] = []
-                revind[word].append(k)
-        return revind
-
     def search(self, s, top=5, edsearch=True):
         ss = self.processor.processline(s)
         return self._search(ss, top=top, edsearch=edsearch)
 
     def _search(self, ss, top=5, edsearch=True):
-        res = self.indexdict[ss] if ss in self.indexdict else []
-        sres = sorted(res, key=lambda x: x["triplecount"], reverse=True)
-        ret = sres[:min(top, len(sres))]
+        labelid = self.index.find(ss)
+        ret = self.index.entries(labelid, top=top) if labelid is not None else []
         for x in ret:
             x.update({"name": ss})
-        if len(ret) == 0 and self.revind is not None and edsearch and self.maxeditdistance > 0:   # no exact matches
+        if len(ret) == 0 and edsearch and self.maxeditdistance > 0:   # no exact matches
+            if self.maxeditdistance > 1:
+                raise Exception("index only has deletion neighbourhoods of edit distance 1")
             nonexactsearchstrings = set()
             words = ss.split()
             if len(words) >= 2:
-                for word in words:
-                    if len(word) < 2 or word in self.customstops:
+                words = set([word for word in words if len(word) >= 2 and word not in self.customstops])
+                for nonexcanid in self.index.neighbours(ss):
+                    nonexcan = self.index.labels[nonexcanid]
+                    if len(words.intersection(nonexcan.split())) == 0:
                         continue
-                    if word not in self.revind:
+                    if abs(len(nonexcan) - len(ss)) >= 3:
                         continue
-                    for nonexcan in self.revind[word]:
-                        if abs(len(nonexcan) - len(ss)) >= 3:
-                            continue
-                        nonexcanred = nonexcan.replace(" '", "")
-                        #embed()
-                        if editdistance.eval(nonexcanred, ss) <= self.maxeditdistance:
-                            nonexactsearchstrings.add(nonexcan)
+                    nonexcanred = nonexcan.replace(" '", "")
+                    if editdistance.eval(nonexcanred, ss) <= self.maxeditdistance:
+                        nonexactsearchstrings.add(nonexcan)
                 for nonexactsearchstring in nonexactsearchstrings:
                     edsearchres = self._search(nonexactsearchstring, top=top, edsearch=False)
-                    #embed()
                     ret.extend(edsearchres)
         return ret
 
@@ -6,7 +6,7 @@ from IPython import embed
 
 from teafacto.core.base import Block, Val, tensorops as T
 from teafacto.blocks.basic import VectorEmbed, Embedder, Switch
-from teafacto.util import ticktock as TT, isnumber, isstring
+from teafacto.util import ticktock as TT, isnumber, isstring, loadwordvecs
 from teafacto.blocks.seq.enc import SimpleSeqStar2Vec
 
 
@@ -113,21 +113,14 @@ class WordEmb(WordEmbBase, VectorEmbed): # unknown words are mapped to index 0,
     def augment(self, wordemb):
         return AugmentedWordEmb(self, wordemb, maskid=self.maskid)
 
-    def loadvalue(self, path, dim, indim=None):
+    def loadvalue(self, path, dim, indim=None):     # through memory-mapped binary cache of text file
         tt = TT(self.__class__.__name__)
         tt.tick()
-        W = [np.zeros((1, dim))]
-        D = OrderedDict()
-        i = 1
-        for line in open(path):
-            if indim is not None and i >= (indim+1):
-                break
-            ls = line.split(" ")
-            word = ls[0]
-            D[word] = i
-            W.append(np.asarray([map(lambda x: float(x), ls[1:])]))
-            i += 1
-        W = np.concatenate(W, axis=0)
+        words, vecs = loadwordvecs(path, top=indim)
+        assert(vecs.shape[1] == dim)
+        W = np.zeros((vecs.shape[0] + 1, dim), dtype=vecs.dtype)
+        W[1:] = vecs
+        D = OrderedDict(zip(words, range(1, len(words) + 1)))
         tt.tock("loaded")
         return W, D
 
@@ -1,6 +1,9 @@
+import numpy as np
+import theano
+
 from teafacto.blocks.basic import VectorEmbed, Softmax, Embedder
 from teafacto.core.base import tensorops as T
-from teafacto.core.base import Block, Val, Var, param
+from teafacto.core.base import Block, Val, Var, Input, param
 from teafacto.core.stack import stack
 from teafacto.util import issequence
 
@@ -85,6 +88,89 @@ class MemoryAddress(Block):
     def apply(self, criterion):     # gets a criterion vector (batsize, crit_dim), outputs (batsize, mem_size)
         raise NotImplementedError("use subclass")
 
+    # dot-product addresses: score = dot(critkeys(criterion), memkeys().T)
+    def memkeys(self):              # (mem_size, key_dim)
+        raise NotImplementedError("no dot-product form for this address")
+
+    def critkeys(self, criterion):  # (batsize, key_dim)
+        raise NotImplementedError("no dot-product form for this address")
+
+    def index(self, numlists=None, nprobe=1, iters=10, seed=None):
+        """ builds an approximate nearest neighbour index (IVF) over the materialized memory,
+            can be used instead of the dense address at prediction time """
+        if self.memblock.innervar is None:
+            raise Exception("memory must be loaded to build an index")
+        memkeys = theano.function(inputs=[], outputs=self.memkeys().d)()
+        return MemAddrIndex(self, IVFIndex(memkeys, numlists=numlists, nprobe=nprobe, iters=iters, seed=seed))
+
+
+class IVFIndex(object):
+    """ Inverted file index for maximum inner product search (numpy).
+        Rows are clustered with k-means into numlists lists, a query only scores the rows
+        in the nprobe lists with highest centroid scores (nprobe=numlists is exact search). """
+    def __init__(self, data, numlists=None, nprobe=1, iters=10, seed=None, trainsize=100000):
+        self.data = data        # (numrows, dim)
+        numlists = int(np.ceil(np.sqrt(data.shape[0]))) if numlists is None else min(numlists, data.shape[0])
+        self.nprobe = nprobe
+        rng = np.random.RandomState(seed)
+        train = data[rng.choice(data.shape[0], min(trainsize, data.shape[0]), replace=False)]
+        self.centroids = train[rng.choice(train.shape[0], numlists, replace=False)].copy()
+        for i in range(iters):      # k-means
+            assign = self._assign(train)
+            for j in range(numlists):
+                members = train[assign == j]
+                if len(members) > 0:
+                    self.centroids[j] = members.mean(axis=0)
+        assign = self._assign(data)
+        self.order = np.argsort(assign, kind="mergesort")       # rows grouped by list
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=numlists))])
+
+    def _assign(self, x, batsize=10000):     # nearest centroid in euclidean distance
+        ret = np.zeros((x.shape[0],), dtype="int64")
+        cnorms = np.sum(self.centroids ** 2, axis=1)
+        for i in range(0, x.shape[0], batsize):
+            ret[i:i + batsize] = np.argmax(2 * np.dot(x[i:i + batsize], self.centroids.T) - cnorms, axis=1)
+        return ret
+
+    @property
+    def numlists(self):
+        return self.centroids.shape[0]
+
+    def search(self, q, k=10, nprobe=None):
+        """ q: (batsize, dim) queries
+            returns indexes and scores (batsize, k) of top-k rows, padded with -1 and -inf """
+        nprobe = min(self.nprobe if nprobe is None else nprobe, self.numlists)
+        probes = np.argsort(-np.dot(q, self.centroids.T), axis=1)[:, :nprobe]
+        retidxs = -np.ones((q.shape[0], k), dtype="int64")
+        retscores = -np.inf * np.ones((q.shape[0], k), dtype=q.dtype)
+        for i in range(q.shape[0]):
+            rows = np.concatenate([self.order[self.offsets[j]:self.offsets[j + 1]] for j in probes[i]])
+            scores = np.dot(self.data[rows], q[i])
+            n = min(k, len(rows))
+            top = np.argpartition(-scores, n - 1)[:n] if n < len(rows) else np.arange(len(rows))
+            top = top[np.argsort(-scores[top], kind="mergesort")]
+            retidxs[i, :n] = rows[top]
+            retscores[i, :n] = scores[top]
+        return retidxs, retscores
+
+
+class MemAddrIndex(object):
+    """ top-k memory rows for criteria, by an index over the memory keys of a memory address """
+    def __init__(self, memaddr, index):
+        self.memaddr = memaddr
+        self.index = index
+        self._critf = None
+
+    def critkeys(self, criterion):
+        if self._critf is None:
+            critvar = Input(ndim=criterion.ndim, dtype=criterion.dtype)
+            self._critf = theano.function(inputs=[critvar.d], outputs=self.memaddr.critkeys(critvar).d)
+        return self._critf(criterion)
+
+    def predict(self, criterion, k=10, nprobe=None):
+        """ criterion: (batsize, crit_dim), returns memory indexes and scores (batsize, k) """
+        return self.index.search(self.critkeys(criterion), k=k, nprobe=nprobe)
+
 
 class LinearGateMemAddr(MemoryAddress):     # TODO: -- TOO MUCH MEMORY USE, TOO SLOW
     def __init__(self, memblock, memdim=None, indim=None, attdim=None, **kw):
@@ -117,10 +203,16 @@ class TransDotMemAddr(MemoryAddress):
         self.U = param((indim, attdim), name="addr_crittrans").uniform()
 
     def apply(self, criterion):
-        wmem = T.dot(self.memblock.innervar, self.W)
-        ucrit = T.dot(criterion, self.U)
+        wmem = self.memkeys()
+        ucrit = self.critkeys(criterion)
         return T.dot(ucrit, wmem.T)
 
+    def memkeys(self):
+        return T.dot(self.memblock.innervar, self.W)
+
+    def critkeys(self, criterion):
+        return T.dot(criterion, self.U)
+
 
 class GeneralDotMemAddr(MemoryAddress):
     def __init__(self, memblock, memdim=None, indim=None, attdim=None, **kw):  # indim should be mem_dim, innerdim should be crit_dim
@@ -129,7 +221,7 @@ class GeneralDotMemAddr(MemoryAddress):
         self.W = param((memdim, indim), name="addressing").uniform()
 
     def apply(self, criterion):     # criterion: (batsize, indim), self.mem: (mem_size, mem_dim), out: (batsize, mem_size)
-        memdot = T.dot(self.memblock.innervar, self.W)  # (mem_size, indim)
+        memdot = self.memkeys()  # (mem_size, indim)
         '''def rec(x_t, crit):         # x_t: (indim),   crit: (batsize, indim)
             d = T.dot(crit, x_t)    # (batsize, )
             return T.nnet.sigmoid(d)
@@ -137,6 +229,12 @@ class GeneralDotMemAddr(MemoryAddress):
         return o.dimswap(1, 0)'''
         return T.dot(criterion, memdot.T)   # (batsize, mem_size)
 
+    def memkeys(self):
+        return T.dot(self.memblock.innervar, self.W)
+
+    def critkeys(self, criterion):
+        return criterion
+
 
 class DotMemAddr(MemoryAddress):
     """ Memory cell dimension must be the same as criterion dimension !!!"""
@@ -145,3 +243,9 @@ class DotMemAddr(MemoryAddress):
 
     def apply(self, criterion): # (batsize, encdim), memblock.var:: (memsize, encdim)
         return T.dot(criterion, self.memblock.innervar.T)
+
+    def memkeys(self):
+        return self.memblock.innervar
+
+    def critkeys(self, criterion):
+        return criterion
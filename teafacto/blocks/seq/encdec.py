@@ -5,6 +5,8 @@ from teafacto.blocks.seq.attention import Attention, WeightedSumAttCon, AttGen
 from teafacto.blocks.basic import MatDot
 from teafacto.blocks.match import CosineDistance, DotDistance
 from teafacto.use.recsearch import SeqEncDecWrapper
+from teafacto.use.modelusers import RecPredictor
+import numpy as np
 from IPython import embed
 
 
@@ -41,6 +43,35 @@ class SeqEncDec(Block):
     def rec(self, x_t, *states):
         return self.dec.rec(x_t, *states)
 
+    # incremental decoding
+    def get_decoder(self, inpseq, inmask=None):
+        """ Stateful decoder (RecPredictor): runs the encoder once on inpseq and keeps its context and mask,
+            every feed(x_t) advances the decoder one step and returns the probabilities of the next symbol """
+        initargs = [inpseq, inpseq.shape[0]] + ([inmask] if inmask is not None else [])
+        return RecPredictor(self).init(*initargs)
+
+    def greedy_decode(self, inpseq, maxlen, startsymbol=0, stopsymbol=None, inmask=None):
+        """ greedy decoding, one decoder step per output symbol.
+            Returns predicted symbols (batsize, maxlen) and their total probabilities (batsize,).
+            Decoding stops early when all sequences have produced stopsymbol, the rest is padded with stopsymbol """
+        dec = self.get_decoder(inpseq, inmask=inmask)
+        x_t = startsymbol * np.ones((inpseq.shape[0],), dtype="int32")
+        accprobs = np.ones((inpseq.shape[0],))
+        done = np.zeros((inpseq.shape[0],), dtype="bool")
+        outs = []
+        for i in range(maxlen):
+            probs = dec.feed(x_t)
+            x_t = np.argmax(probs, axis=1).astype("int32")
+            accprobs *= np.where(done, 1., np.max(probs, axis=1))
+            if stopsymbol is not None:
+                x_t[done] = stopsymbol
+                done |= x_t == stopsymbol
+            outs.append(x_t)
+            if np.all(done):
+                outs += [x_t] * (maxlen - i - 1)
+                break
+        return np.stack(outs, axis=1), accprobs
+
 
 class SimpleSeqEncDec(SeqEncDec):
     def __init__(self, inpvocsize=400,
@@ -1,4 +1,6 @@
-from teafacto.core.base import Block, param
+import numpy as np
+
+from teafacto.core.base import Block, param, Parameter, intrainmode
 from teafacto.core.base import tensorops as T
 from teafacto.util import getnumargs
 from teafacto.util import issequence
@@ -7,6 +9,45 @@ from IPython import embed
 
 default_init_carry_gate_bias = 1
 
+
+def fuseparams(parts, name=None):
+    """ concatenates parameters along their last axis into one parameter,
+        reset() re-initializes every part with its own initializer """
+    if not isinstance(parts[0], Parameter):     # disabled parts (noinput, nobias)
+        assert(not any([isinstance(part, Parameter) for part in parts]))
+        return parts[0]
+    _checkfusable(parts)
+    axis = len(parts[0].shape) - 1
+    initializers = [part.initializer for part in parts]
+    ret = Parameter(np.concatenate([part.v for part in parts], axis=axis),
+                    name=name, lrmul=parts[0].lrmul, regmul=parts[0].regmul)
+    ret.initializer = lambda: np.concatenate([init() for init in initializers], axis=axis)
+    return ret
+
+
+def splitparam(fused, names):
+    """ inverse of fuseparams: splits parameter along its last axis into len(names) parameters """
+    if not isinstance(fused, Parameter):
+        return [fused] * len(names)
+    _checkfusable([fused])
+    axis = len(fused.shape) - 1
+    initializer = fused.initializer
+    ret = []
+    for i, (name, value) in enumerate(zip(names, np.split(fused.v, len(names), axis=axis))):
+        part = Parameter(value, name=name, lrmul=fused.lrmul, regmul=fused.regmul)
+        part.initializer = (lambda i: lambda: np.split(initializer(), len(names), axis=axis)[i])(i)
+        ret.append(part)
+    return ret
+
+
+def _checkfusable(params):   # value constraints and EMA values don't carry over to fused or split params
+    for p in params:
+        if len(p.constraints) > 0 or p.ema_value is not None:
+            raise Exception("can not fuse or split parameter %s with constraints or EMA value" % p.name)
+    if len(set([(p.lrmul, p.regmul) for p in params])) > 1:
+        raise Exception("can not fuse parameters with different lrmul or regmul: %s" % ", ".join([p.name for p in params]))
+
+
 class RecurrentBlock(Block):     # ancestor class for everything that consumes sequences f32~(batsize, seqlen, ...)
     def __init__(self, reverse=False, **kw):
         super(RecurrentBlock, self).__init__(**kw)
@@ -48,6 +89,13 @@ class ReccableBlock(RecurrentBlock):    # exposes a rec function
     def rec(self, *args):
         raise NotImplementedError("use subclass")
 
+    # PRECOMPUTED INPUT API (optional): input projections for all time steps are computed before the scan
+    def precompute(self, x):    # x: (seqlen, batsize, dim) ==> list of sequences for recprecomp or None if not supported
+        return None
+
+    def recprecomp(self, *args):    # like rec but takes the precomputed inputs of one time step instead of x_t
+        raise NotImplementedError("use subclass")
+
     def get_init_info(self, initstates):
         raise NotImplementedError("use subclass")
 
@@ -64,14 +112,19 @@ class ReccableBlock(RecurrentBlock):    # exposes a rec function
             assert(issequence(infoarg))
         inputs = x.dimswap(1, 0) # inputs is (seq_len, batsize, dim)
         init_info = self.get_init_info(infoarg)
+        precomputed = self.precompute(inputs)
+        if precomputed is None:
+            recf, seqs = self.rec, [inputs]
+        else:                       # input projections of all time steps done outside scan
+            recf, seqs = self.recprecomp, list(precomputed)
         if mask is None:
-            outputs = T.scan(fn=self.rec,
-                                sequences=inputs,
+            outputs = T.scan(fn=recf,
+                                sequences=seqs,
                                 outputs_info=[None]+init_info,
                                 go_backwards=self._reverse)
         else:
-            outputs = T.scan(fn=self.recwmask,
-                                sequences=[inputs, mask.dimswap(1, 0)],
+            outputs = T.scan(fn=self._maskedrec(recf, len(seqs)),
+                                sequences=seqs + [mask.dimswap(1, 0)],
                                 outputs_info=[None] + init_info,
                                 go_backwards=self._reverse)
         if not issequence(outputs):
@@ -80,14 +133,21 @@ class ReccableBlock(RecurrentBlock):    # exposes a rec function
         return outputs[0][:, -1, :], outputs[0], outputs[1:]
 
     def recwmask(self, x_t, m_t, *states):   # m_t: (batsize, ), x_t: (batsize, dim), states: (batsize, **somedim**)
-        recout = self.rec(x_t, *states)
-        y_t = recout[0]
-        newstates = recout[1:]
-        y_tm1 = T.zeros_like(y_t)
-        y_tm1 = states[0]               # TODO: beware with multiple layers (here will be the bottom first)
-        y_t_out = (y_t.T * m_t + y_tm1.T * (1 - m_t)).T
-        states_out = [(a.T * m_t + b.T * (1 - m_t)).T for a, b in zip(newstates, states)]   # TODO: try replace with switch expression
-        return [y_t_out] + states_out
+        return self._maskedrec(self.rec, 1)(x_t, m_t, *states)
+
+    def _maskedrec(self, recf, numinps):    # wraps recf(*(inps + states)) into f(*(inps + [m_t] + states))
+        def inner(*args):
+            inps = list(args[:numinps])
+            m_t = args[numinps]
+            states = args[numinps + 1:]
+            recout = recf(*(inps + list(states)))
+            y_t = recout[0]
+            newstates = recout[1:]
+            y_tm1 = states[0]               # TODO: beware with multiple layers (here will be the bottom first)
+            y_t_out = (y_t.T * m_t + y_tm1.T * (1 - m_t)).T
+            states_out = [(a.T * m_t + b.T * (1 - m_t)).T for a, b in zip(newstates, states)]   # TODO: try replace with switch expression
+            return [y_t_out] + states_out
+        return inner
 
 
 class ReccableWrapper(ReccableBlock):
@@ -111,11 +171,13 @@ class ReccableWrapper(ReccableBlock):
 
 
 class RNUBase(ReccableBlock):
+    _precompute = True      # default for blocks saved before this setting existed
 
     def __init__(self, dim=20, innerdim=20, wreg=0.0001, noinput=False,
                  initmult=0.1, nobias=False, paraminit="glorotuniform", biasinit="uniform",
-                 dropout_in=False, dropout_h=False, **kw): #layernormalize=False): # dim is input dimensions, innerdim = dimension of internal elements
+                 dropout_in=False, dropout_h=False, precompute=True, **kw): #layernormalize=False): # dim is input dimensions, innerdim = dimension of internal elements
         super(RNUBase, self).__init__(**kw)
+        self._precompute = precompute
         self.indim = dim
         self.innerdim = innerdim
         self.wreg = wreg
@@ -145,6 +207,29 @@ class RNUBase(ReccableBlock):
         return ret
     '''
 
+    def inputproj(self, x):     # x: (batsize, dim) or (seqlen, batsize, dim) ==> list of input projections
+        raise NotImplementedError("use subclass")
+
+    def precompute(self, x):
+        if not self._precompute or self.noinput:
+            return None
+        definedin = lambda name: [c for c in type(self).__mro__ if name in c.__dict__][0]
+        if definedin("rec") is not definedin("recprecomp"):     # subclass with own rec
+            return None
+        if intrainmode() and self.dropout_in.p > 0:     # keep sampling input dropout in scan (rng updates)
+            return None
+        x = self.dropout_in(x)
+        return self.inputproj(x)
+
+    def _inpdot(self, x, w):    # one big GEMM over all time steps if x is a sequence
+        if self.noinput:
+            return 0
+        if x.ndim == 3:
+            xflat = x.reshape((x.shape[0] * x.shape[1], x.shape[2]))
+            ret = T.dot(xflat, w)
+            return ret.reshape((x.shape[0], x.shape[1], ret.shape[1]))
+        return T.dot(x, w)
+
     def recappl(self, inps, states):
         numrecargs = getnumargs(self.rec) - 2       # how much to pop from states
         mystates = states[:numrecargs]
@@ -207,26 +292,71 @@ class RNU(RNUBase):
 
     def rec(self, x_t, h_tm1):      # x_t: (batsize, dim), h_tm1: (batsize, innerdim)
         x_t = self.dropout_in(x_t) if not self.noinput else 0
-        inp = T.dot(x_t, self.w)    # w: (dim, innerdim) ==> inp: (batsize, innerdim)
+        return self.recprecomp(*(self.inputproj(x_t) + [h_tm1]))
+
+    def inputproj(self, x):
+        return [self._inpdot(x, self.w) + self.b]   # w: (dim, innerdim) ==> inp: (batsize, innerdim)
+
+    def recprecomp(self, inp, h_tm1):
         h_tm1 = self.dropout_h(h_tm1)
         rep = T.dot(h_tm1, self.u)  # u: (innerdim, innerdim) ==> rep: (batsize, innerdim)
-        h = inp + rep + self.b               # h: (batsize, innerdim)
+        h = inp + rep               # h: (batsize, innerdim)
         '''h = self.normalize_layer(h)'''
         h = self.outpactivation(h)               #
         return [h, h] #T.tanh(inp+rep)
 
 
 class GatedRNU(RNU):
-    def __init__(self, gateactivation=T.nnet.sigmoid, init_carry_bias=False, **kw):
+    fusespec = None     # ((fused param name, (separate param names)), ...) if gate weights can be fused
+    _fused = False
+
+    def __init__(self, gateactivation=T.nnet.sigmoid, init_carry_bias=False, fused=False, **kw):
         self.gateactivation = gateactivation
         self._init_carry_bias = init_carry_bias
+        assert(not fused or self.fusespec is not None)
+        self._fused = fused
         super(GatedRNU, self).__init__(**kw)
 
     def rec(self, *args):
         raise NotImplementedError("use subclass")
 
+    # FUSED GATE WEIGHTS: all gate weights in one matrix ==> one GEMM instead of one per gate
+    def fuse(self):     # converts separate gate params to fused layout
+        if not self._fused:
+            self._fuse()
+            self._fused = True
+        return self
+
+    def _fuse(self):
+        fused = [fuseparams([getattr(self, x) for x in partnames], name=fusedname)
+                 for fusedname, partnames in self.fusespec]     # all checked before any param is replaced
+        for (fusedname, partnames), p in zip(self.fusespec, fused):
+            setattr(self, fusedname, p)
+            for partname in partnames:
+                delattr(self, partname)
+
+    def unfuse(self):   # converts fused params back to separate gate params
+        if self._fused:
+            split = [splitparam(getattr(self, fusedname), partnames) for fusedname, partnames in self.fusespec]
+            for (fusedname, partnames), parts in zip(self.fusespec, split):
+                for partname, part in zip(partnames, parts):
+                    setattr(self, partname, part)
+                delattr(self, fusedname)
+            self._fused = False
+        return self
+
+    def _gatesplit(self, x, k):     # splits last dimension of x into k gate parts
+        if not hasattr(x, "ndim"):  # disabled (0)
+            return [x] * k
+        d = self.innerdim
+        return [x[(slice(None, None, None),) * (x.ndim - 1) + (slice(i * d, (i + 1) * d, None),)]
+                for i in range(k)]
+
 
 class GRU(GatedRNU):
+    fusespec = (("wfused", ("wm", "whf", "w")),
+                ("ufused", ("um", "uhf")),      # u is applied after the reset gate ==> not fused
+                ("bfused", ("bm", "bhf", "b")))
 
     def makeparams(self):
         if not self.noinput:
@@ -249,6 +379,8 @@ class GRU(GatedRNU):
             self.bhf = param((self.innerdim,), name="bhf").init(self.biasinit)
         else:
             self.b, self.bm, self.bhf = 0, 0, 0
+        if self._fused:
+            self._fuse()
 
     def rec(self, x_t, h_tm1):
         '''
@@ -257,10 +389,24 @@ class GRU(GatedRNU):
         :return: new state (nb_samples, out_dim)
         '''
         x_t = self.dropout_in(x_t) if not self.noinput else 0
+        return self.recprecomp(*(self.inputproj(x_t) + [h_tm1]))
+
+    def inputproj(self, x):
+        if self._fused:
+            return self._gatesplit(self._inpdot(x, self.wfused) + self.bfused, 3)
+        return [self._inpdot(x, self.wm) + self.bm,
+                self._inpdot(x, self.whf) + self.bhf,
+                self._inpdot(x, self.w) + self.b]
+
+    def recprecomp(self, xm_t, xhf_t, xc_t, h_tm1):
         h_tm1_i = self.dropout_h(h_tm1)
-        mgate =  self.gateactivation(T.dot(h_tm1_i, self.um)  + T.dot(x_t, self.wm)  + self.bm)
-        hfgate = self.gateactivation(T.dot(h_tm1_i, self.uhf) + T.dot(x_t, self.whf) + self.bhf)
-        canh = T.dot(h_tm1_i * hfgate, self.u) + T.dot(x_t, self.w) + self.b
+        if self._fused:
+            hm, hhf = self._gatesplit(T.dot(h_tm1_i, self.ufused), 2)
+        else:
+            hm, hhf = T.dot(h_tm1_i, self.um), T.dot(h_tm1_i, self.uhf)
+        mgate =  self.gateactivation(hm + xm_t)
+        hfgate = self.gateactivation(hhf + xhf_t)
+        canh = T.dot(h_tm1_i * hfgate, self.u) + xc_t
         '''canh = self.normalize_layer(canh)'''
         canh = self.outpactivation(canh)
         h = mgate * h_tm1 + (1-mgate) * canh
@@ -274,6 +420,7 @@ class RHN(GatedRNU):
 
 
 class IFGRU(GRU):      # input-modulating GRU
+    fusespec = None
 
     def makeparams(self):
         super(IFGRU, self).makeparams()
@@ -294,16 +441,29 @@ class IFGRU(GRU):      # input-modulating GRU
         :return: new state (nb_samples, out_dim)
         '''
         x_t = self.dropout_in(x_t) if not self.noinput else 0
+        return self.recprecomp(*(self.inputproj(x_t) + [h_tm1]))
+
+    def inputproj(self, x):     # input-modulated projection (w) depends on state ==> pass x itself
+        return [x,
+                self._inpdot(x, self.wm) + self.bm,
+                self._inpdot(x, self.whf) + self.bhf,
+                self._inpdot(x, self.wif) + self.bif]
+
+    def recprecomp(self, x_t, xm_t, xhf_t, xif_t, h_tm1):
         h_tm1 = self.dropout_h(h_tm1)
-        mgate =  self.gateactivation(T.dot(h_tm1, self.um)  + T.dot(x_t, self.wm)  + self.bm)
-        hfgate = self.gateactivation(T.dot(h_tm1, self.uhf) + T.dot(x_t, self.whf) + self.bhf)
-        ifgate = self.gateactivation(T.dot(h_tm1, self.uif) + T.dot(x_t, self.wif) + self.bif)
-        canh = self.outpactivation(T.dot(h_tm1 * hfgate, self.u) + T.dot(x_t * ifgate, self.w) + self.b)
+        mgate =  self.gateactivation(T.dot(h_tm1, self.um)  + xm_t)
+        hfgate = self.gateactivation(T.dot(h_tm1, self.uhf) + xhf_t)
+        ifgate = self.gateactivation(T.dot(h_tm1, self.uif) + xif_t)
+        canh = self.outpactivation(T.dot(h_tm1 * hfgate, self.u) + self._inpdot(x_t * ifgate, self.w) + self.b)
         h = mgate * h_tm1 + (1-mgate) * canh
         return [h, h]
 
 
 class LSTM(GatedRNU):
+    fusespec = (("wfused", ("wf", "wi", "w", "wo")),
+                ("rfused", ("rf", "ri", "r", "ro")),
+                ("bfused", ("bf", "bi", "b", "bo")))
+
     def makeparams(self):
         if not self.noinput:
             self.w = param((self.indim, self.innerdim), name="w").init(self.paraminit)
@@ -333,16 +493,34 @@ class LSTM(GatedRNU):
         self.pf = param((self.innerdim,), name="pf").init(self.biasinit)
         self.pi = param((self.innerdim,), name="pi").init(self.biasinit)
         self.po = param((self.innerdim,), name="po").init(self.biasinit)
+        if self._fused:
+            self._fuse()
 
     def rec(self, x_t, y_tm1, c_tm1):
         x_t = self.dropout_in(x_t) if not self.noinput else 0
+        return self.recprecomp(*(self.inputproj(x_t) + [y_tm1, c_tm1]))
+
+    def inputproj(self, x):
+        if self._fused:
+            return self._gatesplit(self._inpdot(x, self.wfused) + self.bfused, 4)
+        return [self._inpdot(x, self.wf) + self.bf,
+                self._inpdot(x, self.wi) + self.bi,
+                self._inpdot(x, self.w) + self.b,
+                self._inpdot(x, self.wo) + self.bo]
+
+    def recprecomp(self, xf_t, xi_t, xc_t, xo_t, y_tm1, c_tm1):
         c_tm1 = self.dropout_h(c_tm1)
-        fgate = self.gateactivation(c_tm1*self.pf + self.bf + T.dot(x_t, self.wf) + T.dot(y_tm1, self.rf))
-        igate = self.gateactivation(c_tm1*self.pi + self.bi + T.dot(x_t, self.wi) + T.dot(y_tm1, self.ri))
+        if self._fused:
+            yf, yi, yc, yo = self._gatesplit(T.dot(y_tm1, self.rfused), 4)
+        else:
+            yf, yi, yc, yo = T.dot(y_tm1, self.rf), T.dot(y_tm1, self.ri), \
+                             T.dot(y_tm1, self.r), T.dot(y_tm1, self.ro)
+        fgate = self.gateactivation(c_tm1*self.pf + xf_t + yf)
+        igate = self.gateactivation(c_tm1*self.pi + xi_t + yi)
         cf = c_tm1 * fgate
-        ifi = self.outpactivation(T.dot(x_t, self.w) + T.dot(y_tm1, self.r) + self.b) * igate
+        ifi = self.outpactivation(xc_t + yc) * igate
         c_t = cf + ifi
-        ogate = self.gateactivation(c_t*self.po + self.bo + T.dot(x_t, self.wo) + T.dot(y_tm1, self.ro))
+        ogate = self.gateactivation(c_t*self.po + xo_t + yo)
         y_t = ogate * self.outpactivation(c_t)
         return [y_t, y_t, c_t]
 
@@ -1,3 +1,4 @@
+import os, json
 from types import ModuleType
 from collections import OrderedDict
 from IPython import embed
@@ -12,6 +13,7 @@ from theano.sandbox.rng_mrg import MRG_RandomStreams as RandomStreams
 from teafacto.core.trainer import ModelTrainer, NSModelTrainer
 from teafacto.util import isstring, issequence, isfunction, Saveable, isnumber
 from teafacto.core.datafeed import DataFeed
+from teafacto.core.fcache import FunctionCache, getdefaultcache
 
 _TRAINMODE = False
 _DEBUGMODE = False
@@ -497,6 +499,12 @@ class RVal(Elem, TensorWrapped, Masked):    # random value
             self.value = self.rng.multinomial(shape, n, pvals, ndim, dtype)
         return self
 
+    def uniform(self, shape, low=0.0, high=1.0, ndim=None, dtype=None):
+        if isinstance(shape, Elem):
+            shape = shape.d
+        self.value = self.rng.uniform(shape, low, high, ndim, dtype)
+        return self
+
     def gumbel(self, shape, eps=1e-10):
         if isinstance(shape, Elem):
             shape = shape.d
@@ -635,6 +643,10 @@ class TrainModeContext(object):
         _TRAINMODE = self.oldtrainmode
 
 
+def intrainmode():
+    return _TRAINMODE is True
+
+
 
 
 class Block(Elem, Saveable): # block with parameters
@@ -885,6 +897,75 @@ class Block(Elem, Saveable): # block with parameters
         self._ownparams.add(p)
         return p
 
+    # parameter-only checkpoints
+    def namedparams(self):
+        """ parameters reachable through attributes of this block and its sub-blocks,
+            by hierarchical attribute name (e.g. "enc.block.layers.0.w"); shared parameters get their first name """
+        ret = OrderedDict()
+        seen = set()
+
+        def rec(x, name):
+            if id(x) in seen:
+                return
+            if isinstance(x, Parameter):
+                seen.add(id(x))
+                ret[name] = x
+            elif isinstance(x, Block):
+                seen.add(id(x))
+                for k in sorted(x.__dict__.keys()):
+                    if k not in ("inputs", "outputs"):
+                        rec(x.__dict__[k], k if name is None else "%s.%s" % (name, k))
+            elif isinstance(x, (list, tuple)):
+                for i, e in enumerate(x):
+                    rec(e, "%s.%d" % (name, i))
+            elif isinstance(x, dict):
+                for k in sorted(x.keys(), key=str):
+                    rec(x[k], "%s.%s" % (name, k))
+        rec(self, None)
+        return ret
+
+    def saveparams(self, path):
+        """ Saves only parameter values, as one .npy file per parameter in directory path,
+            with a small meta.json. Loading (loadparams()) requires a block built by the same code. """
+        if not os.path.exists(path):
+            os.makedirs(path)
+        meta = {"block": "%s.%s" % (self.__class__.__module__, self.__class__.__name__), "params": []}
+        for name, p in self.namedparams().items():
+            if p.value is None:
+                raise Exception("parameter %s has no value yet (lazy shape)" % name)
+            value = p.value.get_value(borrow=True)
+            np.save(os.path.join(path, name + ".npy"), value)
+            meta["params"].append({"name": name, "shape": list(value.shape), "dtype": str(value.dtype),
+                                   "lrmul": p.lrmul, "regmul": p.regmul})
+        with open(os.path.join(path, "meta.json"), "w") as f:
+            json.dump(meta, f, indent=1)
+        return path
+
+    def loadparams(self, path, mmap_mode="r"):
+        """ Loads parameter values saved with saveparams() into this block's parameters.
+            Values are memory-mapped with mmap_mode: "r" shares one read-only copy between processes (prediction),
+            "c" is copy-on-write (can be trained), None reads into memory. """
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        params = self.namedparams()
+        names = [entry["name"] for entry in meta["params"]]
+        if set(names) != set(params.keys()):
+            raise Exception("parameters of %s don't match checkpoint %s: missing %s, unexpected %s" % (
+                self.__class__.__name__, path,
+                sorted(set(params.keys()).difference(names)), sorted(set(names).difference(params.keys()))))
+        for name in names:
+            p = params[name]
+            value = np.load(os.path.join(path, name + ".npy"), mmap_mode=mmap_mode)
+            if p.value is None or p.lazyshape:
+                p.oncompleteshape(value.shape)
+            if p.value.get_value(borrow=True).shape != value.shape:
+                raise Exception("shape of %s doesn't match checkpoint: %s vs %s" % (
+                    name, str(p.value.get_value(borrow=True).shape), str(value.shape)))
+            if value.dtype != p.value.dtype:
+                value = value.astype(p.value.dtype)
+            p.value.set_value(value, borrow=True)
+        return self
+
     # training
     def train(self, inputdata, gold):
         # wrap data in datafeeds, generate gold var
@@ -972,21 +1053,77 @@ class OpBlock(Block):
 
 class NSBlock(Block):
     """ To wrap around normal blocks for negative sampling training """
-    def __init__(self, innerblock, obj, **kw):
+    def __init__(self, innerblock, obj, negsampler=None, nrate=1, **kw):
         self.inner = innerblock
         self.obj = obj
+        self.negsampler = negsampler    # in-graph sampler (GraphNegSampler): only positives are given to apply()
+        self.nrate = nrate
         super(NSBlock, self).__init__(**kw)
 
     def apply(self, *vars):
-        lvars = vars[:len(vars)/2]
-        rvars = vars[len(vars)/2:]
-        return self.obj(self.inner(*lvars), self.inner(*rvars))
+        if self.negsampler is None:
+            lvars = vars[:len(vars)/2]
+            rvars = vars[len(vars)/2:]
+            return self.obj(self.inner(*lvars), self.inner(*rvars))
+        lvars = vars
+        if self.nrate > 1:      # every positive is scored against nrate negatives
+            lvars = [tensorops.concatenate([x] * self.nrate, axis=0) for x in vars]
+        rvars = self.negsampler(*lvars)
+        ret = self.obj(self.inner(*lvars), self.inner(*rvars))
+        if self.nrate > 1:      # average over negatives of the same positive ==> (batsize,)
+            ret = ret.reshape((self.nrate, vars[0].shape[0])).mean(axis=0)
+        return ret
 
     @property
     def predict(self):
         return self.inner.predict
 
 
+class GraphNegSampler(object):
+    """ Negative sampling inside the training graph: replaces input which (default: last) of the positives
+        by random ids from [0, numids), uniform or proportional to freqs (alias method).
+        Use with NSTrainConfig.negsamplegen(); the training function then only takes positives. """
+    def __init__(self, numids=None, freqs=None, which=-1, seed=None):
+        assert(numids is not None or freqs is not None)
+        self.which = which
+        self.seed = np.random.randint(0, 1e6) if seed is None else seed
+        self.numids = len(freqs) if freqs is not None else numids
+        self.prob, self.alias = None, None
+        if freqs is not None:
+            prob, alias = self._aliastable(np.asarray(freqs, dtype="float64"))
+            self.prob = theano.shared(prob.astype(theano.config.floatX), name="negsam_prob")
+            self.alias = theano.shared(alias.astype("int32"), name="negsam_alias")
+
+    @staticmethod
+    def _aliastable(freqs):
+        n = len(freqs)
+        probs = freqs * n / freqs.sum()
+        prob = np.ones((n,))
+        alias = np.arange(n)
+        small = list(np.where(probs < 1.)[0])
+        large = list(np.where(probs >= 1.)[0])
+        while len(small) > 0 and len(large) > 0:
+            s, l = small.pop(), large.pop()
+            prob[s], alias[s] = probs[s], l
+            probs[l] -= 1. - probs[s]
+            (small if probs[l] < 1. else large).append(l)
+        return prob, alias
+
+    def __call__(self, *vars):
+        x = vars[self.which]
+        shape = x.d.shape
+        rng = RVal(self.seed)
+        u = rng.uniform(shape, dtype=theano.config.floatX).d
+        k = tensor.minimum(tensor.cast(tensor.floor(u * self.numids), "int32"), self.numids - 1)
+        if self.prob is not None:
+            u2 = rng.uniform(shape, dtype=theano.config.floatX).d
+            k = tensor.switch(u2 < self.prob[k], k, self.alias[k])
+        neg = Var(tensor.cast(k, x.d.dtype))
+        ret = list(vars)
+        ret[self.which] = neg
+        return ret
+
+
 class TransWrapBlock(Block):
     """ Wraps data transformation function """
     def __init__(self, block, transf, **kw):
@@ -1050,6 +1187,8 @@ class NSTrainConfig():
 
     def _makeblock(self):
         tb = TransWrapBlock(self.block, self.trans) # TODO: factor this TransWrap out
+        if isinstance(self.nsamgen, GraphNegSampler):
+            return NSBlock(tb, self.obj, negsampler=self.nsamgen, nrate=self.nrate)
         return NSBlock(tb, self.obj)
 
     def _maketrainer(self):
@@ -1058,7 +1197,10 @@ class NSTrainConfig():
         # wrap data in datafeeds, generate gold var
         goldvar = Input(gold.ndim, gold.dtype, name="gold")
 
-        trainer = NSModelTrainer(block, goldvar.d, self.nrate, self.nsamgen)
+        if isinstance(self.nsamgen, GraphNegSampler):   # negatives are sampled in the graph
+            trainer = NSModelTrainer(block, goldvar.d, 1, None)
+        else:
+            trainer = NSModelTrainer(block, goldvar.d, self.nrate, self.nsamgen)
         trainer.traindata = self.datas
         trainer.traingold = gold
 
@@ -1201,6 +1343,12 @@ class BlockPredictor(object):
         self.outs = []
         self.extra_outs = None
         self._numouts = None
+        self._fcache = None
+
+    def cachefunctions(self, path=None):
+        """ caches the compiled prediction function on disk (path=False disables caching) """
+        self._fcache = FunctionCache(path) if path is not False else False
+        return self
 
     def transform(self, f):
         if f is not None:
@@ -1249,10 +1397,12 @@ class BlockPredictor(object):
             allupdates = OrderedDict()
             for x in flatouts:
                 allupdates.update(x.allupdates)
-            _predictf_sym = theano.function(outputs=[x.d for x in flatouts],
-                                             inputs=[x.d for x in inps],
-                                             updates=allupdates,
-                                             on_unused_input="warn")
+            fcache = self._fcache if self._fcache is not None else getdefaultcache()
+            compiler = theano.function if fcache is None or self._fcache is False else fcache.function
+            _predictf_sym = compiler(outputs=[x.d for x in flatouts],
+                                     inputs=[x.d for x in inps],
+                                     updates=allupdates,
+                                     on_unused_input="warn")
             self._predictf = lambda *largs: \
                 restructurize(outstruct, _predictf_sym(*largs))
             """self._predictf = theano.function(outputs=[o.d for o in outp]
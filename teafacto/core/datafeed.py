@@ -1,15 +1,42 @@
+import sys, threading
 import numpy as np
 from math import ceil
 
 
+_LOCAL = threading.local()
+
+
+def rng():
+    """ Random state for use in sample transforms.
+        Inside a seeded PrefetchFeeder worker, this is a RandomState seeded by (seed, epoch, batch number),
+        so transforms are reproducible regardless of which worker runs them. Otherwise it's np.random. """
+    ret = getattr(_LOCAL, "rng", None)
+    return ret if ret is not None else np.random
+
+
+def outofcore(feed):
+    return isinstance(feed, (np.memmap, FeedView))
+
+
+def loadfeed(path):
+    """ memory-maps a .npy file to use as feed """
+    return np.load(path, mmap_mode="r")
+
+
 class DataFeeder(object): # contains data feeds
-    def __init__(self, *feeds, **kw): # feeds or numpy arrays
-        self.feeds = feeds
+    def __init__(self, *feeds, **kw): # feeds or numpy arrays or paths to .npy files (memory-mapped)
+        self.feeds = tuple([loadfeed(x) if isinstance(x, basestring) else x for x in feeds])
         self.batsize = None
         feedlens = [x.shape[0] for x in self.feeds]
         assert(feedlens.count(feedlens[0]) == len(feedlens)) # all data feeds must have equal number of examples (axis zero)
         self.size = feedlens[0]
         self._random = kw["random"] if "random" in kw else True   # or False or number
+        # chunk-aware shuffling: default for memory-mapped feeds
+        self._chunksize = kw["chunksize"] if "chunksize" in kw else None
+        self._outofcore = any([outofcore(x) for x in self.feeds])
+        # bucketing by sequence length
+        self._bucketing = kw["bucketing"] if "bucketing" in kw else None
+        self._lengths = None
         # iter state
         self.iteridxs = np.arange(self.size)
         self.offset = 0
@@ -32,12 +59,99 @@ class DataFeeder(object): # contains data feeds
         self._random = random
         return self
 
+    def chunks(self, chunksize):
+        """ shuffle order of chunks of consecutive examples, then shuffle within chunks.
+            Batches then mostly read contiguous pages of (memory-mapped) feeds """
+        self._chunksize = chunksize
+        return self
+
+    def getchunksize(self):
+        if self._chunksize is not None:
+            return self._chunksize
+        elif self._outofcore:
+            return self.size if self.batsize is None else self.batsize * 10
+        else:
+            return None
+
+    def bucket(self, maskid=0, numbuckets=10, seqfeeds=None):
+        """ Groups examples with similar sequence length (number of positions until the last non-mask position)
+            in the same batches and trims trailing all-mask positions of every batch.
+            Batches are shuffled within length buckets and batch order is shuffled.
+            seqfeeds: indexes of the sequence feeds to trim and to compute length from (required,
+            integer matrices like id pairs can have valid maskid values at the end) """
+        if seqfeeds is None:
+            raise Exception("bucketing needs the indexes of the sequence feeds (seqfeeds)")
+        self._bucketing = {"maskid": maskid, "numbuckets": numbuckets, "seqfeeds": list(seqfeeds)}
+        self._lengths = None
+        return self
+
+    def _seqfeeds(self):
+        return self._bucketing["seqfeeds"]
+
+    @staticmethod
+    def _seqlens(x, maskid):     # x: (numex, seqlen, ...) ==> (numex,) position after last non-mask
+        nonmask = x != maskid
+        if nonmask.ndim > 2:
+            nonmask = nonmask.reshape(nonmask.shape[:2] + (-1,)).any(axis=2)
+        seqlen = nonmask.shape[1]
+        return np.where(nonmask.any(axis=1), seqlen - np.argmax(nonmask[:, ::-1], axis=1), 0)
+
+    def getlengths(self, blocksize=10000):
+        if self._lengths is None:
+            maskid = self._bucketing["maskid"]
+            ret = np.zeros((self.size,), dtype="int64")
+            for i in self._seqfeeds():
+                for start in range(0, self.size, blocksize):    # don't load all of out-of-core feeds at once
+                    block = np.asarray(self.feeds[i][start:start+blocksize])
+                    ret[start:start+blocksize] = np.maximum(ret[start:start+blocksize], self._seqlens(block, maskid))
+            self._lengths = ret
+        return self._lengths
+
+    def _bucketorder(self):
+        lens = self.getlengths()
+        numbuckets = self._bucketing["numbuckets"]
+        bounds = np.unique(np.percentile(lens, np.linspace(0, 100, numbuckets + 1)[1:-1]))
+        bucketids = np.searchsorted(bounds, lens, side="right")
+        perm = np.random.permutation(self.size) if self._random is not False else np.arange(self.size)
+        order = perm[np.argsort(bucketids[perm], kind="mergesort")]   # random within bucket
+        batches = [order[i:i+self.batsize] for i in range(0, self.size, self.batsize)]
+        last = batches.pop() if len(batches[-1]) < self.batsize else None   # keep partial batch at end
+        if self._random is not False:
+            np.random.shuffle(batches)
+        if last is not None:
+            batches.append(last)
+        return np.concatenate(batches)
+
+    def _trim(self, batch):
+        maskid = self._bucketing["maskid"]
+        for i in self._seqfeeds():
+            maxlen = max(1, np.max(self._seqlens(batch[i], maskid)))
+            batch[i] = batch[i][:, :maxlen]
+        return batch
+
     # batching
     def reset(self):
-        if self._random is not False:
-            np.random.shuffle(self.iteridxs)
+        if self._bucketing is not None and self.batsize is not None:
+            self.iteridxs = self._bucketorder()
+        elif self._random is not False:
+            chunksize = self.getchunksize()
+            if chunksize is None:
+                np.random.shuffle(self.iteridxs)
+            else:
+                self.iteridxs = self._chunkshuffle(self.size, chunksize)
         self.offset = 0
 
+    @staticmethod
+    def _chunkshuffle(size, chunksize):
+        chunkstarts = np.arange(0, size, chunksize)
+        np.random.shuffle(chunkstarts)
+        acc = []
+        for start in chunkstarts:
+            chunk = np.arange(start, min(start + chunksize, size))
+            np.random.shuffle(chunk)
+            acc.append(chunk)
+        return np.concatenate(acc)
+
     def hasnextbatch(self):
         ret = self.offset <= self.size-2
         if not ret and self.autoreset:
@@ -52,7 +166,11 @@ class DataFeeder(object): # contains data feeds
         end = min(self.offset+self.batsize, self.size)
         sampleidxs = self.iteridxs[start:end]
         self.offset = end
+        if self._outofcore:     # read pages in order
+            sampleidxs = np.sort(sampleidxs)
         ret = [x[sampleidxs] for x in self.feeds]
+        if self._bucketing is not None:
+            ret = self._trim(ret)
         if withbatchsize:
             return ret, sampleidxs.shape[0]
         else:
@@ -65,8 +183,8 @@ class DataFeeder(object): # contains data feeds
         start = 0
         middle = int(ceil(1.*self.size / split))
         end = self.size
-        dfvalid = DataFeeder(*[self.splitfeed(feed, splitidxs[start:middle]) for feed in self.feeds], random=df_randoms[1])
-        dftrain = DataFeeder(*[self.splitfeed(feed, splitidxs[middle:end])   for feed in self.feeds], random=df_randoms[0])
+        dfvalid = self._subfeeder(splitidxs[start:middle], random=df_randoms[1])
+        dftrain = self._subfeeder(splitidxs[middle:end], random=df_randoms[0])
         return dftrain, dfvalid
 
     def osplit(self, split=2, random=False):
@@ -76,21 +194,187 @@ class DataFeeder(object): # contains data feeds
         start = 0
         end = int(ceil(1.*self.size / split))
 
-        return DataFeeder(*[self.splitfeed(feed, splitidxs[start:end]) for feed in self.feeds])
+        return self._subfeeder(splitidxs[start:end])
 
     def isplit(self, splitidxs, df_randoms=(True, True)):
         nsplitidxs = np.setdiff1d(np.arange(0, self.size), splitidxs)
-        dfvalid = DataFeeder(*[self.splitfeed(feed, splitidxs)  for feed in self.feeds], random=df_randoms[1])
-        dftrain = DataFeeder(*[self.splitfeed(feed, nsplitidxs) for feed in self.feeds], random=df_randoms[0])
+        dfvalid = self._subfeeder(splitidxs, random=df_randoms[1])
+        dftrain = self._subfeeder(nsplitidxs, random=df_randoms[0])
         return dftrain, dfvalid
 
+    def _subfeeder(self, idxs, random=True):
+        if self._outofcore:     # keep examples in storage order, shuffling is done by the new feeder
+            idxs = np.sort(idxs)
+        return DataFeeder(*[self.splitfeed(feed, idxs) for feed in self.feeds],
+                          random=random, chunksize=self._chunksize, bucketing=self._bucketing)
+
     def splitfeed(self, feed, idxs):
         if isinstance(feed, DataFeed):
             return feed.get(idxs)
+        elif outofcore(feed):   # don't copy out-of-core data
+            return FeedView(feed, idxs)
         else:
             return feed[idxs]
 
 
+class FeedView(object):
+    """ Index view on a (memory-mapped) feed, only reads the selected examples when indexed.
+        Reads are done in order of position in the underlying feed. """
+    def __init__(self, feed, idxs):
+        if isinstance(feed, FeedView):      # view of view
+            idxs = feed.idxs[idxs]
+            feed = feed.feed
+        self.feed = feed
+        self.idxs = np.asarray(idxs)
+
+    @property
+    def dtype(self):
+        return self.feed.dtype
+
+    @property
+    def shape(self):
+        return (self.idxs.shape[0],) + self.feed.shape[1:]
+
+    @property
+    def ndim(self):
+        return self.feed.ndim
+
+    def __len__(self):
+        return self.idxs.shape[0]
+
+    def __getitem__(self, item):
+        if isinstance(item, tuple):
+            return self[item[0]][(slice(None),) + item[1:]]
+        idxs = self.idxs[item]
+        if idxs.ndim == 0:
+            return np.asarray(self.feed[idxs])
+        order = np.argsort(idxs, kind="mergesort")
+        ret = np.empty((idxs.shape[0],) + self.feed.shape[1:], dtype=self.feed.dtype)
+        ret[order] = self.feed[idxs[order]]
+        return ret
+
+    def __array__(self, dtype=None):
+        return self[:] if dtype is None else self[:].astype(dtype)
+
+
+class PrefetchFeeder(object):
+    """ Wraps a DataFeeder and prepares the next batches (incl. applying transform) in background threads
+        while the current batch is being consumed. At most depth batches are prepared ahead.
+        Batches come out in the same order as from the wrapped feeder.
+        With one worker, batches and np.random use are the same as without prefetching.
+        With more workers, transforms should draw random numbers from rng() and a seed should be given. """
+    def __init__(self, feeder, transform=None, depth=2, workers=1, seed=None):
+        assert(depth > 0 and workers > 0)
+        self.feeder = feeder
+        self.transform = transform
+        self.depth = depth
+        self.workers = workers
+        self.seed = seed
+        self.epoch = -1
+        self._threads = []
+        self._cond = None
+
+    @property
+    def size(self):
+        return self.feeder.size
+
+    @property
+    def batsize(self):
+        return self.feeder.batsize
+
+    def getnumbats(self):
+        return self.feeder.getnumbats()
+
+    def reset(self):
+        self._stop()
+        self.epoch += 1
+        self._cond = threading.Condition()
+        self._readlock = threading.Lock()
+        self._slots = threading.Semaphore(self.depth)
+        self._results = {}
+        self._produced = 0      # number of batches taken from feeder
+        self._current = 0       # number of batches consumed
+        self._total = None      # known when feeder is exhausted
+        self._error = None
+        self._stopping = False
+        self.feeder.reset()
+        self._threads = [threading.Thread(target=self._work) for _ in range(self.workers)]
+        for t in self._threads:
+            t.daemon = True
+            t.start()
+
+    def _stop(self):
+        if len(self._threads) > 0:
+            self._stopping = True
+            self._wakeall()
+            for t in self._threads:
+                t.join()
+            self._threads = []
+
+    def _wakeall(self):
+        for _ in range(self.workers):
+            self._slots.release()
+
+    def _work(self):
+        try:
+            while True:
+                self._slots.acquire()
+                with self._readlock:
+                    if self._stopping or self._total is not None or self._error is not None:
+                        return
+                    if not self.feeder.hasnextbatch():
+                        with self._cond:
+                            self._total = self._produced
+                            self._cond.notify_all()
+                        self._wakeall()
+                        return
+                    i = self._produced
+                    batch, batsize = self.feeder.nextbatch(withbatchsize=True)
+                    self._produced += 1
+                batch = self._transform(i, batch)
+                with self._cond:
+                    self._results[i] = (batch, batsize)
+                    self._cond.notify_all()
+        except Exception:
+            with self._cond:
+                self._error = sys.exc_info()
+                self._cond.notify_all()
+            self._wakeall()
+
+    def _transform(self, i, batch):
+        if self.transform is None:
+            return batch
+        if self.seed is not None:
+            _LOCAL.rng = np.random.RandomState([self.seed, self.epoch, i])
+        try:
+            return self.transform(*batch)
+        finally:
+            _LOCAL.rng = None
+
+    def hasnextbatch(self):
+        if self._cond is None:
+            self.reset()
+        with self._cond:
+            while self._error is None and self._current not in self._results \
+                    and (self._total is None or self._current < self._total):
+                self._cond.wait(0.1)    # timeout keeps main thread interruptible
+            if self._error is not None:
+                raise self._error[0], self._error[1], self._error[2]
+            return self._current in self._results
+
+    def nextbatch(self, withbatchsize=False):
+        if not self.hasnextbatch():
+            raise StopIteration
+        with self._cond:
+            batch, batsize = self._results.pop(self._current)
+            self._current += 1
+        self._slots.release()
+        if withbatchsize:
+            return batch, batsize
+        else:
+            return batch
+
+
 class DataFeed(object):
     '''
     Wraps data, custom data feed can be implemented for dynamic sampling
@@ -0,0 +1,183 @@
+import os, re, hashlib, cPickle as pickle
+from collections import OrderedDict
+
+import numpy as np
+import theano
+from theano.compile.sharedvalue import SharedVariable
+from theano.gof import Constant
+from theano.gof.graph import io_toposort, inputs as graphinputs
+
+from teafacto.util import ticktock as TT
+
+
+_DEFAULTCACHE = None
+
+
+def cachefunctions(path=None):
+    """ enables the on-disk function cache for all trainers and predictors
+        that don't have their own cache set. path=False disables it again """
+    global _DEFAULTCACHE
+    _DEFAULTCACHE = None if path is False else FunctionCache(path)
+    return _DEFAULTCACHE
+
+
+def getdefaultcache():
+    return _DEFAULTCACHE
+
+
+def _opkey(op):
+    if hasattr(op, "inputs") and hasattr(op, "outputs"):   # scan or other op with inner graph
+        info = getattr(op, "info", {})
+        info = [(k, info[k]) for k in sorted(info.keys()) if k not in ("name", "profile")]
+        inner, _ = fingerprint(op.inputs, op.outputs)
+        ret = "%s{%s|%s}" % (type(op).__name__, str(info), inner)
+    elif getattr(op, "__props__", None) is not None:
+        ret = "%s%s" % (type(op).__name__, str(tuple([getattr(op, p) for p in op.__props__])))
+    else:
+        ret = "%s:%s" % (type(op).__name__, str(op))
+    return re.sub(" at 0x[0-9a-fA-F]+", "", ret)
+
+
+def fingerprint(inputs, outputs, updates=None):
+    """ Structural fingerprint of the graph from inputs to outputs and update expressions.
+        Returns the hex digest and the list of shared variables in order of first appearance.
+        Two graphs built by the same code get the same digest and the same shared variable order,
+        regardless of the order in which the updates are given. """
+    updates = updates.items() if isinstance(updates, dict) else list(updates) if updates is not None else []
+    inputs = list(inputs)
+    inputidxs = dict([(v, i) for i, v in enumerate(inputs)])
+    ids = {}
+    nodeids = {}
+    shared = []
+    lines = []
+
+    def varkey(v):
+        if v in ids:
+            return ids[v]
+        if v in inputidxs:
+            ret = "i%d:%s" % (inputidxs[v], str(v.type))
+        elif isinstance(v, SharedVariable):
+            ret = "s%d:%s" % (len(shared), str(v.type))
+            shared.append(v)
+        elif isinstance(v, Constant):
+            data = np.asarray(v.data)
+            ret = "c:%s:%s" % (str(v.type), hashlib.md5(data.tostring() + str(data.shape)).hexdigest())
+        else:
+            ret = "f:%s" % str(v.type)
+        ids[v] = ret
+        return ret
+
+    def walk(outs):
+        for node in io_toposort(graphinputs(outs), outs):
+            if node in nodeids:
+                continue
+            i = len(nodeids)
+            nodeids[node] = i
+            lines.append("%s(%s)" % (_opkey(node.op), ",".join([varkey(x) for x in node.inputs])))
+            for j, out in enumerate(node.outputs):
+                ids[out] = "n%d.%d" % (i, j)
+
+    outputs = list(outputs)
+    walk(outputs)
+    lines.append("outs(%s)" % ",".join([varkey(x) for x in outputs]))
+    # updates of already seen shared variables first, in order of appearance
+    pending = updates
+    while len(pending) > 0:
+        ready = [upd for upd in pending if upd[0] in ids]
+        ready = sorted(ready, key=lambda upd: shared.index(upd[0])) if len(ready) > 0 else pending[:1]
+        for upd in ready:
+            walk([upd[1]])
+            lines.append("upd(%s<-%s)" % (varkey(upd[0]), varkey(upd[1])))
+        readyids = set([id(upd) for upd in ready])
+        pending = [upd for upd in pending if id(upd) not in readyids]
+    lines.append("ins(%s)" % ",".join([varkey(x) for x in inputs]))
+    return hashlib.sha1("\n".join(lines)).hexdigest(), shared
+
+
+def graphorder(params, outputs):
+    """ sorts parameters by first appearance in the graph computing the outputs """
+    _, shared = fingerprint([], outputs)
+    order = dict([(v, i) for i, v in enumerate(shared)])
+    return sorted(params, key=lambda p: (order[p.d] if p.d in order else len(order), str(p)))
+
+
+class FunctionCache(object):
+    """ On-disk cache of compiled theano functions.
+        Functions are keyed by a structural fingerprint of their graph (including input types,
+        update expressions and optimizer constants), theano version and floatX.
+        Shared variables are stored empty and rebound to the shared variables of the current graph on load.
+        Default path is $TEAFACTO_FCACHE, or ~/.teafacto/fcache/ if not set. """
+    def __init__(self, path=None, verbose=True):
+        if path is None:
+            path = os.environ.get("TEAFACTO_FCACHE", os.path.join(os.path.expanduser("~"), ".teafacto", "fcache"))
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.path = path
+        self.tt = TT("FunctionCache", verbose=verbose)
+
+    def getkey(self, inputs, outputs, updates=None, mode=None):
+        digest, shared = fingerprint(inputs, outputs, updates)
+        settings = "|".join([digest, theano.__version__, theano.config.floatX,
+                             theano.config.device, re.sub(" at 0x[0-9a-fA-F]+", "", str(mode))])
+        return hashlib.sha1(settings).hexdigest(), shared
+
+    def function(self, inputs=None, outputs=None, updates=None, mode=None, **kw):
+        """ drop-in for theano.function """
+        updates = OrderedDict() if updates is None else updates
+        key, shared = self.getkey(inputs, outputs, updates, mode=mode)
+        ret = self.load(key, shared)
+        if ret is None:
+            ret = theano.function(inputs=inputs, outputs=outputs, updates=updates, mode=mode, **kw)
+            self.store(key, ret, shared)
+        return ret
+
+    def _filepath(self, key):
+        return os.path.join(self.path, key + ".pkl")
+
+    def load(self, key, shared):
+        p = self._filepath(key)
+        if not os.path.exists(p):
+            return None
+        try:
+            with open(p, "rb") as f:
+                f, placeholders = pickle.load(f)
+        except Exception as e:
+            self.tt.msg("could not load cached function %s (%s)" % (key, str(e)))
+            return None
+        if len(placeholders) != len(shared):
+            return None
+        swap = {}
+        for placeholder, sv in zip(placeholders, shared):
+            if placeholder is not None:
+                swap[placeholder] = sv
+        ret = f.copy(swap=swap)
+        self.tt.msg("loaded cached function %s" % key)
+        return ret
+
+    def store(self, key, f, shared):
+        fshared = set([x.variable for x in f.maker.inputs])
+        placeholders, swap = [], {}
+        for sv in shared:
+            if sv not in fshared:
+                placeholders.append(None)
+            else:
+                placeholder = self._placeholder(sv)
+                swap[sv] = placeholder
+                placeholders.append(placeholder)
+        fstore = f.copy(swap=swap)      # don't store (possibly large) parameter values
+        p = self._filepath(key)
+        with open(p + ".tmp", "wb") as outf:
+            pickle.dump((fstore, placeholders), outf, protocol=pickle.HIGHEST_PROTOCOL)
+        os.rename(p + ".tmp", p)
+        self.tt.msg("stored compiled function %s" % key)
+
+    def _placeholder(self, sv):
+        if isinstance(sv.type, theano.tensor.TensorType):
+            value = np.zeros([1 if b else 0 for b in sv.broadcastable], dtype=sv.dtype)
+            return theano.shared(value, name=sv.name, broadcastable=sv.broadcastable)
+        return theano.shared(sv.get_value(), name=sv.name)
+
+    def clear(self):
+        for p in os.listdir(self.path):
+            if p.endswith(".pkl"):
+                os.remove(os.path.join(self.path, p))
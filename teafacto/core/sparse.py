@@ -0,0 +1,120 @@
+from collections import OrderedDict
+
+import numpy as np
+import theano
+from theano import tensor
+from theano.gof.graph import io_toposort, inputs as graphinputs
+from theano.tensor.subtensor import AdvancedSubtensor1
+from theano.tensor.extra_ops import Unique
+
+
+def find_sparse_params(cost, params):
+    """ Finds the parameters that are only used through integer row indexing (W[idx]) in the graph of cost.
+        Returns an ordered dict from those parameters to a list of (idx, rows) for every use. """
+    uses = OrderedDict([(p.d, []) for p in params])
+    dense = set()
+    for node in io_toposort(graphinputs([cost]), [cost]):
+        for i, inp in enumerate(node.inputs):
+            if inp in uses:
+                if isinstance(node.op, AdvancedSubtensor1) and i == 0:
+                    uses[inp].append((node.inputs[1], node.outputs[0]))
+                else:       # any other use (incl. scan non-sequences) needs the full gradient
+                    dense.add(inp)
+    return OrderedDict([(p, uses[p.d]) for p in params
+                        if p.d not in dense and len(uses[p.d]) > 0])
+
+
+def aggregate_rows(idxs, grads, param):
+    """ Merges the row gradients of all uses of param, summing gradients of duplicate rows.
+        Returns unique row indexes and their gradients. """
+    idx = tensor.concatenate([tensor.cast(x, "int64") for x in idxs], axis=0)
+    grad = tensor.concatenate(grads, axis=0)
+    uidx, inv = Unique(return_inverse=True)(idx)
+    shape = [uidx.shape[0]] + [param.shape[i] for i in range(1, param.ndim)]
+    gsum = tensor.inc_subtensor(tensor.zeros(shape, dtype=grad.dtype)[inv], grad)
+    return uidx, gsum
+
+
+def _zeros_like(param):
+    value = param.get_value(borrow=True)
+    return theano.shared(np.zeros(value.shape, dtype=value.dtype),
+                         broadcastable=param.broadcastable)
+
+
+# SPARSE VERSIONS OF LASAGNE UPDATE RULES
+# take shared var param, unique row indexes idx and the gradient of these rows
+# optimizer state of rows that are not in idx is not touched (lazy updates)
+def sparse_sgd(param, idx, grad, learning_rate):
+    updates = OrderedDict()
+    updates[param] = tensor.inc_subtensor(param[idx], -learning_rate * grad)
+    return updates
+
+
+def sparse_momentum(param, idx, grad, learning_rate, momentum=0.9):
+    updates = OrderedDict()
+    velocity = _zeros_like(param)
+    x = momentum * velocity[idx] - learning_rate * grad
+    updates[velocity] = tensor.set_subtensor(velocity[idx], x)
+    updates[param] = tensor.inc_subtensor(param[idx], x)
+    return updates
+
+
+def sparse_nesterov_momentum(param, idx, grad, learning_rate, momentum=0.9):
+    updates = OrderedDict()
+    velocity = _zeros_like(param)
+    x = momentum * velocity[idx] - learning_rate * grad
+    updates[velocity] = tensor.set_subtensor(velocity[idx], x)
+    updates[param] = tensor.inc_subtensor(param[idx], momentum * x - learning_rate * grad)
+    return updates
+
+
+def sparse_adagrad(param, idx, grad, learning_rate=1.0, epsilon=1e-6):
+    updates = OrderedDict()
+    accu = _zeros_like(param)
+    accu_new = accu[idx] + grad ** 2
+    updates[accu] = tensor.set_subtensor(accu[idx], accu_new)
+    updates[param] = tensor.inc_subtensor(param[idx], -learning_rate * grad / tensor.sqrt(accu_new + epsilon))
+    return updates
+
+
+def sparse_rmsprop(param, idx, grad, learning_rate=1.0, rho=0.9, epsilon=1e-6):
+    updates = OrderedDict()
+    one = tensor.constant(1)
+    accu = _zeros_like(param)
+    accu_new = rho * accu[idx] + (one - rho) * grad ** 2
+    updates[accu] = tensor.set_subtensor(accu[idx], accu_new)
+    updates[param] = tensor.inc_subtensor(param[idx], -learning_rate * grad / tensor.sqrt(accu_new + epsilon))
+    return updates
+
+
+def sparse_adadelta(param, idx, grad, learning_rate=1.0, rho=0.95, epsilon=1e-6):
+    updates = OrderedDict()
+    one = tensor.constant(1)
+    accu = _zeros_like(param)
+    delta_accu = _zeros_like(param)
+    accu_new = rho * accu[idx] + (one - rho) * grad ** 2
+    updates[accu] = tensor.set_subtensor(accu[idx], accu_new)
+    delta_accu_rows = delta_accu[idx]
+    update = grad * tensor.sqrt(delta_accu_rows + epsilon) / tensor.sqrt(accu_new + epsilon)
+    updates[param] = tensor.inc_subtensor(param[idx], -learning_rate * update)
+    delta_accu_new = rho * delta_accu_rows + (one - rho) * update ** 2
+    updates[delta_accu] = tensor.set_subtensor(delta_accu[idx], delta_accu_new)
+    return updates
+
+
+def sparse_adam(param, idx, grad, learning_rate=0.001, beta1=0.9, beta2=0.999, epsilon=1e-8):
+    updates = OrderedDict()
+    one = tensor.constant(1)
+    t_prev = theano.shared(np.asarray(0., dtype=theano.config.floatX))
+    t = t_prev + 1
+    a_t = learning_rate * tensor.sqrt(one - beta2 ** t) / (one - beta1 ** t)
+    m_prev = _zeros_like(param)
+    v_prev = _zeros_like(param)
+    m_t = beta1 * m_prev[idx] + (one - beta1) * grad
+    v_t = beta2 * v_prev[idx] + (one - beta2) * grad ** 2
+    step = a_t * m_t / (tensor.sqrt(v_t) + epsilon)
+    updates[m_prev] = tensor.set_subtensor(m_prev[idx], m_t)
+    updates[v_prev] = tensor.set_subtensor(v_prev[idx], v_t)
+    updates[param] = tensor.inc_subtensor(param[idx], -step)
+    updates[t_prev] = t
+    return updates
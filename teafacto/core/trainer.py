@@ -1,4 +1,5 @@
 import sys, gc, inspect
+from collections import OrderedDict
 from pympler import asizeof
 from datetime import datetime as dt
 from IPython import embed
@@ -12,7 +13,10 @@ from theano import tensor as tensor
 from theano.compile.nanguardmode import NanGuardMode
 
 #from core import Input
-from teafacto.core.datafeed import DataFeeder, SplitIdxIterator
+from teafacto.core.datafeed import DataFeeder, SplitIdxIterator, PrefetchFeeder
+from teafacto.core.fcache import FunctionCache, getdefaultcache, graphorder
+from teafacto.core.sparse import find_sparse_params, aggregate_rows, sparse_sgd, sparse_momentum, \
+    sparse_nesterov_momentum, sparse_adagrad, sparse_rmsprop, sparse_adadelta, sparse_adam
 from teafacto.util import ticktock as TT, issequence
 
 
@@ -33,6 +37,28 @@ class thresh_lr(DynamicLearningParam):
         return lr if epoch < self.thresh else 0.
 
 
+class ParamSnapshot(object):
+    """ Keeps a copy of parameter values (and their moving averages) in preallocated buffers.
+        Restoring sets the values of the same shared variables, so compiled functions stay valid. """
+    def __init__(self, params):
+        self.shared = []
+        for param in params:
+            self.shared.append(param.value)
+            if param.ema_value is not None:
+                self.shared.append(param.ema_value)
+        self.buffers = [np.empty_like(x.get_value(borrow=True)) for x in self.shared]
+
+    def take(self):
+        for x, buf in zip(self.shared, self.buffers):
+            buf[...] = x.get_value(borrow=True)
+        return self
+
+    def restore(self):
+        for x, buf in zip(self.shared, self.buffers):
+            x.set_value(buf)    # copies
+        return self
+
+
 class ModelTrainer(object):
     def __init__(self, model, gold):
         self.model = model
@@ -50,10 +76,14 @@ class ModelTrainer(object):
         self.regularizer = None
         self._exp_mov_avg_decay = 0.0
         self.optimizer = None
+        self.sparse_optimizer = None
+        self._sparseupdates = False
         self.traindata = None
         self.traingold = None
         self.gradconstraints = []
         self._sampletransformers = []
+        self._prefetch = None
+        self._bucketing = None
         # validation settings
         self._validinter = 1
         self.trainstrategy = self._train_full
@@ -69,9 +99,12 @@ class ModelTrainer(object):
         self.besttaker = None
         self.bestmodel = None
         self.savebest = None
+        self._trainparams = []
         self.smallerbetter = True
         # writing
         self._writeresultspath = None
+        # compiled function cache
+        self._fcache = None
 
 
     #region ====================== settings =============================
@@ -266,36 +299,50 @@ class ModelTrainer(object):
     def sgd(self, lr):
         self._setlr(lr)
         self.optimizer = lambda x, y, l: sgd(x, y, learning_rate=l)
+        self.sparse_optimizer = lambda p, i, g, l: sparse_sgd(p, i, g, learning_rate=l)
         return self
 
     def momentum(self, lr, mome=0.9):
         self._setlr(lr)
         self.optimizer = lambda x, y, l: momentum(x, y, learning_rate=l, momentum=mome)
+        self.sparse_optimizer = lambda p, i, g, l: sparse_momentum(p, i, g, learning_rate=l, momentum=mome)
         return self
 
     def nesterov_momentum(self, lr, momentum=0.9):
         self._setlr(lr)
         self.optimizer = lambda x, y, l: nesterov_momentum(x, y, learning_rate=l, momentum=momentum)
+        self.sparse_optimizer = lambda p, i, g, l: sparse_nesterov_momentum(p, i, g, learning_rate=l, momentum=momentum)
         return self
 
     def adagrad(self, lr=1.0, epsilon=1e-6):
         self._setlr(lr)
         self.optimizer = lambda x, y, l: adagrad(x, y, learning_rate=l, epsilon=epsilon)
+        self.sparse_optimizer = lambda p, i, g, l: sparse_adagrad(p, i, g, learning_rate=l, epsilon=epsilon)
         return self
 
     def rmsprop(self, lr=1., rho=0.9, epsilon=1e-6):
         self._setlr(lr)
         self.optimizer = lambda x, y, l: rmsprop(x, y, learning_rate=l, rho=rho, epsilon=epsilon)
+        self.sparse_optimizer = lambda p, i, g, l: sparse_rmsprop(p, i, g, learning_rate=l, rho=rho, epsilon=epsilon)
         return self
 
     def adadelta(self, lr=1., rho=0.95, epsilon=1e-6):
         self._setlr(lr)
         self.optimizer = lambda x, y, l: adadelta(x, y, learning_rate=l, rho=rho, epsilon=epsilon)
+        self.sparse_optimizer = lambda p, i, g, l: sparse_adadelta(p, i, g, learning_rate=l, rho=rho, epsilon=epsilon)
         return self
 
     def adam(self, lr=0.001, b1=0.9, b2=0.999, epsilon=1e-8):
         self._setlr(lr)
         self.optimizer = lambda x, y, l: adam(x, y, learning_rate=l, beta1=b1, beta2=b2, epsilon=epsilon)
+        self.sparse_optimizer = lambda p, i, g, l: sparse_adam(p, i, g, learning_rate=l, beta1=b1, beta2=b2, epsilon=epsilon)
+        return self
+
+    def sparse_updates(self, enable=True):
+        """ Update parameters that are only used through integer row indexing (embeddings)
+            only in the rows touched by the batch, with lazily updated optimizer state.
+            Parameters with constraints or nonzero regularization are always updated densely. """
+        self._sparseupdates = enable
         return self
     #endregion
 
@@ -365,9 +412,10 @@ class ModelTrainer(object):
         self.numbats = numbats
         self.maxiter = epochs
         errors = self.trainstrategy(_skiptrain=_skiptrain)       # trains according to chosen training strategy, returns errors
-        if self.besttaker is not None and self.savebest is None:      # unfreezes best model if best choosing was chosen
-            self.model = self.model.__class__.unfreeze(self.bestmodel[0])
-            self.tt.tock("unfroze best model (%.3f) - " % self.bestmodel[1]).tick()
+        if self.besttaker is not None and not self.savebest \
+                and self.bestmodel[0] is not None:      # restores best model if best choosing was chosen
+            self.bestmodel[0].restore()
+            self.tt.tock("restored best model (%.3f) - " % self.bestmodel[1]).tick()
         ret = self.model
         if returnerrors:
             ret = (ret,) + errors
@@ -395,7 +443,8 @@ class ModelTrainer(object):
             outp = outps[0]
             self.tt.tock("training - autobuilt")
             self.tt.tick("compiling training function")
-            params = outp.allparams
+            params = graphorder(outp.allparams, [outp.d])     # deterministic order (for function caching)
+            self._trainparams = params
             nonparams = [p for p in params if not p.lrmul > 0]
             params = [p for p in params if p.lrmul > 0]
             scanupdates = outp.allupdates
@@ -425,10 +474,25 @@ class ModelTrainer(object):
             #for x in params:
             #    self.tt.msg("computing gradient for %s" % str(x))
             #    grads.append(tensor.grad(cost, x.d))
-            grads = tensor.grad(cost, [x.d for x in params])  # compute gradient
+            sparseparams = self._find_sparse_params(loss, params)
+            sparseids = set(map(id, sparseparams))
+            denseparams = [p for p in params if id(p) not in sparseids]
+            if len(sparseparams) > 0:
+                self.tt.msg("sparse row updates for: %s" % ", ".join([str(p) for p in sparseparams]))
+            rowvars = [rows for p in sparseparams for _, rows in sparseparams[p]]
+            grads = tensor.grad(cost, [x.d for x in denseparams] + rowvars)  # compute gradient
             self.tt.msg("computed gradients")
-            grads = self._gradconstrain(grads)
-            for param, grad in zip(params, grads):
+            rowgrads = grads[len(denseparams):]
+            grads = grads[:len(denseparams)]
+            rowidxs = []
+            for param in sparseparams:
+                uses = sparseparams[param]
+                idx, rowgrad = aggregate_rows([u[0] for u in uses], rowgrads[:len(uses)], param.d)
+                rowgrads = rowgrads[len(uses):]
+                rowidxs.append(idx)
+                grads.append(rowgrad)
+            grads = self._gradconstrain(grads)      # row grads have the same norm as the full grads
+            for param, grad in zip(denseparams, grads[:len(denseparams)]):
                 upds = self.optimizer([grad], [param.d], self.get_learning_rate() * param.lrmul)
                 newparamval = None
 
@@ -448,11 +512,14 @@ class ModelTrainer(object):
                         param.ema_value = theano.shared(param.value.get_value())
                         updates.append((param.ema_value,
                             param.ema_value * self._exp_mov_avg_decay + newparamval * (1 - self._exp_mov_avg_decay)))
+            for param, idx, grad in zip(sparseparams.keys(), rowidxs, grads[len(denseparams):]):
+                upds = self.sparse_optimizer(param.d, idx, grad, self.get_learning_rate() * param.lrmul)
+                updates.extend(upds.items())
             #print updates
             #embed()
             finputs = [x.d for x in inputs] + [self.goldvar]
             allupdates = updates + scanupdates.items()
-            trainf = theano.function(
+            trainf = self._function(
                 inputs=finputs,
                 outputs=[cost],
                 updates=allupdates,
@@ -462,6 +529,13 @@ class ModelTrainer(object):
             self.tt.tock("training function compiled")
         return trainf
 
+    def _find_sparse_params(self, loss, params):
+        if not self._sparseupdates or self.sparse_optimizer is None or self._exp_mov_avg_decay > 0:
+            return OrderedDict()
+        candidates = [p for p in params
+                      if len(p.constraints) == 0 and (self.regularizer is None or p.regmul == 0)]
+        return find_sparse_params(loss, candidates)
+
     def buildlosses(self, output, objs):
         acc = []
         for objective in objs:
@@ -506,7 +580,7 @@ class ModelTrainer(object):
         inputs = newinp if newinp is not None else inps
         ret = None
         if len(metrics) > 0:
-            ret = theano.function(inputs=[x.d for x in inputs] + [self.goldvar],
+            ret = self._function(inputs=[x.d for x in inputs] + [self.goldvar],
                                   outputs=metrics,
                                   mode=NanGuardMode(nan_is_error=True, inf_is_error=False, big_is_error=True)
                                   )
@@ -514,11 +588,18 @@ class ModelTrainer(object):
             self.tt.msg("NO VALIDATION METRICS DEFINED, RETURNS NONE")
         self.tt.tock("validation function compiled")
         return ret
+
+    def _function(self, **kw):
+        fcache = self._fcache if self._fcache is not None else getdefaultcache()
+        if fcache is None or self._fcache is False:
+            return theano.function(**kw)
+        else:
+            return fcache.function(**kw)
     #endregion
 
     #region ################## TRAINING STRATEGIES ############
     def _train_full(self, _lambda=False, _skiptrain=False): # on all data, no validation
-        df = DataFeeder(*(self.traindata + [self.traingold])).numbats(self.numbats)
+        df = self._makefeeder(*(self.traindata + [self.traingold])).numbats(self.numbats)
         trainf = self.buildtrainfun(self.model, df.batsize)
         if _lambda:
             return trainf, None, df, None
@@ -529,8 +610,8 @@ class ModelTrainer(object):
             return err, None, None, None
 
     def _train_validdata(self, _lambda=False, _skiptrain=False):
-        df = DataFeeder(*(self.traindata + [self.traingold])).numbats(self.numbats)
-        vdf = DataFeeder(*(self.validdata + [self.validgold]), random=False)
+        df = self._makefeeder(*(self.traindata + [self.traingold])).numbats(self.numbats)
+        vdf = self._makefeeder(*(self.validdata + [self.validgold]), random=False)
         vdf.batsize = df.batsize
         trainf = self.buildtrainfun(self.model, df.batsize)
         validf = self.getvalidfun(self.model, vdf.batsize)
@@ -546,7 +627,7 @@ class ModelTrainer(object):
             return err, verr, None, None
 
     def _train_split(self, _lambda=False, _skiptrain=False):
-        df = DataFeeder(*(self.traindata + [self.traingold]))
+        df = self._makefeeder(*(self.traindata + [self.traingold]))
         dftrain, dfvalid = df.split(self.validsplits, self.validrandom, df_randoms=(True, False))
         dftrain.numbats(self.numbats)
         dfvalid.batsize = dftrain.batsize
@@ -562,7 +643,7 @@ class ModelTrainer(object):
             return err, verr, None, None
 
     def _train_cross_valid(self, _skiptrain=False):
-        df = DataFeeder(*(self.traindata + [self.traingold]))
+        df = self._makefeeder(*(self.traindata + [self.traingold]))
         splitter = SplitIdxIterator(df.size, split=self.validsplits, random=self.validrandom, folds=self.validsplits)
         err = []
         verr = []
@@ -648,8 +729,8 @@ class ModelTrainer(object):
                         self.save(suffix=".best")
                         self.bestmodel = (None, modelscore)
                     else:
-                        #tt.tock("freezing best with score %.3f (prev: %.3f)" % (modelscore, self.bestmodel[1]), prefix="-").tick()
-                        self.bestmodel = (self.save(freeze=True, filepath=False), modelscore)
+                        #tt.tock("snapshotting best with score %.3f (prev: %.3f)" % (modelscore, self.bestmodel[1]), prefix="-").tick()
+                        self.bestmodel = (self.snapshot(), modelscore)
             tt.tock(ttmsg + "\t", prefix="-")
             self._update_lr(self.currentiter, self.maxiter, err, verr)
             evalcount += 1
@@ -664,6 +745,10 @@ class ModelTrainer(object):
         '''
         sampletransf = self._transformsamples
         this = self
+        if self._prefetch is not None:      # transforms are applied by the prefetching feeder
+            datafeeder = PrefetchFeeder(datafeeder, transform=lambda *s: sampletransf(*s, phase=phase),
+                                        **self._prefetch)
+            sampletransf = lambda *s, **kw: s
 
         def batchloop():
             c = 0
@@ -714,6 +799,26 @@ class ModelTrainer(object):
     def sampletransform(self, *f):
         self._sampletransformers = f
         return self
+
+    def bucketed(self, maskid=0, numbuckets=10, seqfeeds=None):
+        """ batch examples of similar length together and trim trailing masked positions of every batch
+            (see DataFeeder.bucket(), seqfeeds index into traindata + [traingold] and are required) """
+        if seqfeeds is None:
+            raise Exception("bucketing needs the indexes of the sequence feeds (seqfeeds)")
+        self._bucketing = {"maskid": maskid, "numbuckets": numbuckets, "seqfeeds": seqfeeds}
+        return self
+
+    def _makefeeder(self, *feeds, **kw):
+        ret = DataFeeder(*feeds, **kw)
+        if self._bucketing is not None:
+            ret.bucket(**self._bucketing)
+        return ret
+
+    def prefetch(self, depth=2, workers=1, seed=None):
+        """ prepare and transform the next depth batches in background threads while training on the current one.
+            With more than one worker, sample transforms should use teafacto.core.datafeed.rng() and set a seed. """
+        self._prefetch = {"depth": depth, "workers": workers, "seed": seed}
+        return self
     #endregion
     #endregion
 
@@ -732,6 +837,16 @@ class ModelTrainer(object):
         self._writeresultspath = p
         return self
 
+    def cachefunctions(self, path=None):
+        """ caches compiled training and validation functions on disk (path=False disables caching) """
+        self._fcache = FunctionCache(path) if path is not False else False
+        return self
+
+    def snapshot(self):     # reuses buffers of previous snapshot
+        if not isinstance(self.bestmodel[0], ParamSnapshot):
+            return ParamSnapshot(self._trainparams).take()
+        return self.bestmodel[0].take()
+
     def save(self, model=None, filepath=None, suffix="", freeze=False):
         model = model if model is not None else \
             self.model if self._autosaveblock is None else \
@@ -806,8 +921,8 @@ class InterleavedTrainer(object):
             if self.spts[0].original.besttaker is not None:
                 modelscore = self.spts[0].original.besttaker(([erre[0]] + verre[0] + [self.currentiter]))
                 if modelscore < self.spts[0].original.bestmodel[1]:
-                    # tt.tock("freezing best with score %.3f (prev: %.3f)" % (modelscore, self.bestmodel[1]), prefix="-").tick()
-                    self.spts[0].original.bestmodel = (self.spts[0].original.model.freeze(), modelscore)
+                    # tt.tock("snapshotting best with score %.3f (prev: %.3f)" % (modelscore, self.bestmodel[1]), prefix="-").tick()
+                    self.spts[0].original.bestmodel = (self.spts[0].original.snapshot(), modelscore)
 
             ttlines = []
             for i in range(len(erre)):
@@ -891,20 +1006,19 @@ class NSModelTrainer(ModelTrainer):
 
     def _transformsamples(self, *s, **kw):
         # phase in kw
-        """ apply negative sampling function and neg sam rate """
+        """ apply negative sampling function and neg sam rate:
+            positives are repeated nrate times and all negatives are drawn in one call """
+        if self.ns_nsamgen is None:     # negatives are sampled inside the graph
+            return list(s)
         psams = s[:-1]
-        acc = []
-        for i in range(self.ns_nrate):
-            nsams = self.ns_nsamgen(*psams)
-            news = psams + nsams + (s[-1],)
-            ret = []
-            if len(acc) == 0:       # first one
-                ret = news
-            else:
-                for x, y in zip(acc, news):
-                    ret.append(np.concatenate([x, y], axis=0))
-            acc = ret
-        return acc
+        if self.ns_nrate > 1:
+            tile = lambda x: np.concatenate([x] * self.ns_nrate, axis=0)
+            psams = tuple(map(tile, psams))
+            s = psams + (tile(s[-1]),)
+        nsams = self.ns_nsamgen(*psams)
+        return list(psams + tuple(nsams) + (s[-1],))
 
     def autobuild_model(self, model, *traindata, **kw):
+        if self.ns_nsamgen is None:     # in-graph negative sampling: model only takes positives
+            return model.autobuild(*traindata)
         return model.autobuild(*(traindata + traindata))
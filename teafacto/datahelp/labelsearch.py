@@ -1,86 +1,39 @@
-import elasticsearch, re, sys
+import itertools, sys
 from teafacto.util import tokenize, argprun
+from teafacto.datahelp.ngramindex import NGramIndex
 
 
 class SimpleQuestionsLabelIndex(object):
-    def __init__(self, host="drogon", index="simplequestions_labels"):
+    """ Label index kept on disk in directory <index> (see NGramIndex), no search server needed.
+        host is not used anymore and only kept for existing callers. """
+    def __init__(self, host=None, index="simplequestions_labels", tokenizer=tokenize):
         self.host = host
         self.indexp = index
+        self.tokenizer = tokenizer
+        self.idx = NGramIndex(index)
 
     def index(self, labelp="labels.map"):
-        es = elasticsearch.Elasticsearch(hosts=[self.host])
-        try:
-            es.indices.delete(index=self.indexp)
-        except Exception, e:
-            print "could not delete index %s" % self.indexp
-        es.indices.create(index=self.indexp,
-                          body={
-                              "settings": {
-                                  "index": {
-                                      "analysis": {
-                                          "filter": {
-                                            "pstemmer": {
-                                              "type": "porter_stem",
-                                              "language": "_english_"
-                                            }
-                                          },
-                                          "char_filter": {
-                                            "punctfil": {
-                                              "type": "pattern_replace",
-                                              "pattern": "[\W]",
-                                              "replacement": ""
-                                            }
-                                          },
-                                          "analyzer": {
-                                              "myana": {
-                                                  "tokenizer": "whitespace",
-                                                  "filter": [
-                                                      "lowercase",
-                                                      "pstemmer",
-                                                  ]
-                                                  #,"char_filter": ["punctfil"]
-                                              }
-                                          }
-                                      }
-                                  }
-                              },
-                              "mappings": {
-                                  "labelmap": {
-                                      "properties": {
-                                          "label": {
-                                              "type": "string",
-                                              "analyzer": "myana",
-                                              "fields": {
-                                                "len": {
-                                                    "type": "token_count",
-                                                    "store": "yes",
-                                                    "analyzer": "myana"
-                                                }
-                                              }
-                                          }
-                                      }
-                                  }
-                              }
-                          })
-        i = 1
-        for line in open(labelp):
-            k, v = line[:-1].split("\t")
-            vt = tokenize(v)
-            es.index(index=self.indexp, doc_type="labelmap", id=i,
-                     body={"label": " ".join(vt), "fbid": k})
-            if i % 1000 == 0:
-                print i
-            i += 1
+        def docs():
+            i = 1
+            for line in open(labelp):
+                k, v = line[:-1].split("\t")
+                yield k, self.tokenizer(v)
+                if i % 100000 == 0:
+                    print i
+                i += 1
+        self.idx.build(docs())
         print "indexed labels"
 
-    def search(self, query, top=10):
-        es = elasticsearch.Elasticsearch(hosts=[self.host])
-        res = es.search(index=self.indexp, q="label:%s" % query, size=top)
-        acc = {}
-        for r in res["hits"]["hits"]:
-            self._merge(acc, {r["_source"]["fbid"]: (r["_score"], r["_source"]["label"])})
+    def _hits(self, docs, scores, acc=None):
+        acc = {} if acc is None else acc
+        for doc, score in zip(docs, scores):
+            self._merge(acc, {self.idx.key(doc): (score, self.idx.label(doc))})
         return acc
 
+    def search(self, query, top=10):
+        docs, scores = self.idx.search(query.split(), top=top)
+        return self._hits(docs, scores)
+
     @staticmethod
     def _merge(acc, d):
         for k, v in d.items():
@@ -91,9 +44,21 @@ class SimpleQuestionsLabelIndex(object):
                 acc[k] = v
 
     def searchsentence(self, s, top=None, topsize=None, exact=True):
-        s = tokenize(s)
-        ngrams = self.getallngrams(s, topsize)
-        return self.searchallngrams(ngrams, top, exact=exact)
+        return self.searchsentences([s], top=top, topsize=topsize, exact=exact)[0]
+
+    def searchsentences(self, sentences, top=None, topsize=None, exact=True):
+        """ searchsentence for many sentences, with one batched index lookup of all their n-grams """
+        allngrams = [list(self.getallngrams(self.tokenizer(s), topsize)) for s in sentences]
+        res = self.idx.lookup(list(itertools.chain(*allngrams)), exact=exact, top=top)
+        ret = []
+        i = 0
+        for ngrams in allngrams:
+            cans = {}
+            for docs, scores in res[i:i + len(ngrams)]:
+                self._hits(docs, scores, acc=cans)
+            ret.append(cans)
+            i += len(ngrams)
+        return ret
 
     def getallngrams(self, s, topsize=None):
         topsize = len(s) if topsize is None else topsize
@@ -109,73 +74,15 @@ class SimpleQuestionsLabelIndex(object):
         return ngrams
 
     def searchallngrams(self, ngrams, top=None, exact=True):
-        #print ngrams
-        es = elasticsearch.Elasticsearch(hosts=[self.host])
-        searchbody = []
-        header = {"index": self.indexp, "type": "labelmap"}
-        for ngram in ngrams:
-            if not exact:
-                body = {
-                            "query": {
-                                "filtered": {
-                                    "query": {
-                                        "match_phrase": {
-                                            "label":  " ".join(ngram)
-                                        }
-                                    }
-                                }
-                            }
-                        }
-            else:
-                body = {
-                            "query": {
-                                "filtered": {
-                                    "query": {
-                                        "match_phrase": {
-                                            "label":  {
-                                                "query": " ".join(ngram)
-                                            }
-                                        }
-                                    },
-                                    "filter": {
-                                        "term": {
-                                            "label.len": len(ngram)
-                                        }
-                                    }
-                                }
-                            }
-                        }
-                """{
-                    "query": {
-                        "constant_score": {
-                            "filter": {
-                                "term": {
-                                    "label": " ".join(ngram)
-                                }
-                            }
-                        }
-                    }
-                }
-                """
-
-            if top is not None:
-                body.update({"size": top, "from": 0})
-            searchbody.append(header)
-            searchbody.append(body)
-        ngramres = es.msearch(body=searchbody)
         cans = {}
-        for response in ngramres["responses"]:
-            try:
-                for r in response["hits"]["hits"]:
-                    self._merge(cans, {r["_source"]["fbid"]: (r["_score"], r["_source"]["label"])})
-            except KeyError, e:
-                print response
+        for docs, scores in self.idx.lookup(list(ngrams), exact=exact, top=top):
+            self._hits(docs, scores, acc=cans)
         return cans
 
 
 def run(index=False, indexp="labels.map", indexname="sq_subjnames_fb2m",
-        search="e mc", host="localhost", exact=False, top=10):
-    idx = SimpleQuestionsLabelIndex(host=host, index=indexname)
+        search="e mc", exact=False, top=10):
+    idx = SimpleQuestionsLabelIndex(index=indexname)
     if index is True and indexp is not None:
         idx.index(labelp=indexp)
         sys.exit()
@@ -189,4 +96,4 @@ def run(index=False, indexp="labels.map", indexname="sq_subjnames_fb2m",
 
 
 if __name__ == "__main__":
-    argprun(run)
\ No newline at end of file
+    argprun(run)
@@ -0,0 +1,241 @@
+import itertools
+import os
+import numpy as np
+from nltk.stem.porter import PorterStemmer
+
+from teafacto.util import ticktock
+
+
+_P = np.uint64(1000003)
+
+
+def _seqhash(ids, offsets):
+    """ polynomial hash of every id sequence ids[offsets[i]:offsets[i+1]] """
+    lens = np.diff(offsets)
+    h = np.zeros((len(lens),), dtype="uint64")
+    for j in range(np.max(lens) if len(lens) > 0 else 0):
+        m = lens > j
+        h[m] = h[m] * _P + (ids[offsets[:-1][m] + j].astype("uint64") + np.uint64(1))
+    return h
+
+
+def _tostr(x):
+    return x.encode("utf-8") if isinstance(x, unicode) else x
+
+
+class NGramIndex(object):
+    """ On-disk inverted index of short labels (token sequences) for exact and phrase n-gram lookup.
+        Tokens are split on whitespace, lowercased and porter-stemmed.
+        Documents, postings and label hashes are kept in .npy files in directory path and memory-mapped.
+        Matches are scored like Lucene's classic phrase similarity: sqrt(phrase freq) * sum of term idfs / sqrt(label length). """
+    _files = ["doclens", "docoffsets", "docterms", "df", "postoffsets", "postkeys", "hashes", "hashorder"]
+
+    def __init__(self, path):
+        self.path = path
+        self._stemmer = PorterStemmer()
+        self._stems = {}
+        self._loaded = False
+
+    # ANALYSIS
+    def analyze(self, tokens):
+        return [self._stem(t) for t in " ".join(tokens).split()]
+
+    def _stem(self, token):
+        if token not in self._stems:
+            self._stems[token] = _tostr(self._stemmer.stem(token.lower()))
+        return self._stems[token]
+
+    # BUILDING
+    def build(self, docs):
+        """ docs: iterable of (key, tokens of label) """
+        tt = ticktock("ngram index")
+        tt.tick("analyzing labels")
+        keys, labels, terms, lens = [], [], [], []
+        vocab = {}
+        for key, tokens in docs:
+            keys.append(_tostr(key))
+            labels.append(_tostr(" ".join(tokens)))
+            dterms = self.analyze(tokens)
+            terms.extend([vocab.setdefault(t, len(vocab)) for t in dterms])
+            lens.append(len(dterms))
+        tt.tock("analyzed %d labels" % len(labels)).tick("building postings")
+        doclens = np.asarray(lens, dtype="int32")
+        docoffsets = np.zeros((len(doclens) + 1,), dtype="int64")
+        np.cumsum(doclens, out=docoffsets[1:])
+        docterms = np.asarray(terms, dtype="int32")
+        maxlen = np.max(doclens) if len(doclens) > 0 else 0
+        # occurrences, sorted by term, then document and position
+        occdoc = np.repeat(np.arange(len(doclens), dtype="int64"), doclens)
+        occpos = np.arange(len(docterms), dtype="int64") - docoffsets[:-1][occdoc]
+        order = np.argsort(docterms, kind="mergesort")
+        occterm = docterms[order]
+        postkeys = occdoc[order] * (maxlen + 1) + occpos[order]
+        postoffsets = np.zeros((len(vocab) + 1,), dtype="int64")
+        np.cumsum(np.bincount(occterm, minlength=len(vocab)), out=postoffsets[1:])
+        first = np.ones((len(occterm),), dtype="bool")     # first occurrence of term in document
+        first[1:] = (occterm[1:] != occterm[:-1]) | (occdoc[order][1:] != occdoc[order][:-1])
+        df = np.bincount(occterm[first], minlength=len(vocab)).astype("int32")
+        hashes = _seqhash(docterms, docoffsets)
+        hashorder = np.argsort(hashes, kind="mergesort").astype("int32")
+        tt.tock("built postings").tick("saving")
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        arrays = dict(zip(self._files, [doclens, docoffsets, docterms, df, postoffsets, postkeys,
+                                        hashes[hashorder], hashorder]))
+        for name in self._files:
+            np.save(os.path.join(self.path, name + ".npy"), arrays[name])
+        rvocab = sorted(vocab.items(), key=lambda (x, y): y)
+        with open(os.path.join(self.path, "terms.txt"), "w") as f:
+            for term, _ in rvocab:
+                f.write(term + "\n")
+        with open(os.path.join(self.path, "docs.tsv"), "w") as f:
+            for key, label in zip(keys, labels):
+                f.write("%s\t%s\n" % (key, label))
+        tt.tock("saved")
+        self._loaded = False
+        return self
+
+    # LOADING
+    def _load(self):
+        if self._loaded:
+            return
+        for name in self._files:
+            setattr(self, "_" + name, np.load(os.path.join(self.path, name + ".npy"), mmap_mode="r"))
+        with open(os.path.join(self.path, "terms.txt")) as f:
+            self._vocab = dict([(line[:-1], i) for i, line in enumerate(f)])
+        with open(os.path.join(self.path, "docs.tsv")) as f:
+            self._keys, self._labels = [], []
+            for line in f:
+                key, label = line[:-1].split("\t", 1)
+                self._keys.append(key)
+                self._labels.append(label)
+        self._maxlen = int(np.max(self._doclens)) if len(self._doclens) > 0 else 0
+        self._idf = 1. + np.log(1. * len(self._doclens) / (self._df + 1.))
+        self._loaded = True
+
+    @property
+    def numdocs(self):
+        self._load()
+        return len(self._keys)
+
+    def key(self, doc):
+        self._load()
+        return self._keys[doc]
+
+    def label(self, doc):
+        self._load()
+        return self._labels[doc]
+
+    def termids(self, tokens):     # None if a term is not in the index
+        self._load()
+        ret = [self._vocab.get(t) for t in self.analyze(tokens)]
+        return None if None in ret else ret
+
+    # SEARCHING
+    def lookup(self, queries, exact=True, top=None):
+        """ Finds the labels equal to (exact) or containing (not exact) every query n-gram (list of tokens).
+            Returns for every query a tuple of arrays (docs, scores), best first, at most top. """
+        self._load()
+        cache = {}
+        ret = []
+        uqueries = []
+        for query in queries:
+            query = tuple(query)
+            if query not in cache:
+                cache[query] = None
+                uqueries.append(query)
+        termids = [self.termids(query) for query in uqueries]
+        if exact:
+            found = self._lookupexact(termids)
+        else:
+            found = self._lookupphrases(termids)
+        for query, (docs, freqs), t in zip(uqueries, found, termids):
+            if len(docs) == 0:
+                cache[query] = (docs, freqs)
+                continue
+            scores = np.sqrt(freqs) * (np.sum(self._idf[t]) if t is not None else 0.) / np.sqrt(self._doclens[docs])
+            order = np.argsort(-scores, kind="mergesort")[:top]
+            cache[query] = (docs[order], scores[order])
+        for query in queries:
+            ret.append(cache[tuple(query)])
+        return ret
+
+    def _lookupexact(self, termids):
+        """ docs whose term sequence equals termids, hashes of all queries are looked up at once """
+        empty = (np.zeros((0,), dtype="int64"), np.zeros((0,)))
+        valid = [i for i, t in enumerate(termids) if t is not None and len(t) > 0]
+        ret = [empty] * len(termids)
+        if len(valid) == 0:
+            return ret
+        qids = np.fromiter(itertools.chain(*[termids[i] for i in valid]), dtype="int32")
+        qoffsets = np.zeros((len(valid) + 1,), dtype="int64")
+        np.cumsum([len(termids[i]) for i in valid], out=qoffsets[1:])
+        qhashes = _seqhash(qids, qoffsets)
+        los = np.searchsorted(self._hashes, qhashes, side="left")
+        his = np.searchsorted(self._hashes, qhashes, side="right")
+        for i, lo, hi in zip(valid, los, his):
+            if hi > lo:
+                t = termids[i]
+                docs = np.sort(np.asarray(self._hashorder[lo:hi], dtype="int64"))
+                docs = [doc for doc in docs if self._doclens[doc] == len(t)
+                        and np.all(self._docterms[self._docoffsets[doc]:self._docoffsets[doc + 1]] == t)]
+                ret[i] = (np.asarray(docs, dtype="int64"), np.ones((len(docs),)))
+        return ret
+
+    def _postings(self, term):
+        return np.asarray(self._postkeys[self._postoffsets[term]:self._postoffsets[term + 1]])
+
+    def _lookupphrases(self, termids):
+        """ docs containing termids as consecutive terms and their phrase frequencies, for every termids.
+            Phrase start positions are extended from those of the phrase without its last term, which are shared. """
+        starts = {}
+
+        def getstarts(t):
+            if t not in starts:
+                if len(t) == 1:
+                    s = self._postings(t[0])
+                else:
+                    s = getstarts(t[:-1])
+                    keys = self._postings(t[-1])
+                    if len(s) > 0 and len(keys) > 0:
+                        k = s + (len(t) - 1)
+                        idx = np.minimum(np.searchsorted(keys, k), len(keys) - 1)
+                        s = s[(keys[idx] == k) & (k // width == s // width)]
+                    else:
+                        s = s[:0]
+                starts[t] = s
+            return starts[t]
+
+        width = self._maxlen + 1
+        empty = (np.zeros((0,), dtype="int64"), np.zeros((0,)))
+        ret = []
+        for t in termids:
+            s = getstarts(tuple(t)) if t is not None and len(t) > 0 else []
+            if len(s) == 0:
+                ret.append(empty)
+            else:
+                docs, freqs = np.unique(s // width, return_counts=True)
+                ret.append((docs.astype("int64"), freqs.astype("float64")))
+        return ret
+
+    def search(self, tokens, top=10):
+        """ Boolean OR of the query terms, classic Lucene scoring. Returns arrays (docs, scores), best first. """
+        self._load()
+        terms = [t for t in [self._vocab.get(term) for term in self.analyze(tokens)] if t is not None]
+        if len(terms) == 0:
+            return np.zeros((0,), dtype="int64"), np.zeros((0,))
+        width = self._maxlen + 1
+        idfs = self._idf[terms]
+        docs, scores, matched = [], [], []
+        for t, idf in zip(terms, idfs):
+            tdocs, tfs = np.unique(self._postings(t) // width, return_counts=True)
+            docs.append(tdocs)
+            scores.append(np.sqrt(tfs) * idf ** 2 / np.sqrt(self._doclens[tdocs]))
+            matched.append(np.ones((len(tdocs),)))
+        docs = np.concatenate(docs)
+        udocs, inv = np.unique(docs, return_inverse=True)
+        score = np.bincount(inv, weights=np.concatenate(scores))
+        coord = np.bincount(inv, weights=np.concatenate(matched)) / len(terms)
+        score = score * coord / np.sqrt(np.sum(idfs ** 2))
+        order = np.argsort(-score, kind="mergesort")[:top]
+        return udocs[order], score[order]
@@ -0,0 +1,142 @@
+import bisect
+import os
+import numpy as np
+
+from teafacto.procutil import wordchartable
+from teafacto.util import ticktock
+
+
+_P = np.uint64(1000003)
+
+
+def _deletehashes(chars, offsets):
+    """ Hashes of every string chars[offsets[i]:offsets[i+1]] (deletion neighbourhood of distance 0)
+        and of all its versions with one char deleted (distance 1).
+        Returns hashes and the index of the string they come from. """
+    lens = np.diff(offsets)
+    maxlen = np.max(lens) if len(lens) > 0 else 0
+    pw = np.ones((maxlen + 1,), dtype="uint64")     # powers of P
+    pw[1:] = np.cumprod(_P * np.ones((maxlen,), dtype="uint64"), dtype="uint64")
+    h = np.zeros((len(lens),), dtype="uint64")
+    before = np.zeros((len(chars),), dtype="uint64")     # hash of the chars before every char in its string
+    uchars = chars.astype("uint64")
+    for j in range(maxlen):
+        m = lens > j
+        idx = offsets[:-1][m] + j
+        before[idx] = h[m]
+        h[m] = h[m] * _P + uchars[idx]
+    owner = np.repeat(np.arange(len(lens)), lens)
+    after = (offsets[1:][owner] - np.arange(len(chars)) - 1).astype("int64")     # number of chars after every char
+    # hash(s[:i] + s[i+1:]) = hash(s) - (hash(s[:i]) * (P - 1) + s[i]) * P^(len(s) - i - 1)
+    deletes = h[owner] - (before * (_P - np.uint64(1)) + uchars) * pw[after]
+    return np.concatenate([h, deletes]), np.concatenate([np.arange(len(lens)), owner])
+
+
+class StringArray(object):
+    """ Strings stored as one utf-8 blob with an offset table, in <p>.blob.npy and <p>.offsets.npy """
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
+
+    @staticmethod
+    def fromstrings(strings):
+        strings = [x.encode("utf-8") if isinstance(x, unicode) else ("" if x is None else x) for x in strings]
+        offsets = np.zeros((len(strings) + 1,), dtype="int64")
+        np.cumsum([len(x) for x in strings], out=offsets[1:])
+        return StringArray(np.frombuffer("".join(strings), dtype="uint8"), offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.blob[self.offsets[i]:self.offsets[i + 1]].tostring().decode("utf-8")
+
+    def save(self, p):
+        np.save(p + ".blob.npy", self.blob)
+        np.save(p + ".offsets.npy", self.offsets)
+
+    @staticmethod
+    def load(p):
+        return StringArray(np.load(p + ".blob.npy", mmap_mode="r"), np.load(p + ".offsets.npy", mmap_mode="r"))
+
+
+class SubjectIndex(object):
+    """ Sorted unique labels with the entries of every label (struct of arrays, by descending triplecount),
+        and a table of the deletion neighbourhood (edit distance 1) of every label, sorted by hash.
+        Saved as .npy files in a directory and memory-mapped when loaded. """
+    columns = "fb_id triplecount type_id type_name".split()
+
+    def __init__(self, labels, entryoffsets, fb_id, triplecount, type_id, type_name, delhashes, dellabels):
+        self.labels = labels
+        self.entryoffsets = entryoffsets
+        self.fb_id = fb_id
+        self.triplecount = triplecount
+        self.type_id = type_id
+        self.type_name = type_name
+        self.delhashes = delhashes
+        self.dellabels = dellabels
+
+    @staticmethod
+    def build(names, fb_ids, triplecounts, type_ids, type_names):
+        tt = ticktock("SubjectIndex")
+        tt.tick("sorting")
+        labels = sorted(set(names))
+        labelids = dict(zip(labels, range(len(labels))))
+        entrylabels = np.asarray([labelids[name] for name in names], dtype="int64")
+        triplecounts = np.asarray(triplecounts, dtype="int64")
+        order = np.lexsort((np.arange(len(names)), -triplecounts, entrylabels))
+        entryoffsets = np.zeros((len(labels) + 1,), dtype="int64")
+        np.cumsum(np.bincount(entrylabels, minlength=len(labels)), out=entryoffsets[1:])
+        tt.tock("sorted").tick("building deletion neighbourhoods")
+        chars, charoffsets = wordchartable([label.replace(" '", "") for label in labels])
+        delhashes, dellabels = _deletehashes(chars, charoffsets)
+        dels = np.unique(np.rec.fromarrays([delhashes, dellabels]))
+        tt.tock("built %d deletions" % len(dels))
+        return SubjectIndex(StringArray.fromstrings(labels), entryoffsets,
+                            StringArray.fromstrings([fb_ids[i] for i in order]),
+                            triplecounts[order],
+                            StringArray.fromstrings([type_ids[i] for i in order]),
+                            StringArray.fromstrings([type_names[i] for i in order]),
+                            dels["f0"].copy(), dels["f1"].astype("int32"))
+
+    def save(self, p):
+        if not os.path.exists(p):
+            os.makedirs(p)
+        for name in ["labels", "fb_id", "type_id", "type_name"]:
+            getattr(self, name).save(os.path.join(p, name))
+        for name in ["entryoffsets", "triplecount", "delhashes", "dellabels"]:
+            np.save(os.path.join(p, name + ".npy"), getattr(self, name))
+
+    @staticmethod
+    def load(p):
+        kw = {}
+        for name in ["labels", "fb_id", "type_id", "type_name"]:
+            kw[name] = StringArray.load(os.path.join(p, name))
+        for name in ["entryoffsets", "triplecount", "delhashes", "dellabels"]:
+            kw[name] = np.load(os.path.join(p, name + ".npy"), mmap_mode="r")
+        return SubjectIndex(**kw)
+
+    def find(self, label):      # id of label or None
+        i = bisect.bisect_left(self.labels, label)
+        return i if i < len(self.labels) and self.labels[i] == label else None
+
+    def entries(self, labelid, top=None):
+        start = self.entryoffsets[labelid]
+        end = self.entryoffsets[labelid + 1] if top is None else min(start + top, self.entryoffsets[labelid + 1])
+        ret = []
+        for i in range(start, end):
+            ret.append({"fb_id": self.fb_id[i], "triplecount": int(self.triplecount[i]),
+                        "type_id": self.type_id[i] or None, "type_name": self.type_name[i] or None})
+        return ret
+
+    def neighbours(self, s):
+        """ ids of labels that can be within edit distance 1 of s (deletion neighbourhoods share a hash) """
+        chars, offsets = wordchartable([s])
+        hashes, _ = _deletehashes(chars, offsets)
+        los = np.searchsorted(self.delhashes, hashes, side="left")
+        his = np.searchsorted(self.delhashes, hashes, side="right")
+        ret = set()
+        for lo, hi in zip(los, his):
+            if hi > lo:
+                ret.update(self.dellabels[lo:hi].tolist())
+        return ret
@@ -1,7 +1,7 @@
-import numpy as np, pandas as pd, pickle
-from teafacto.core.utils import ticktock as TT
+import numpy as np, pandas as pd, pickle, theano
+from teafacto.util import ticktock as TT, Saveable
+from teafacto.core.base import Input
 from IPython import embed
-from teafacto.core.trainutil import Saveable
 
 
 class Evaluator(object):
@@ -29,21 +29,34 @@ class Evaluator(object):
 
 
 class KBCEvaluator(Evaluator):
+    def __init__(self, *metrics, **kw):
+        self.maxbatch = kw.pop("maxbatch", 1000000)     # max number of (triple, entity) scores per predict call
+        super(KBCEvaluator, self).__init__(*metrics, **kw)
 
     def evaluate(self, model, data, labels):
         tt = TT("Evaluator")
-        entidxs = set(data[:, 0]).union(set(labels))
-        for n in range(data.shape[0]):
-            ranking = self.makerank(data[n], model, entidxs)
+        entidxs = list(set(data[:, 0]).union(set(labels)))
+        entcol = dict(zip(entidxs, range(len(entidxs))))
+        gold = np.asarray([entcol[label] for label in labels])
+        numtriples = max(1, self.maxbatch // len(entidxs))
+        for n in range(0, data.shape[0], numtriples):
+            scores = self.makescores(data[n:n + numtriples], model, entidxs)
             tt.progress(n, data.shape[0])
             for metric in self.metrics:
-                metric([labels[n]], ranking)
+                metric.accumulatescores(scores, gold[n:n + numtriples])
         results = {}
         for metric in self.metrics:
             results[metric.name] = metric()
         tt.tock("computed")
         return results
 
+    def makescores(self, data, model, entidxs):     # scores of all entities for a batch of (s, r) ==> (batsize, numents)
+        svec = np.repeat(data[:, 0], len(entidxs))
+        rvec = np.repeat(data[:, 1:], len(entidxs), axis=0)
+        ovec = np.tile(np.asarray(entidxs), data.shape[0])
+        preds = model.predict(svec, rvec, ovec)
+        return np.asarray(preds).reshape((data.shape[0], len(entidxs)))
+
     def makerank(self, data, model, entidxs):
         entidxs = list(entidxs)
         svec = np.repeat(data[0], len(entidxs))
@@ -55,6 +68,62 @@ class KBCEvaluator(Evaluator):
         return ret
 
 
+class AllScoreKBCEvaluator(Evaluator):
+    """ Ranks all entities as object of (s, r) queries, for models with scoreall(sp) ==> (batsize, numents)
+        (e.g. Rescal, TransE), batsize queries per compiled call.
+        With known triples (s, r, o), ranks are filtered: other known objects of a query are not ranked. """
+    def __init__(self, *metrics, **kw):
+        self.batsize = kw.pop("batsize", 100)
+        known = kw.pop("known", None)
+        super(AllScoreKBCEvaluator, self).__init__(*metrics, **kw)
+        self.known = None
+        if known is not None:   # known objects of every (s, r) as sorted (s, r) keys and objects
+            known = np.asarray(known)
+            order = np.lexsort((known[:, 1], known[:, 0]))
+            self.known = (self._pairkeys(known[order]), known[order, 2])
+
+    @staticmethod
+    def _pairkeys(x):     # (s, r) of every row as structured array, sorts and searches lexicographically
+        ret = np.zeros((x.shape[0],), dtype=[("s", "int64"), ("r", "int64")])
+        ret["s"] = x[:, 0]
+        ret["r"] = x[:, 1]
+        return ret
+
+    def makemask(self, data, gold, numents):     # True for known objects other than gold
+        mask = np.zeros((data.shape[0], numents), dtype="bool")
+        if self.known is None:
+            return mask
+        keys, objs = self.known
+        qkeys = self._pairkeys(data)
+        starts = np.searchsorted(keys, qkeys, side="left")
+        ends = np.searchsorted(keys, qkeys, side="right")
+        lens = ends - starts
+        rows = np.repeat(np.arange(data.shape[0]), lens)
+        idxs = np.repeat(starts - np.cumsum(lens) + lens, lens) + np.arange(np.sum(lens))
+        mask[rows, objs[idxs]] = True
+        mask[np.arange(data.shape[0]), gold] = False
+        return mask
+
+    def evaluate(self, model, data, labels):
+        tt = TT("Evaluator")
+        sp = Input(ndim=2, dtype="int32")
+        scoref = theano.function([sp.d], model.scoreall(sp).d)
+        for n in range(0, data.shape[0], self.batsize):
+            batch = data[n:n + self.batsize].astype("int32")
+            gold = labels[n:n + self.batsize]
+            scores = scoref(batch)
+            mask = self.makemask(batch, gold, scores.shape[1])
+            for metric in self.metrics:
+                metric.accumulatescores(scores, gold, mask=mask)
+            tt.live("%d/%d\t%s" % (n + batch.shape[0], data.shape[0], "  ".join(map(str, self.metrics))))
+        results = {}
+        for metric in self.metrics:
+            results[metric.name] = metric()
+        tt.stoplive()
+        tt.tock("computed")
+        return results
+
+
 class ClasEvaluator(Evaluator):
     def evaluate(self, model, data, labels):
         tt = TT("Evaluator")
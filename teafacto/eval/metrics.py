@@ -1,6 +1,50 @@
 from teafacto.util import issequence
 import numpy as np
 
+
+# SCORE MATRIX HELPERS
+# scores: (batsize, numcans), gold: column indexes (batsize,) or (batsize, numgold) padded with -1
+# mask: (batsize, numcans), True for candidates that are filtered out of the ranking
+def goldranks(scores, gold, mask=None):
+    """ 0-based positions of gold candidates in the rankings by descending score,
+        equal scores are ordered by column (like a stable sort of the candidates).
+        Returns (batsize, numgold) ranks, -1 for padding """
+    gold = np.asarray(gold)
+    squeeze = gold.ndim == 1
+    gold = gold[:, None] if squeeze else gold
+    rows = np.arange(scores.shape[0])[:, None]
+    goldscores = scores[rows, np.maximum(gold, 0)]                      # (batsize, numgold)
+    cols = np.arange(scores.shape[1])[None, None, :]
+    before = (scores[:, None, :] > goldscores[:, :, None]) \
+             | ((scores[:, None, :] == goldscores[:, :, None]) & (cols < gold[:, :, None]))
+    if mask is not None:
+        before &= ~mask[:, None, :]
+    ret = np.sum(before, axis=2)
+    ret[gold < 0] = -1
+    return ret[:, 0] if squeeze else ret
+
+
+def topk(scores, k, mask=None):
+    """ column indexes of the k best candidates per row, best first (ties by column) """
+    if mask is not None:
+        scores = np.where(mask, -np.inf, scores)
+    k = min(k, scores.shape[1])
+    kth = -np.partition(-scores, k - 1, axis=1)[:, k - 1:k]     # k-th best score per row
+    greater = scores > kth
+    ties = scores == kth
+    numtiesin = k - np.sum(greater, axis=1, keepdims=True)     # ties that make it, lowest columns first
+    sel = greater | (ties & (np.cumsum(ties, axis=1) <= numtiesin))
+    part = np.nonzero(sel)[1].reshape((scores.shape[0], k))
+    partscores = scores[np.arange(scores.shape[0])[:, None], part]
+    order = np.lexsort((part, -partscores), axis=1)      # by score, then column
+    return part[np.arange(scores.shape[0])[:, None], order]
+
+
+def _goldmatrix(gold):
+    gold = np.asarray(gold)
+    return gold[:, None] if gold.ndim == 1 else gold
+
+
 class Metric(object):
     def __init__(self, **kw):
         self.reset()
@@ -16,6 +60,9 @@ class Metric(object):
     def accumulate(self, label, ranking):
         raise NotImplementedError("use subclass")
 
+    def accumulatescores(self, scores, gold, mask=None):     # batched version of accumulate, see goldranks()
+        raise NotImplementedError("use subclass")
+
     def compute(self):
         raise NotImplementedError("use subclass")
 
@@ -46,6 +93,11 @@ class ClassAccuracy(Metric):
             self.acc += 1
         self.div += 1
 
+    def accumulatescores(self, scores, gold, mask=None):
+        ranks = goldranks(scores, np.asarray(gold).reshape((-1,)), mask=mask)
+        self.acc += np.sum(ranks == 0)
+        self.div += scores.shape[0]
+
     def compute(self):
         return self.acc * 1.0 / (self.div + 1e-9)
 
@@ -69,6 +121,13 @@ class RecallAt(Metric):
         self.acc += recall
         self.div += 1
 
+    def accumulatescores(self, scores, gold, mask=None):
+        gold = _goldmatrix(gold)
+        ranks = goldranks(scores, gold, mask=mask)
+        numgold = np.sum(gold >= 0, axis=1)
+        self.acc += np.sum(np.sum((ranks >= 0) & (ranks < self.topn), axis=1) * 1. / numgold)
+        self.div += scores.shape[0]
+
     def compute(self):
         return self.acc / self.div
 
@@ -94,8 +153,41 @@ class MeanQuantile(Metric):
             self.acc += 1. * (total - pos) / total
             self.div += 1
 
+    def accumulatescores(self, scores, gold, mask=None):    # same numbers as accumulate()
+        gold = _goldmatrix(gold)
+        ranks = goldranks(scores, gold, mask=mask)
+        total = scores.shape[1] - (np.sum(mask, axis=1, keepdims=True) if mask is not None else 0)
+        valid = gold >= 0
+        self.acc += np.sum((1. * (total - (ranks - 1)) / total)[valid])
+        self.div += np.sum(valid)
+
     def compute(self):
         return self.acc / self.div
 
     def __str__(self):
         return "MQ:%.3f" % self.compute()
+
+
+class MeanReciprocalRank(Metric):
+
+    @property
+    def name(self):
+        return "Mean Reciprocal Rank"
+
+    def accumulate(self, label, ranking):
+        ids = [x for (x, y) in ranking]
+        for correctone in label:
+            self.acc += 1. / (ids.index(correctone) + 1) if correctone in ids else 0.
+            self.div += 1
+
+    def accumulatescores(self, scores, gold, mask=None):
+        ranks = goldranks(scores, _goldmatrix(gold), mask=mask)
+        valid = ranks >= 0
+        self.acc += np.sum(1. / (ranks[valid] + 1))
+        self.div += np.sum(valid)
+
+    def compute(self):
+        return self.acc / self.div
+
+    def __str__(self):
+        return "MRR: %.3f" % self.compute()
@@ -1,9 +1,10 @@
+import itertools
 import numpy as np
 from collections import OrderedDict
 
 from teafacto.feed.langfeeds import WordSeqFeed
 from teafacto.feed.langtransform import WordToWordCharTransform, WordToWordId
-from teafacto.util import ticktock
+from teafacto.util import ticktock, loadwordvocab, parsetsv
 
 
 def iden(x):
@@ -19,27 +20,25 @@ class FBSeqFeedsMaker(object):  #simple feed maker transforms words to idxs
         self.worddic = worddic
         self.load(entdic)
 
-    def load(self, entdic):
-        self.trainingdata = []
-        self.golddata = []
+    def load(self, entdic, workers=None):
         tt = ticktock(self.__class__.__name__)
         tt.tick("loading kgraph")
-        with open(self.path) as f:
-            c = 0
-            for line in f:
-                ns = line[:-1].split("\t")
-                if len(ns) is not 2:
-                    print line, c
-                    continue
-                sf, fb = ns
-                self.trainingdata.append(self._process_sf(sf, self.numwords))
-                entids = self._process_ent(fb, entdic)
-                self.golddata.append(entids)
-                if c % 1e6 == 0:
-                    tt.tock("%.0fM" % (c/1e6)).tick()
-                c += 1
-        self.golddata = np.asarray(self.golddata, dtype="int32")
-        self.trainingdata = np.array(self.trainingdata)
+        self.trainingdata, self.golddata = parsetsv(self.path, self._parselines, workers=workers, entdic=entdic)
+        tt.tock("loaded %d examples" % len(self.golddata))
+
+    def _parselines(self, lines, entdic=None):
+        trainingdata = []
+        golddata = []
+        for line in lines:
+            ns = line.split("\t")
+            if len(ns) is not 2:
+                print line
+                continue
+            sf, fb = ns
+            trainingdata.append(self._process_sf(sf, self.numwords))
+            golddata.append(self._process_ent(fb, entdic))
+        return np.array(trainingdata, dtype="object").reshape((len(trainingdata), self.numwords)), \
+               np.asarray(golddata, dtype="int32")
 
     @property
     def trainfeed(self):
@@ -76,27 +75,25 @@ class FreebaseEntFeedsMaker(object):
         self.unkentid = unkentid
         self.load(entdic)
 
-    def load(self, entdic):
-        self.trainingdata = []
-        self.golddata = []
+    def load(self, entdic, workers=None):
         tt = ticktock(self.__class__.__name__)
         tt.tick("loading kgraph")
-        with open(self.path) as f:
-            c = 0
-            for line in f:
-                ns = line[:-1].split("\t")
-                if len(ns) is not 2:
-                    print line, c
-                    continue
-                sf, fb = ns
-                self.trainingdata.append(self._process_sf(sf, self.numwords, self.numchars))
-                entids = self._process_ent(fb, entdic)
-                self.golddata.append(entids)
-                if c % 1e6 == 0:
-                    tt.tock("%.0fM" % (c/1e6)).tick()
-                c += 1
-        self.golddata = np.asarray(self.golddata, dtype="int32")
-        self.trainingdata = np.array(self.trainingdata)
+        self.trainingdata, self.golddata = parsetsv(self.path, self._parselines, workers=workers, entdic=entdic)
+        tt.tock("loaded %d examples" % len(self.golddata))
+
+    def _parselines(self, lines, entdic=None):
+        trainingdata = []
+        golddata = []
+        for line in lines:
+            ns = line.split("\t")
+            if len(ns) is not 2:
+                print line
+                continue
+            sf, fb = ns
+            trainingdata.append(self._process_sf(sf, self.numwords, self.numchars))
+            golddata.append(self._process_ent(fb, entdic))
+        return np.array(trainingdata, dtype="object").reshape((len(trainingdata), self.numwords)), \
+               np.asarray(golddata, dtype="int32")
 
     @property
     def trainfeed(self):
@@ -145,33 +142,27 @@ class FreebaseSeqFeedMakerEntidxs(FreebaseSeqFeedMaker):
         return ret
 
 
-def getglovedict(path, offset=2, top=None):
-    gd = {}
-    maxid = 0
-    with open(path) as f:
-        c = offset
-        for line in f:
-            if not top is None and c - offset > top:
-                break
-            ns = line.split(" ")
-            w = ns[0]
-            gd[w] = c
-            maxid = max(maxid, c)
-            c += 1
+def getglovedict(path, offset=2, top=None):     # through binary cache of glove file
+    words = loadwordvocab(path, top=None if top is None else top + 1)
+    gd = dict(zip(words, range(offset, offset + len(words))))
+    maxid = offset + len(words) - 1 if len(words) > 0 else 0
     return gd, maxid
 
 
-def getentdict(path, offset=2, top=None):
-    ed = {}
-    maxid = 0
-    with open(path) as f:
-        c = 0
-        for line in f:
-            if not top is None and top < c:
-                break
-            e, i = line[:-1].split("\t")
-            ed[e] = int(i) + offset
-            maxid = max(ed[e], maxid)
-            c += 1
+def getentdict(path, offset=2, top=None, workers=None):
+    if top is None:
+        ents, ids = parsetsv(path, _parseentdiclines, workers=workers)
+    else:
+        with open(path) as f:
+            ents, ids = _parseentdiclines([line[:-1] for line in itertools.islice(f, top + 1)])
+    ids = ids + offset
+    ed = dict(zip(ents, ids.tolist()))
+    maxid = max(0, int(np.max(ids))) if len(ids) > 0 else 0
     return ed, maxid
 
+
+def _parseentdiclines(lines):
+    pairs = [line.split("\t") for line in lines]
+    ents = np.asarray([e for e, _ in pairs], dtype="object")
+    ids = np.asarray([int(i) for _, i in pairs], dtype="int64")
+    return ents, ids
@@ -5,9 +5,15 @@ from teafacto.core.datafeed import FeedTransform
 
 
 class WordSeqFeed(DataFeed):
-    def __init__(self, data, transformer=FeedTransform(), **kw):
+    ''' Tensorizes word sequences on access.
+        With a vocabulary transformer, words are interned once and batches are numpy gathers.
+        With cache=True, the whole dataset is tensorized on first access and kept in memory. '''
+    def __init__(self, data, transformer=FeedTransform(), cache=False, **kw):
         super(WordSeqFeed, self).__init__(data, **kw)
         self.transformer = transformer
+        self.cache = cache
+        self._ids = None
+        self._cached = None
 
     @property
     def dtype(self):
@@ -21,13 +27,33 @@ class WordSeqFeed(DataFeed):
     def shape(self):
         return self.transformer.getshapefor(self.data.shape)
 
+    @property
+    def interned(self):
+        return hasattr(self.transformer, "intern")
+
+    @property
+    def ids(self):      # local word ids of whole dataset, computed once
+        if self._ids is None:
+            self._ids = self.transformer.intern(self.data)
+        return self._ids
+
     def __getitem__(self, item):
+        if self.cache:
+            if self._cached is None:
+                self._cached = self.transformer.fromids(self.ids) if self.interned else self.transform(self.data)
+            return self._cached[item]
+        if self.interned:
+            return self.transformer.fromids(self.ids[item])
         ret = self.data.__getitem__(item)
         return self.transform(ret)
 
-    def get(self, idxs): # should return datafeed of the same type TODO write test
-        return self.__class__(self.data[idxs], self.transformer)
+    def get(self, idxs): # should return datafeed of the same type
+        ret = self.__class__(self.data[idxs], self.transformer, cache=self.cache)
+        if self._ids is not None:
+            ret._ids = self._ids[idxs]
+        if self._cached is not None:
+            ret._cached = self._cached[idxs]
+        return ret
 
     def transform(self, x):
         return self.transformer.transform(x)
-
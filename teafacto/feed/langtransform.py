@@ -1,63 +1,96 @@
 import numpy as np
 from collections import OrderedDict
+from threading import Lock
 
 from teafacto.core.datafeed import FeedTransform
 
 
-class WordToWordId(FeedTransform):
+class VocabTransform(FeedTransform):
+    ''' Interns every distinct word once into a local id and a precomputed table row.
+        Batches are then tensorized with a numpy gather over the table (see intern() and fromids()). '''
+    def __init__(self, numwords=10, **kw):
+        super(VocabTransform, self).__init__(**kw)
+        self.numwords = numwords
+        self._vocab = {None: 0}     # raw word -> local id, local id 0 is padding/missing word
+        self._rows = [self.padrow()]
+        self._table = None
+        self._lock = Lock()
+
+    def padrow(self):       # table row of missing words
+        raise NotImplementedError("use subclass")
+
+    def wordrow(self, word):    # table row of word
+        raise NotImplementedError("use subclass")
+
+    def transform(self, x):     # x is batch of lists of words
+        return self.fromids(self.intern(x))
+
+    def intern(self, x):
+        ''' maps object array of words to int array of local ids, everything from the first None in a row on is 0 '''
+        x = np.asarray(x, dtype="object")
+        vocab = self._vocab
+        ids = np.asarray([vocab.get(w, -1) for w in x.flat], dtype="int32").reshape(x.shape)
+        if np.any(ids < 0):
+            with self._lock:
+                for w in set(x.flat[np.flatnonzero(ids < 0)]):
+                    self._addword(w)
+            ids = np.asarray([vocab[w] for w in x.flat], dtype="int32").reshape(x.shape)
+        ids[np.cumsum(ids == 0, axis=-1) > 0] = 0
+        return ids
+
+    def _addword(self, word):
+        if word not in self._vocab:
+            self._rows.append(self.wordrow(word))
+            self._vocab[word] = len(self._rows) - 1
+
+    @property
+    def table(self):
+        table = self._table
+        if table is None or table.shape[0] != len(self._rows):
+            with self._lock:
+                table = np.asarray(self._rows, dtype="int32")
+                self._table = table
+        return table
+
+    def fromids(self, ids):     # gathers table rows, truncates/pads words to numwords
+        ids = np.asarray(ids)
+        ret = np.zeros(ids.shape[:-1] + (self.numwords,), dtype="int32")
+        w = min(self.numwords, ids.shape[-1])
+        ret[..., :w] = ids[..., :w]
+        return self.table[ret]
+
+
+class WordToWordId(VocabTransform):
     def __init__(self, worddic, numwords=10, **kw):
-        super(WordToWordId, self).__init__(**kw)
         self.worddic = worddic
-        self.numwords = numwords
+        super(WordToWordId, self).__init__(numwords=numwords, **kw)
 
     def getshapefor(self, datashape):
         return (datashape[0], self.numwords)
 
-    def transform(self, x):     # x is batch of lists of words
-        ret = np.zeros((x.shape[0], self.numwords), dtype="int32")
-        i = 0
-        while i < x.shape[0]:
-            j = 0
-            while j < x.shape[1]:
-                word = x[i, j]
-                if word is None:
-                    j = x.shape[1]  #skip
-                else:
-                    ret[i, j] = self.worddic[word.lower()]
-                j += 1
-            i += 1
-        return ret
-
-
-class WordToWordCharTransform(FeedTransform):
+    def padrow(self):
+        return 0
+
+    def wordrow(self, word):
+        return self.worddic[word.lower()]
+
+
+class WordToWordCharTransform(VocabTransform):
     def __init__(self, worddic, unkwordid=1, numwords=10, numchars=30, **kw):
-        super(WordToWordCharTransform, self).__init__(**kw)
         self.worddic = worddic
         self.unkwordid = unkwordid
-        self.numwords = numwords
         self.numchars = numchars
+        super(WordToWordCharTransform, self).__init__(numwords=numwords, **kw)
 
     def getshapefor(self, datashape):
         return (datashape[0], self.numwords, self.numchars + 1)
 
-    def transform(self, x):
-        ret = np.zeros((x.shape[0], self.numwords, self.numchars + 1), dtype="int32")
-        i = 0
-        while i < x.shape[0]:
-            j = 0
-            while j < x.shape[1]:
-                word = x[i, j]
-                retword, skip = transinner((word, self.numchars, self.worddic, self.unkwordid))
-                if max(retword[1:]) > 128:
-                    print x
-                if skip:
-                    j = x.shape[1]
-                else:
-                    ret[i, j, :] = retword
-                j += 1
-
-            i += 1
-        return ret
+    def padrow(self):
+        return [0] * (self.numchars + 1)
+
+    def wordrow(self, word):
+        retword, _ = transinner((word, self.numchars, self.worddic, self.unkwordid))
+        return retword[:self.numchars + 1]
 
 
 def transinner(args):
@@ -78,4 +111,4 @@ def transinner(args):
             retword = [unkwordid]                       # unknown word
         retword.extend(map(ord, word))
         retword.extend([0]*(numchars-len(retword)))
-    return retword, skip #np.asarray(retword, dtype="int32")
\ No newline at end of file
+    return retword, skip #np.asarray(retword, dtype="int32")
@@ -1,21 +1,55 @@
+import itertools
+import sys
+
 import numpy as np
 from teafacto.util import ticktock
 
 
+def wordchartable(words):
+    ''' Concatenated char ords of all words and their cumulative-length offsets:
+        chars of words[i] are chars[offsets[i]:offsets[i+1]] '''
+    lens = np.asarray([len(w) for w in words], dtype="int64")
+    offsets = np.zeros((len(words) + 1,), dtype="int64")
+    np.cumsum(lens, out=offsets[1:])
+    if all(isinstance(w, str) for w in words):
+        chars = np.frombuffer("".join(words), dtype="uint8")
+    elif all(isinstance(w, unicode) for w in words):
+        enc, dtype = ("utf-32-le", "<u4") if sys.maxunicode > 0xffff else ("utf-16-le", "<u2")
+        chars = np.frombuffer(u"".join(words).encode(enc), dtype=dtype)
+    else:
+        chars = np.fromiter(itertools.imap(ord, itertools.chain(*words)), dtype="int64", count=offsets[-1])
+    return chars.astype("int32"), offsets
+
+
+def padchartable(chars, offsets, maxlen, maskid=-1):
+    ''' Matrix with a row of (at most maxlen) chars per word, padded with maskid '''
+    lens = np.minimum(np.diff(offsets), maxlen)
+    ret = maskid * np.ones((len(lens), maxlen), dtype="int32")
+    cols = np.arange(maxlen)
+    m = cols[np.newaxis, :] < lens[:, np.newaxis]
+    ret[m] = chars[(offsets[:-1, np.newaxis] + cols[np.newaxis, :])[m]]
+    return ret, lens
+
+
+def _idtable(rwd):
+    ''' Sorted ids of rwd and padded char table rows for them '''
+    ids = np.asarray(sorted(rwd.keys()), dtype="int64")
+    chars, offsets = wordchartable([rwd[i] for i in ids])
+    return ids, chars, offsets
+
+
 def wordmatfromdic(worddic, maxwordlen=30):
     maskid = -1
-    rwd = sorted(worddic.items(), key=lambda (x, y): y)
-    realmaxlen = 0
-    wordmat = np.ones((rwd[-1][1]+1, maxwordlen), dtype="int32") * maskid
-    for i in range(len(rwd)):
-        rwdichars, rwdiidx = rwd[i]
-        realmaxlen = max(realmaxlen, len(rwdichars))
-        wordmat[rwdiidx, :min(len(rwdichars), maxwordlen)] \
-            = [ord(c) for c in rwdichars[:min(len(rwdichars), maxwordlen)]]
+    rwd = {v: k for k, v in worddic.items()}
+    ids, chars, offsets = _idtable(rwd)
+    rows, _ = padchartable(chars, offsets, maxwordlen, maskid=maskid)
+    wordmat = np.ones((ids[-1]+1, maxwordlen), dtype="int32") * maskid
+    wordmat[ids] = rows
     allchars = set(list(np.unique(wordmat))).difference({maskid})
     chardic = {maskid: maskid}
     chardic.update(dict(zip(allchars, range(len(allchars)))))
-    wordmat = np.vectorize(lambda x: chardic[x])(wordmat)
+    keys = np.asarray(sorted(chardic.keys()), dtype="int32")
+    wordmat = np.asarray([chardic[k] for k in keys], dtype="int32")[np.searchsorted(keys, wordmat)]
     del chardic[maskid]
     chardic = {chr(k): v for k, v in chardic.items()}
     return wordmat, chardic
@@ -33,21 +67,17 @@ def wordmat2chartensor(wordmat, worddic=None, rwd=None, maxchars=30, maskid=-1):
     assert(not(worddic is not None and rwd is not None))
     if rwd is None:
         rwd = {v: k for k, v in worddic.items()}
-    wordcharmat = maskid * np.ones((max(rwd.keys())+1, maxchars), dtype="int32")
-    realmaxlen = 0
-    for i in rwd.keys():
-        word = rwd[i]
-        word = word[:min(maxchars, len(word))]
-        realmaxlen = max(realmaxlen, len(word))
-        wordcharmat[i, :len(word)] = [ord(ch) for ch in word]
+    ids, chars, offsets = _idtable(rwd)
+    rows, lens = padchartable(chars, offsets, maxchars, maskid=maskid)
+    realmaxlen = max(lens) if len(lens) > 0 else 0
+    wordcharmat = maskid * np.ones((ids[-1]+1, min(realmaxlen, maxchars)), dtype="int32")
+    wordcharmat[ids] = rows[:, :wordcharmat.shape[1]]
     chartensor = wordcharmat[wordmat, :]
     chartensor[wordmat == -1] = -1
-    if realmaxlen < maxchars:
-        chartensor = chartensor[:, :, :realmaxlen]
     return chartensor
 
 
-def wordmat2charmat(wordmat, worddic=None, rwd=None, maxlen=100, raretoken="<RARE>", maskid=-1):
+def wordmat2charmat(wordmat, worddic=None, rwd=None, maxlen=100, raretoken="<RARE>", maskid=-1, chunksize=100000):
     assert(worddic is not None or rwd is not None)
     assert(not(worddic is not None and rwd is not None))
     tt = ticktock("wordmat2charmat")
@@ -60,15 +90,38 @@ def wordmat2charmat(wordmat, worddic=None, rwd=None, maxlen=100, raretoken="<RAR
     else:
         rwd = dict([(k, (v if v != raretoken else " "))
                    for k, v in rwd.items()])
+    # word table with unknown word "<???>" as last entry
+    ids = np.asarray(sorted(rwd.keys()), dtype="int64")
+    chars, offsets = wordchartable([rwd[i] for i in ids] + ["<???>"])
+    wordlens = np.diff(offsets)
     realmaxlen = 0
-    for i in range(wordmat.shape[0]):
-        s = wordids2string(wordmat[i], rwd, maskid=maskid)
-        s = s[:min(len(s), maxlen)]
-        realmaxlen = max(len(s), realmaxlen)
-        if len(s) > maxlen:
-            toolong += 1
-        charmat[i, :len(s)] = [ord(ch) for ch in s]
-        tt.progress(i, wordmat.shape[0], live=True)
+    for start in range(0, wordmat.shape[0], chunksize):
+        chunk = np.asarray(wordmat[start:start+chunksize])
+        rows, cols = np.nonzero(chunk != maskid)
+        words = chunk[rows, cols]
+        t = len(ids) * np.ones(words.shape, dtype="int64")     # unknown ids
+        if len(ids) > 0:
+            found = np.minimum(np.searchsorted(ids, words), len(ids) - 1)
+            t[ids[found] == words] = found[ids[found] == words]
+        # every word is written followed by a space, the last space of every row is cut off
+        toklens = wordlens[t] + 1
+        rowlens = np.bincount(rows, weights=toklens, minlength=chunk.shape[0]).astype("int64")
+        strlens = np.maximum(rowlens - 1, 0)
+        toolong += np.sum(strlens > maxlen)
+        strlens = np.minimum(strlens, maxlen)
+        realmaxlen = max(realmaxlen, np.max(strlens) if len(strlens) > 0 else 0)
+        tokstarts = np.cumsum(toklens) - toklens
+        rowstarts = np.cumsum(rowlens) - rowlens
+        tok = np.repeat(np.arange(len(t)), toklens)
+        inword = np.arange(len(tok)) - tokstarts[tok]
+        pos = tokstarts[tok] + inword - rowstarts[rows[tok]]
+        keep = pos < strlens[rows[tok]]
+        tok, inword, pos = tok[keep], inword[keep], pos[keep]
+        isspace = inword == wordlens[t[tok]]
+        vals = 32 * np.ones((len(tok),), dtype="int32")     # ord(" ")
+        vals[~isspace] = chars[offsets[t[tok[~isspace]]] + inword[~isspace]]
+        charmat[start + rows[tok], pos] = vals
+        tt.progress(min(start + chunksize, wordmat.shape[0]), wordmat.shape[0], live=True)
     if realmaxlen < maxlen:
         charmat = charmat[:, :realmaxlen]
     if toolong > 0:
@@ -95,15 +148,20 @@ def charids2string(inp, rcd=None, maskid=-1):
 
 
 def wordcharmat2string(inp, rcd=None, maskid=-1):
+    inp = np.asarray(inp)
     if rcd is not None:
-        tochar = np.vectorize(lambda x: rcd[x] if x != maskid else "" if x in rcd else "<???>")
+        tochar = lambda x: rcd[x] if x != maskid else "" if x in rcd else "<???>"
+        u, inv = np.unique(inp, return_inverse=True)     # look up every distinct char id once
+        # trailing NULs are dropped, as in a fixed-width string array
+        x = np.asarray([tochar(ue).rstrip("\x00") for ue in u], dtype="object")[inv].reshape(inp.shape)
+        acc = ["".join(list(x[i])) for i in range(x.shape[0])]
     else:
-        tochar = np.vectorize(lambda x: chr(x) if x != maskid else "")
-    x = tochar(inp)
-    acc = []
-    for i in range(x.shape[0]):
-        w = "".join(list(x[i]))
-        acc.append(w)
+        if np.any((inp != maskid) & ((inp < 0) | (inp > 255))):
+            raise ValueError("chr() arg not in range(256)")
+        keep = (inp != maskid) & (inp != 0)     # chr(0) is dropped, as in a fixed-width string array
+        s = inp[keep].astype("uint8").tostring()
+        ends = np.cumsum(np.sum(keep, axis=1))
+        acc = [s[a:b] for a, b in zip(np.concatenate([[0], ends[:-1]]), ends)]
     ret = " ".join([w for w in acc if len(w) > 0])
     return ret
 
@@ -24,21 +24,7 @@ class Searcher(object):
 class SeqEncDecAttSearch(Searcher):
     """ Default: greedy search strategy """
     def decode(self, inpseq):       # inpseq: idx^(batsize, seqlen)
-        i = 0
-        stop = False
-        # prevpreds = [np.zeros((inpseq.shape[0], 1))]*self.beamsize
-        acc = np.zeros((inpseq.shape[0], 1)).astype("int32")
-        accprobs = np.ones((inpseq.shape[0]))
-        while not stop:
-            curprobs = self.model.predict(inpseq, acc)   # curpred: f32^(batsize, prevpred.seqlen, numlabels)
-            curpreds = np.argmax(curprobs, axis=2).astype("int32")
-            accprobs = np.max(curprobs, axis=2)[:, -1] * accprobs
-            acc = np.concatenate([acc, curpreds[:, -1:]], axis=1)
-            i += 1
-            stop = i == inpseq.shape[1]
-        ret = acc[:, 1:]
-        finalprobs = np.max(curprobs, axis=2).prod(axis=1)
-        print np.linalg.norm(finalprobs - accprobs)
+        ret, accprobs = self.model.greedy_decode(inpseq, inpseq.shape[1], startsymbol=0)  # one decoder step per output
         assert(ret.shape == inpseq.shape)
         return ret
 
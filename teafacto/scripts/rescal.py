@@ -2,6 +2,8 @@ from teafacto.core.base import Block, param, tensorops as T
 from teafacto.blocks.basic import VectorEmbed
 from teafacto.blocks.match import MatchScore, EuclideanDistance, DotDistance
 from teafacto.util import argprun, ticktock
+from teafacto.eval.eval import AllScoreKBCEvaluator
+from teafacto.eval.metrics import MeanReciprocalRank, RecallAt
 import numpy as np
 import pickle
 from IPython import embed
@@ -9,6 +11,7 @@ from IPython import embed
 
 class Rescal(Block):
     def __init__(self, embdim, numents, numrels, **kw):
+        self.numents = numents
         self.A = VectorEmbed(indim=numents, dim=embdim)
         self.R = param((numrels, embdim, embdim), name="rel_embed").glorotuniform()
         self.scorer = DotDistance()
@@ -20,9 +23,16 @@ class Rescal(Block):
         ret = T.batched_dot(entembs, relembs)
         return self.scorer(ret, self.A(o))
 
+    def scoreall(self, sp):     # scores of all entities as object ==> (batsize, numents)
+        entembs = self.A(sp[:, 0])
+        relembs = self.R[sp[:, 1], :, :]
+        ret = T.batched_dot(entembs, relembs)
+        return T.dot(ret, self.A(T.arange(self.numents)).T)
+
 
 class TransE(Block):
     def __init__(self, embdim, numents, numrels, **kw):
+        self.numents = numents
         self.A = VectorEmbed(indim=numents, dim=embdim, normalize=True)
         self.R = VectorEmbed(indim=numrels, dim=embdim, normalize=True)
         self.scorer = EuclideanDistance()
@@ -34,6 +44,13 @@ class TransE(Block):
         ret = entembs + relembs
         return self.scorer(ret, self.A(o)) ** 2
 
+    def scoreall(self, sp):     # squared distances to all entities ==> (batsize, numents)
+        ret = self.A(sp[:, 0]) + self.R(sp[:, 1])
+        allents = self.A(T.arange(self.numents))
+        sqdists = T.sum(ret ** 2, axis=1).dimshuffle(0, "x") - 2 * T.dot(ret, allents.T) \
+                  + T.sum(allents ** 2, axis=1).dimshuffle("x", 0)
+        return T.maximum(sqdists, 1e-6)
+
 
 def run(
         embdim=50,
@@ -82,6 +99,17 @@ def run(
         .adagrad(lr=lr).l2(wreg)\
         .train(numbats=numbats, epochs=epochs)
 
+    # filtered evaluation on test triples (s, o, r)
+    if "test_subs" in data:
+        tt = ticktock("evaluation")
+        alltriples = np.concatenate([np.asarray(data[k]) for k in ["train_subs", "valid_subs", "test_subs"]
+                                     if k in data], axis=0)
+        test = np.asarray(data["test_subs"])
+        evaluator = AllScoreKBCEvaluator(MeanReciprocalRank(), RecallAt(1), RecallAt(3), RecallAt(10),
+                                         known=alltriples[:, [0, 2, 1]])
+        results = evaluator.run(scorer, test[:, [0, 2]], test[:, 1])
+        tt.msg(" ".join(["%s: %.4f" % (k, v) for k, v in sorted(results.items())]))
+
     #scorer.save("rescal.scorer.block")
 
 
@@ -1,5 +1,5 @@
 from teafacto.util import ticktock, argprun, inp, tokenize
-import os, pickle, random
+import os, pickle, random, hashlib
 from teafacto.procutil import *
 from IPython import embed
 from scipy import sparse
@@ -14,6 +14,7 @@ from teafacto.blocks.memory import MemVec
 from teafacto.blocks.match import SeqMatchScore, CosineDistance, MatchScore
 
 from teafacto.core.base import Block, tensorops as T, Val
+from teafacto.core.datafeed import rng
 
 
 def readdata(p="../../../../data/simplequestions/clean/datamat.word.fb2m.pkl",
@@ -322,11 +323,92 @@ class TypedSubjBlock(Block):
         return ret
 
 
+class EncodingCache(object):
+    """ Persistent cache of encodings of entity/relation ids by an encoder.
+        Encodings live in a memory-mapped (size, encdim) matrix with a validity bitmap,
+        one pair of files per fingerprint of the encoder's parameter values and of trans,
+        so only ids never encoded with the current weights are encoded.
+        The fingerprint is computed on first use, call refresh() after the encoder's weights changed.
+        Only the class and array/Val/scalar attributes of trans are fingerprinted:
+        use a different path for transforms that differ otherwise. """
+    def __init__(self, encoder, size, path, trans=None, batsize=1000):
+        self.encoder = encoder
+        self.size = size
+        self.path = path
+        self.trans = trans
+        self.batsize = batsize
+        self.fingerprint = None
+        self.codes = None
+        self.valid = None
+        self._pred = None
+
+    def getfingerprint(self):
+        h = hashlib.md5()
+        for name, param in self.encoder.namedparams().items():
+            v = np.ascontiguousarray(param.v)
+            h.update(name)
+            h.update(str(v.shape))
+            h.update(v.data)
+        self._hashtrans(h)
+        return h.hexdigest()
+
+    def _hashtrans(self, h):
+        trans = self.trans
+        h.update("trans:%s.%s" % (type(trans).__module__, type(trans).__name__))
+        for name, value in sorted(getattr(trans, "__dict__", {}).items()):
+            value = value.v if isinstance(value, Val) else value
+            if isinstance(value, np.ndarray):
+                value = np.ascontiguousarray(value)
+                h.update("%s:%s:%s" % (name, value.dtype, value.shape))
+                h.update(value.data)
+            elif isinstance(value, (basestring, int, long, float, bool)):
+                h.update("%s:%r" % (name, value))
+
+    def refresh(self):      # recompute fingerprint (after weights changed) and open its encodings
+        self.fingerprint = self.getfingerprint()
+        self._open()
+        return self
+
+    def _open(self, encdim=None, dtype=None):
+        codep = os.path.join(self.path, "%s.codes.npy" % self.fingerprint)
+        validp = os.path.join(self.path, "%s.valid.npy" % self.fingerprint)
+        if os.path.isfile(codep) and os.path.isfile(validp):
+            self.codes = np.load(codep, mmap_mode="r+")
+            self.valid = np.load(validp, mmap_mode="r+")
+        elif encdim is not None:    # create on first encoding
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            self.codes = np.lib.format.open_memmap(codep, mode="w+", dtype=dtype, shape=(self.size, encdim))
+            self.valid = np.lib.format.open_memmap(validp, mode="w+", dtype="bool", shape=(self.size,))
+        else:
+            self.codes, self.valid = None, None
+
+    def __call__(self, ids):     # ids: unique int ids
+        ids = np.asarray(ids)
+        if self.fingerprint is None:
+            self.refresh()
+        todo = ids if self.valid is None else ids[~self.valid[ids]]
+        if len(todo) > 0:
+            if self._pred is None:
+                self._pred = self.encoder.predict.transform(self.trans)
+            for i in range(0, len(todo), self.batsize):
+                batch = todo[i:i + self.batsize]
+                codes = self._pred(batch)
+                if self.codes is None:
+                    self._open(encdim=codes.shape[1], dtype=codes.dtype)
+                self.codes[batch] = codes
+                self.valid[batch] = True
+            self.codes.flush()
+            self.valid.flush()
+        return np.asarray(self.codes[ids])
+
+
 class CustomPredictor(object):
     def __init__(self, questionencoder=None, entityencoder=None,
                  relationencoder=None,
                  enttrans=None, reltrans=None, debug=False,
-                 subjinfo=None):
+                 subjinfo=None, encbatsize=1000,
+                 enccache=None, numents=None, numrels=None):
         self.qenc = questionencoder
         self.eenc = entityencoder
         self.renc = relationencoder
@@ -336,6 +418,13 @@ class CustomPredictor(object):
         self.debug = debug
         self.subjinfo = subjinfo
         self.qencodings = None
+        self.encbatsize = encbatsize    # number of unique candidates encoded per call
+        self.entcache, self.relcache = None, None
+        if enccache is not None:        # persistent encodings (directory)
+            self.entcache = EncodingCache(entityencoder, numents, os.path.join(enccache, "ents"),
+                                          trans=enttrans, batsize=encbatsize)
+            self.relcache = EncodingCache(relationencoder, numrels, os.path.join(enccache, "rels"),
+                                          trans=reltrans, batsize=encbatsize)
         self.tt = ticktock("predictor")
 
     # stateful API
@@ -358,21 +447,7 @@ class CustomPredictor(object):
         else:
             raise Exception("unrecognized mode in prediction")'''
         self.tt.tick("rank subjects")
-        ret = []    # list of lists of (subj, score) tuples, sorted
-        for i in range(self.qencodings.shape[0]):       # for every question
-            if len(entcans[i]) == 0:
-                scoredentcans = [(-1, 0)]
-            elif len(entcans[i]) == 1:
-                scoredentcans = [(entcans[i][0], 1)]
-            else:
-                entembs = self.eenc.predict.transform(self.enttrans)(entcans[i])
-                #embed()
-                entscoresi = np.tensordot(qencforent[i], entembs, axes=(0, 1))
-                entscoresi /= np.linalg.norm(qencforent[i])
-                entscoresi /= np.linalg.norm(entembs, axis=1)
-                scoredentcans = sorted(zip(entcans[i], entscoresi), key=lambda (x, y): y, reverse=True)
-            ret.append(scoredentcans)
-            self.tt.progress(i, self.qencodings.shape[0], live=True)
+        ret = self._rankcans(qencforent, entcans, self.eenc, self.enttrans, cache=self.entcache)
         self.tt.tock("ranked subjects")
         self.subjranks = ret
         return ret
@@ -391,24 +466,47 @@ class CustomPredictor(object):
         else:
             raise Exception("unrecognized mode in prediction")'''
         self.tt.tick("rank relations")
-        ret = []
-        for i in range(self.qencodings.shape[0]):
-            if len(relcans[i]) == 0:
-                scoredrelcans = [(-1, 0)]
-            elif len(relcans[i]) == 1:
-                scoredrelcans = [(relcans[i][0], 1)]
-            else:
-                relembs = self.renc.predict.transform(self.reltrans)(relcans[i])
-                relscoresi = np.tensordot(qencforrel[i], relembs, axes=(0, 1))
-                relscoresi /= np.linalg.norm(qencforrel[i])
-                relscoresi /= np.linalg.norm(relembs, axis=1)
-                scoredrelcans = sorted(zip(relcans[i], relscoresi), key=lambda (x, y): y, reverse=True)
-            ret.append(scoredrelcans)
-            self.tt.progress(i, self.qencodings.shape[0], live=True)
+        ret = self._rankcans(qencforrel, relcans, self.renc, self.reltrans, cache=self.relcache)
         self.tt.tock("ranked relations")
         self.relranks = ret
         return ret
 
+    def _rankcans(self, qencs, cans, encoder, trans, cache=None, pairbatsize=100000):
+        """ Ranks the candidates of all questions at once.
+            Every unique candidate over all questions is encoded once, in batches,
+            all (question, candidate) cosines are computed in one pass over the flattened pairs
+            and sorted per question by one lexsort.
+            Returns list of lists of (candidate, score) tuples, sorted """
+        ret = [[(-1, 0)] if len(can) == 0 else [(can[0], 1)] for can in cans]
+        qids = [i for i in range(len(cans)) if len(cans[i]) > 1]
+        if len(qids) == 0:
+            return ret
+        lens = np.asarray([len(cans[i]) for i in qids])
+        flatcans = np.concatenate([np.asarray(cans[i]) for i in qids])
+        flatqs = np.repeat(np.asarray(qids), lens)      # question of every pair
+        uniqcans, canidxs = np.unique(flatcans, return_inverse=True)
+        # encode every unique candidate once, with one compiled predictor
+        if cache is not None:
+            cancodes = cache(uniqcans)
+        else:
+            encpred = encoder.predict.transform(trans)
+            cancodes = np.concatenate([encpred(uniqcans[i:i + self.encbatsize])
+                                       for i in range(0, len(uniqcans), self.encbatsize)], axis=0)
+        cancodes = cancodes / np.linalg.norm(cancodes, axis=1, keepdims=True)
+        qcodes = qencs / np.linalg.norm(qencs, axis=1, keepdims=True)
+        # score all pairs
+        scores = np.zeros((len(flatcans),), dtype=cancodes.dtype)
+        for i in range(0, len(flatcans), pairbatsize):
+            j = i + pairbatsize
+            scores[i:j] = np.einsum("ij,ij->i", qcodes[flatqs[i:j]], cancodes[canidxs[i:j]])
+        # sort within every question (stable, like sorted())
+        order = np.lexsort((-scores, flatqs))
+        flatcans, scores = flatcans[order], scores[order]
+        offsets = np.concatenate([[0], np.cumsum(lens)])
+        for k, i in enumerate(qids):
+            ret[i] = zip(flatcans[offsets[k]:offsets[k+1]].tolist(), scores[offsets[k]:offsets[k+1]])
+        return ret
+
     def rankrelationsfroments(self, bestsubjs, relsperent):
         relcans = [relsperent[bestsubj][0] if bestsubj in relsperent else [] for bestsubj in bestsubjs]
         return self.rankrelations(relcans)
@@ -539,17 +637,29 @@ class CustomPredictor(object):
 
 
 class NegIdxGen(object):
+    """ Negative subject and relation sampler.
+        Close sets are held as CSR arrays (sorted per row), all rows of a batch are drawn at once. """
     def __init__(self, maxentid, maxrelid, relclose=None, subjclose=None, relsperent=None):
         self.maxentid = maxentid
         self.maxrelid = maxrelid
-        print "using relclose" if relclose is not None else "no relclose"
-        print "using subjclose" if subjclose is not None else "no subjclose"
-        print "using relsperent" if relsperent is not None else "no relsperent"
-        self.relclose = {k: set(v) for k, v in relclose.items()} if relclose is not None else None
-        self.subjclose = {k: set(v) for k, v in subjclose.items()} if subjclose is not None else None
-        self.relsperent = {k: set(v[0]) for k, v in relsperent.items()} if relsperent is not None else None
+        self.relclose = self._csr(relclose, maxrelid + 1) if relclose is not None else None
+        self.subjclose = self._csr(subjclose, maxentid + 1) if subjclose is not None else None
+        self.relsperent = self._csr({k: v[0] for k, v in relsperent.items()}, maxentid + 1) \
+            if relsperent is not None else None
         self.samprobf = lambda x: np.tanh(np.log(x + 1)/3)
 
+    @staticmethod
+    def _csr(sets, numrows):    # dict: id -> ids ==> (offsets, values, keys, width), keys = row * width + value (sorted)
+        rows = sorted([k for k in sets if k < numrows])
+        vals = [np.unique(np.asarray(list(sets[k]), dtype="int64")) for k in rows]
+        lens = np.zeros((numrows,), dtype="int64")
+        lens[rows] = [len(v) for v in vals]
+        offsets = np.concatenate([[0], np.cumsum(lens)])
+        values = np.concatenate(vals) if len(vals) > 0 else np.zeros((0,), dtype="int64")
+        width = values.max() + 1 if len(values) > 0 else 1
+        keys = np.repeat(np.arange(numrows, dtype="int64"), lens) * width + values
+        return offsets, values, keys, width
+
     def __call__(self, datas, gold):
         subjrand = self.sample(gold[:, 0], self.subjclose, self.maxentid)
         if self.relsperent is not None:     # sample uber-close
@@ -557,45 +667,52 @@ class NegIdxGen(object):
         else:
             relrand = self.sample(gold[:, 1], self.relclose, self.maxrelid)
         ret = np.concatenate([subjrand, relrand], axis=1)
-        # embed()
         # TODO NEGATIVE SAMPLING OF RELATIONS FROM GOLD ENTITY'S RELATIONS
         return datas, ret.astype("int32")
 
+    def _draw(self, csr, rows, excl=None):
+        """ for every row, size of its set (without excl) and a uniform draw from it (-1 if empty) """
+        offsets, values, keys, width = csr
+        inrange = (rows >= 0) & (rows < len(offsets) - 1)     # ids out of range have empty sets
+        rows = np.where(inrange, rows, 0)
+        starts = offsets[rows]
+        lens = np.where(inrange, offsets[rows + 1] - starts, 0)
+        if excl is not None and len(values) > 0:      # position of excl in row, shift draws past it
+            pos = np.searchsorted(keys, rows * width + excl) - starts
+            has = (pos < lens) & (values[np.minimum(starts + pos, len(values) - 1)] == excl)
+            lens = lens - has
+        draws = np.floor(rng().random_sample(rows.shape) * lens).astype("int64")
+        if excl is not None and len(values) > 0:
+            draws += has & (draws >= pos)
+        ret = -np.ones_like(rows, dtype="int64")
+        ret[lens > 0] = values[(starts + draws)[lens > 0]]
+        return lens, ret
+
     def samplereluberclose(self, relgold, entgold):
-        ret = np.zeros_like(relgold, dtype="int32")
-        for i in range(relgold.shape[0]):
-            uberclosesampleset = (self.relsperent[entgold[i]] if entgold[i] in self.relsperent else set())\
-                .difference({relgold[i]})
-            if np.random.random() < self.samprobf(len(uberclosesampleset)):
-                ret[i] = random.sample(uberclosesampleset, 1)[0]
-            else:
-                completerandom = False
-                if self.relclose is not None:
-                    closesampleset = (self.relclose[relgold[i]] if relgold[i] in self.relclose else set())\
-                        .difference({relgold[i]})
-                    if np.random.random() < self.samprobf(len(closesampleset)):
-                        ret[i] = random.sample(closesampleset, 1)[0]
-                    else:
-                        completerandom = True
-                else:
-                    completerandom = True
-                if completerandom:
-                    ret[i] = np.random.randint(0, self.maxrelid + 1)
+        r = rng()
+        ret = r.randint(0, self.maxrelid + 1, relgold.shape)
+        done = np.zeros(relgold.shape, dtype="bool")
+        uberlens, uberdraws = self._draw(self.relsperent, entgold, excl=relgold)
+        usesam = r.random_sample(relgold.shape) < self.samprobf(uberlens)
+        ret[usesam] = uberdraws[usesam]
+        done |= usesam
+        if self.relclose is not None:
+            closelens, closedraws = self._draw(self.relclose, relgold, excl=relgold)
+            usesam = ~done & (r.random_sample(relgold.shape) < self.samprobf(closelens))
+            ret[usesam] = closedraws[usesam]
         ret = np.expand_dims(ret, axis=1)
-        return ret
+        return ret.astype("int32")
 
     def sample(self, gold, closeset, maxid):
         # assert(gold.ndim == 2 and gold.shape[1] == 1)
+        r = rng()
         if closeset is None:
-            return np.random.randint(0, maxid + 1, (gold.shape[0], 1))
+            return r.randint(0, maxid + 1, (gold.shape[0], 1))
         else:
-            ret = np.zeros_like(gold)
-            for i in range(gold.shape[0]):
-                sampleset = closeset[gold[i]] if gold[i] in closeset else []
-                if np.random.random() < self.samprobf(len(sampleset)):
-                    ret[i] = random.sample(sampleset, 1)[0]
-                else:
-                    ret[i] = np.random.randint(0, maxid + 1)
+            ret = r.randint(0, maxid + 1, gold.shape)
+            lens, draws = self._draw(closeset, gold)
+            usesam = r.random_sample(gold.shape) < self.samprobf(lens)
+            ret[usesam] = draws[usesam]
             ret = np.expand_dims(ret, axis=1)
             return ret.astype("int32")
 
@@ -628,6 +745,7 @@ def run(negsammode="closest",   # "close" or "random"
         testnegsam=False,
         testmodel=False,
         sepcharembs=False,
+        enccache=None,      # directory for persistent subject/relation encodings
         ):
     tt = ticktock("script")
     tt.tick("loading data")
@@ -845,7 +963,10 @@ def run(negsammode="closest",   # "close" or "random"
                                 enttrans=transf.ef,
                                 reltrans=transf.rf,
                                 debug=debugtest,
-                                subjinfo=subjinfo)
+                                subjinfo=subjinfo,
+                                enccache=enccache,
+                                numents=numsubjs,
+                                numrels=numrels)
 
     tt.tick("predicting")
     if forcesubjincl:       # forces the intended subject entity to be among candidates
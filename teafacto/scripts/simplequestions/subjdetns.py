@@ -95,12 +95,9 @@ def gencans(data, top=50, exact=True, rwd=None, ed=None, host=None, index=None):
                         map(lambda x: rwd[x],
                             filter(lambda x: x in rwd, data[i, :])))
         sentences.append(sentence)
-        searchres = idx.searchsentence(sentence, exact=exact, top=top)
+    for searchres in idx.searchsentences(sentences, exact=exact, top=top):   # one batched lookup
         scans = map(lambda (x, (y, z)): ed[x], searchres.items())
-        if i % 10 == 0:
-            tt.live("%d of %d" % (i, data.shape[0]))
         cans.append(scans)
-    tt.stoplive()
     tt.tock("generated cans")
     return cans
 
@@ -1,4 +1,4 @@
-import theano, numpy as np
+import theano, numpy as np, weakref
 
 from teafacto.core.base import Input, Var, Val
 from teafacto.util import issequence
@@ -12,30 +12,118 @@ class ModelUser(object):
 
 
 class RecPredictor(ModelUser):
+    # compiled init and step functions, shared by all predictors of the same model
+    # model -> {"params": param values, "init": {initsig: (initvals, initf, statevars, nonseqvars, outs)},
+    #           "step": {stepsig: f}, "transfstep": {transf: {stepsig: f}}}
+    # step functions built with a transf are dropped with it, all functions are dropped when the params change
+    _cache = weakref.WeakKeyDictionary()
+
     def __init__(self, model, **kw):
         super(RecPredictor, self).__init__(model, **kw)
         self._transf = None
+        self._initsig = None
         self.statevars, self.statevals, self.nonseqvars, self.nonseqvals = None, None, None, None
 
+    @classmethod
+    def clearcache(cls, model=None):
+        if model is None:
+            cls._cache.clear()
+        elif model in cls._cache:
+            del cls._cache[model]
+
+    def _getcache(self):
+        params = self._paramvalues()
+        if self.model not in self._cache or not self._same(self._cache[self.model]["params"], params):
+            self._cache[self.model] = {"params": params, "init": {}, "step": {},
+                                       "transfstep": weakref.WeakKeyDictionary()}
+        return self._cache[self.model]
+
+    def _paramvalues(self):     # shared variables of the model's params, changed by e.g. GRU.fuse()
+        if not hasattr(self.model, "namedparams"):
+            return []
+        return [(name, p.value) for name, p in self.model.namedparams().items()]
+
+    @staticmethod
+    def _same(a, b):
+        return len(a) == len(b) and all([x[0] == y[0] and x[1] is y[1] for x, y in zip(a, b)])
+
     def init(self, *initargs):
-        # pre-build
-        initargs = [Val(initarg) for initarg in initargs]
-        inits = self.model.get_inits(*initargs)
+        initargs = [np.asarray(initarg) for initarg in initargs]
+        self._initsig = tuple((x.ndim, self._valdtype(x)) for x in initargs)
+        cache = self._getcache()["init"]
+        if self._initsig not in cache:      # pre-build
+            cache[self._initsig] = self._buildinit(initargs)
+        initvals, initf, self.statevars, self.nonseqvars, outs = cache[self._initsig]
+        for initval, initarg, (_, dtype) in zip(initvals, initargs, self._initsig):
+            initval.value.set_value(initarg.astype(dtype))
+        # one pass through shared computation (e.g. encoder)
+        symvals = initf() if initf is not None else []
+        if not all([issym for issym, _ in outs]):   # non-symbolic inits can depend on the init values
+            outs = self._getouts(initvals)
+        vals = [symvals[x] if issym else x for issym, x in outs]
+        self.statevals = vals[:len(self.statevars)]
+        self.nonseqvals = vals[len(self.statevars):]
+        self.f = None
+        return self
+
+    def _buildinit(self, initargs):
+        initvals = [Val(initarg) for initarg in initargs]
+        inits, nonseqs = self._getinits(initvals)
+        statevars = [self._wrapininput(x) for x in inits]
+        nonseqvars = [self._wrapininput(x) for x in nonseqs]
+        symouts = [x.d for x in inits + nonseqs if isinstance(x, (Var, Val))]
+        initf = theano.function(inputs=[], outputs=symouts) if len(symouts) > 0 else None
+        return initvals, initf, statevars, nonseqvars, self._getouts(initvals, inits + nonseqs)
+
+    def _getinits(self, initvals):
+        inits = self.model.get_inits(*initvals)
         nonseqs = []
         if isinstance(inits, tuple):
             nonseqs = inits[1]
             inits = inits[0]
-        self.statevars = [self._wrapininput(x) for x in inits]
-        self.nonseqvars = [self._wrapininput(x) for x in nonseqs]
-        self.statevals = [self._evalstate(x) for x in inits]
-        self.nonseqvals = [self._evalstate(x) for x in nonseqs]
-        return self
+        return list(inits), list(nonseqs)
+
+    def _getouts(self, initvals, allinits=None):
+        """ (True, position in compiled outputs) or (False, value) for every init,
+            non-symbolic values are taken from a fresh get_inits() on the current init values """
+        if allinits is None:
+            inits, nonseqs = self._getinits(initvals)
+            allinits = inits + nonseqs
+        outs = []
+        numsym = 0
+        for x in allinits:
+            if isinstance(x, (Var, Val)):
+                outs.append((True, numsym))
+                numsym += 1
+            else:
+                outs.append((False, x))
+        return outs
+
+    @staticmethod
+    def _valdtype(x):     # dtype as stored by Val
+        if x.dtype.kind == "i":
+            return str(x.dtype)
+        elif x.dtype.kind == "f":
+            return theano.config.floatX
+        else:
+            return str(x.dtype)
 
     def transf(self, transf):
         self._transf = transf
+        self.f = None
         return self
 
     def _build(self, inps):
+        stepsig = (self._initsig, tuple((x.ndim, str(x.dtype)) for x in inps))
+        if self._transf is None:
+            cache = self._getcache()["step"]
+        else:
+            cache = self._getcache()["transfstep"].setdefault(self._transf, {})
+        if stepsig not in cache:
+            cache[stepsig] = self._buildstep(inps)
+        self.f = cache[stepsig]
+
+    def _buildstep(self, inps):
         inpvars = [Input(ndim=inp.ndim, dtype=inp.dtype) for inp in inps]
         if self._transf is not None:
             tinpvars = self._transf(*inpvars)
@@ -46,9 +134,9 @@ class RecPredictor(ModelUser):
             tinpvars = inpvars
         out = self.model.rec(*(tinpvars + self.statevars + self.nonseqvars))
         alloutvars = out
-        self.f = theano.function(inputs=[x.d for x in inpvars + self.statevars + self.nonseqvars],
-                                 outputs=[x.d for x in alloutvars],
-                                 on_unused_input="warn")
+        return theano.function(inputs=[x.d for x in inpvars + self.statevars + self.nonseqvars],
+                               outputs=[x.d for x in alloutvars],
+                               on_unused_input="warn")
 
     def _wrapininput(self, x):
         if isinstance(x, (Var, Val)):
@@ -56,15 +144,22 @@ class RecPredictor(ModelUser):
         elif isinstance(x, int):
             return Input(ndim=0, dtype="int32")
 
-    def _evalstate(self, x):
-        if isinstance(x, (Var, Val)):
-            return x.d.eval()
-        else:
-            return x
+    # beams
+    def expand(self, k):    # repeats every example k times (for beam search), states and nonseqs are batch-first
+        rep = lambda x: np.repeat(x, k, axis=0) if isinstance(x, np.ndarray) and x.ndim > 0 else x
+        self.statevals = [rep(x) for x in self.statevals]
+        self.nonseqvals = [rep(x) for x in self.nonseqvals]
+        return self
+
+    def reorder(self, idxs):    # selects (and duplicates) examples of current states
+        self.statevals = [x[idxs] if isinstance(x, np.ndarray) and x.ndim > 0 else x
+                          for x in self.statevals]
+        return self
 
     # feed
     def feed(self, *inps):  # inps: (batsize, ...)
-        if self.f is None:      # build
+        inps = [np.asarray(inp) for inp in inps]
+        if self.f is None:      # build or get from cache
             self._build(inps)
         inpvals = list(inps) + self.statevals + self.nonseqvals
         outpvals = self.f(*inpvals)
@@ -17,6 +17,15 @@ class ModelWrapper(object):
         self.recpred.init(*args)
         return self
 
+    def expand(self, k):    # k copies of every example, after init() and setargs()
+        self.recpred.expand(k)
+        self._batsize *= k
+        return self
+
+    def reorder(self, idxs):
+        self.recpred.reorder(idxs)
+        return self
+
     @staticmethod
     def wrap(model, startsymbol=0, stopsymbol=None):
         assert(startsymbol is not None and isnumber(startsymbol))
@@ -56,6 +65,11 @@ class SeqTransDecWrapper(ModelWrapper):
     def init_out(self):
         return self.startsymbol * np.ones((self.args.shape[0],)).astype("int32")
 
+    def expand(self, k):
+        super(SeqTransDecWrapper, self).expand(k)
+        self.args = np.repeat(self.args, k, axis=0)
+        return self
+
     def get_cur_probs(self, i, curout):
         curinp = self.args[:, i]
         curprobs = self.recpred.feed(curinp, curout)
@@ -119,13 +133,65 @@ class GreedySearch(SearchStrategy):
 
 
 class BeamSearch(SearchStrategy):
-    def __init__(self, model, beamsize=10, startsymbol=0, stopsymbol=None, maxlen=100, **kw):
+    def __init__(self, model, beamsize=10, startsymbol=0, stopsymbol=None, maxlen=100, lennorm=0., **kw):
         super(BeamSearch, self).__init__(model, startsymbol=startsymbol, stopsymbol=stopsymbol, maxlen=maxlen, **kw)
         self.beamsize = beamsize
-
-    def search(self, *args):
+        self.lennorm = lennorm
+
+    def search(self, *args, **kw):
+        """ Returns the topk best sequences for every example (batsize, topk, seqlen)
+            and their log-probabilities (batsize, topk), divided by length ** lennorm.
+            Length counts up to and including the stop symbol. """
+        topk = kw["topk"] if "topk" in kw else self.beamsize
+        lennorm = kw["lennorm"] if "lennorm" in kw else self.lennorm
+        assert(topk <= self.beamsize)
+        k = self.beamsize
         self.wrapped.setargs(*args)
-        # TODO
+        curout = self.wrapped.init_out()
+        batsize = curout.shape[0]
+        self.wrapped.expand(k)          # all hypotheses in one batch: (batsize * k, ...)
+        curout = np.repeat(curout, k, axis=0)
+        scores = np.zeros((batsize, k), dtype="float32")
+        scores[:, 1:] = -np.inf         # start with one hypothesis per example
+        scores = scores.reshape((-1,))
+        lens = np.zeros_like(scores)
+        done = np.zeros(scores.shape, dtype="bool")
+        outs = np.zeros((batsize * k, 0), dtype="int32")
+        groupoffsets = (np.arange(batsize) * k)[:, None]
+        i = 0
+        stop = False
+        while not stop:
+            curprobs = self.wrapped._get_cur_probs(i, curout)     # (batsize * k, vocsize)
+            vocsize = curprobs.shape[1]
+            with np.errstate(divide="ignore"):
+                logprobs = np.log(curprobs)
+            if self.stopsymbol is not None:     # finished hypotheses only continue with stop symbol
+                logprobs[done, :] = -np.inf
+                logprobs[done, self.stopsymbol] = 0.
+            candscores = (scores[:, None] + logprobs).reshape((batsize, k * vocsize))
+            best = np.argpartition(-candscores, k - 1, axis=1)[:, :k]       # (batsize, k)
+            bestscores = candscores[np.arange(batsize)[:, None], best]
+            order = np.argsort(-bestscores, axis=1, kind="mergesort")
+            best = best[np.arange(batsize)[:, None], order]
+            src = (groupoffsets + best // vocsize).reshape((-1,))      # (batsize * k,) selected hypotheses
+            curout = (best % vocsize).reshape((-1,)).astype("int32")
+            scores = candscores[np.arange(batsize)[:, None], best].reshape((-1,))
+            self.wrapped.reorder(src)
+            outs = np.concatenate([outs[src], curout[:, None]], axis=1)
+            lens = np.where(done[src], lens[src], lens[src] + 1)
+            done = done[src]
+            if self.stopsymbol is not None:
+                done = done | (curout == self.stopsymbol)
+            i += 1
+            stop = (i == (self.maxlen - 1)) \
+                   or self.wrapped.isstop(i) \
+                   or np.all(done)
+        normscores = scores / np.maximum(lens, 1) ** lennorm if lennorm != 0 else scores
+        normscores = normscores.reshape((batsize, k))
+        rerank = np.argsort(-normscores, axis=1, kind="mergesort")[:, :topk]
+        ret = outs.reshape((batsize, k, -1))[np.arange(batsize)[:, None], rerank]
+        retscores = normscores[np.arange(batsize)[:, None], rerank]
+        return ret, retscores
 
 
 class VarBeamSearch(BeamSearch):
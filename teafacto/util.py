@@ -1,66 +1,208 @@
-import collections, inspect, argparse, dill as pkl, os, numpy as np, pandas as pd, sys
+import collections, inspect, argparse, dill as pkl, os, numpy as np, pandas as pd, sys, itertools
 from datetime import datetime as dt
 import re, unidecode, nltk
 from nltk.corpus import stopwords
 
 
-def loadlexidtsv(path, numwords=10, numchars=30):
-    with open(path) as f:
-        allgloveids = []    # 2D
-        allcharmats = []    # 3D
-        allfbids = []       # 1D
-
-        c = 0
-        for line in f:
-            try:
-                ns = line[:-1].split("\t")
-                gloveids = map(int, ns[0].split(" "))
-                charmat = []
-                charsplits = ns[1].split(", ")
-                charmat.extend([[int(y) if len(y) > 0 else 0 for y in x.split(" ")] for x in charsplits])
-                fbid = int(ns[2])
-                allgloveids.append(gloveids)
-                allcharmats.append(charmat)
-                allfbids.append(fbid)
-                if c % 1e6 == 0:
-                    print "%.0fM" % (c/1e6)
-                c += 1
-            except Exception, e:
-                print line
-                raise e
-        allgloveids, allcharmats, allfbids = makenpfrom(allgloveids, allcharmats, allfbids, dtype="int32", numwords=numwords, numchars=numchars)
-        return allgloveids, allcharmats, allfbids
+def loadlexidtsv(path, numwords=10, numchars=30, workers=None, cache=True, chunksize=2**25):
+    """ Loads a TSV of (space-separated word ids, comma-separated space-separated char ids of words, fb id) lines
+        into int32 matrices of word ids (numwords), char ids (numwords x numchars) and a vector of fb ids.
+        Files larger than chunksize are parsed in parallel over byte ranges. With cache, the arrays are kept in
+        <path>.lexid-<numwords>-<numchars>.<i>.npy and reloaded as long as the TSV file is not newer. """
+    build = lambda: parsetsv(path, _parselexidlines, workers=workers, chunksize=chunksize,
+                             numwords=numwords, numchars=numchars)
+    if not cache:
+        return build()
+    return npcache(path, "lexid-%d-%d" % (numwords, numchars), build, numarrays=3)
+
+
+def _parselexidlines(lines, numwords=10, numchars=30):
+    allgloveids = np.zeros((len(lines), numwords), dtype="int32")
+    allcharmats = np.zeros((len(lines), numwords, numchars), dtype="int32")
+    allfbids = np.zeros((len(lines),), dtype="int32")
+    for i, line in enumerate(lines):
+        try:
+            ns = line.split("\t")
+            gloveids = ns[0].split(" ")
+            charsplits = ns[1].split(", ")
+            assert(len(gloveids) == len(charsplits))
+            gloveids = gloveids[:numwords]     # drop words after <numwords> words
+            allgloveids[i, :len(gloveids)] = map(int, gloveids)
+            for j, x in enumerate(charsplits[:numwords]):
+                chars = x.split(" ")[:numchars]     # if word is too long, truncate
+                allcharmats[i, j, :len(chars)] = [int(y) if len(y) > 0 else 0 for y in chars]
+            allfbids[i] = int(ns[2])
+        except Exception, e:
+            print line
+            raise e
+    return allgloveids, allcharmats, allfbids
 
 
 def makenpfrom(tomat, toten, tovec, dtype="int32", numwords=15, numchars=30):
-    i = 0
     delc = 0
     truncwc = 0
     assert(len(tomat) == len(toten) and len(toten) == len(tovec))
-    while i < len(tomat):
+    mat = np.zeros((len(tomat), numwords), dtype=dtype)
+    ten = np.zeros((len(tomat), numwords, numchars), dtype=dtype)
+    for i in range(len(tomat)):
         assert(len(tomat[i]) == len(toten[i]))
         if len(tomat[i]) > numwords:   # drop phrases longer than <numwords> words
-            #print tovec[i]
-            tomat[i] = tomat[i][:numwords]
-            toten[i] = toten[i][:numwords]
             delc += 1
-        else:
-            tomat[i].extend([0]*(numwords - len(tomat[i])))
-        j = 0
-        while j < len(toten[i]):
-            if len(toten[i][j]) > numchars:     # if word is too long, truncate
-                toten[i][j] = toten[i][j][:numchars]
+        words = tomat[i][:numwords]
+        mat[i, :len(words)] = words
+        for j, chars in enumerate(toten[i][:numwords]):
+            if len(chars) > numchars:     # if word is too long, truncate
                 truncwc += 1
-            else:
-                toten[i][j].extend([0]*(numchars-len(toten[i][j])))
-            j += 1
-        torep = [[0]*numchars]
-        toten[i].extend(torep*(numwords-len(toten[i])))
-        i += 1
-        if i % 1e6 == 0:
-            print "%.0fM, %d, %d" % ((i/1e6), delc, truncwc)
-    print i, delc, truncwc
-    return np.asarray(tomat, dtype=dtype), np.asarray(toten, dtype=dtype), np.asarray(tovec, dtype=dtype)
+            chars = chars[:numchars]
+            ten[i, j, :len(chars)] = chars
+    print len(tomat), delc, truncwc
+    return mat, ten, np.asarray(tovec, dtype=dtype)
+
+
+def tsvchunks(path, numchunks):
+    """ Splits the file in path into at most numchunks byte ranges (start, end) at line boundaries """
+    size = os.path.getsize(path)
+    bounds = [0]
+    with open(path, "rb") as f:
+        for i in range(1, numchunks):
+            pos = size * i // numchunks
+            if pos <= bounds[-1]:
+                continue
+            f.seek(pos - 1)
+            f.readline()            # to the start of the next line
+            bounds.append(f.tell())
+    bounds.append(size)
+    return [(a, b) for a, b in zip(bounds[:-1], bounds[1:]) if b > a]
+
+
+def readlines(path, start=0, end=None):
+    """ Lines (without line ends) in byte range start:end of the file in path """
+    with open(path, "rb") as f:
+        f.seek(start)
+        data = f.read() if end is None else f.read(end - start)
+    lines = data.split("\n")
+    if lines[-1] == "":
+        del lines[-1]
+    return lines
+
+
+_parsejobs = {}     # parse jobs, inherited by forked worker processes
+
+
+def _parsechunk(args):
+    job, start, end = args
+    path, parse, kw = _parsejobs[job]
+    return _astuple(parse(readlines(path, start, end), **kw))
+
+
+def _astuple(x):
+    return x if isinstance(x, tuple) else (x,)
+
+
+def parsetsv(path, parse, workers=None, chunksize=2**25, **kw):
+    """ Parses the file in path with parse(lines, **kw), which must return an array or tuple of arrays (of one row per line).
+        Files larger than chunksize bytes are split into byte ranges (at least one per worker),
+        parsed by <workers> processes (default: all cpus) and the results are concatenated in file order.
+        Smaller files are parsed in this process. """
+    import multiprocessing
+    from contextlib import closing
+    workers = multiprocessing.cpu_count() if workers is None else workers
+    size = os.path.getsize(path)
+    numchunks = int(np.ceil(1. * size / chunksize))
+    chunks = tsvchunks(path, max(numchunks, workers)) if numchunks > 1 else [(0, size)]
+    job = max(_parsejobs.keys() + [-1]) + 1
+    _parsejobs[job] = (path, parse, kw)
+    try:
+        jobs = [(job, start, end) for start, end in chunks]
+        if workers > 1 and len(jobs) > 1:
+            with closing(multiprocessing.Pool(min(workers, len(jobs)))) as pool:
+                rets = pool.map(_parsechunk, jobs, chunksize=1)
+        else:
+            rets = map(_parsechunk, jobs)
+    finally:
+        del _parsejobs[job]
+    rets = [r for r in rets if len(r[0]) > 0]     # chunks without rows can have a different shape
+    if len(rets) == 0:
+        rets = [_astuple(parse([], **kw))]
+    ret = tuple([np.concatenate(x, axis=0) for x in zip(*rets)])
+    return ret if len(ret) > 1 else ret[0]
+
+
+def _npcachepaths(path, key, numarrays):
+    return ["%s.%s.%d.npy" % (path, key, i) for i in range(numarrays)]
+
+
+def npcache(path, key, build, numarrays=1):
+    """ Returns the arrays made by build() from the file in path, saved once in <path>.<key>.<i>.npy.
+        The cache is rebuilt when the file in path is newer. """
+    cachepaths = _npcachepaths(path, key, numarrays)
+    if all([os.path.exists(cp) and os.path.getmtime(cp) >= os.path.getmtime(path) for cp in cachepaths]):
+        ret = tuple([np.load(cp) for cp in cachepaths])
+    else:
+        ret = _astuple(build())
+        assert(len(ret) == numarrays)
+        for cp, x in zip(cachepaths, ret):
+            np.save(cp + ".tmp.npy", x)
+            os.rename(cp + ".tmp.npy", cp)
+    return ret if numarrays > 1 else ret[0]
+
+
+def _wordveccachepaths(path):
+    return path + ".npy", path + ".vocab"
+
+
+def wordveccache(path, dtype="float32"):
+    """ Converts a text word vector file (e.g. GloVe: word followed by space-separated values on every line)
+        to a binary matrix (<path>.npy) and a vocabulary file (<path>.vocab, one word per line), once.
+        The cache is rebuilt when the text file is newer. Returns the paths of the binary matrix and vocabulary. """
+    binpath, vocpath = _wordveccachepaths(path)
+    if os.path.exists(binpath) and os.path.exists(vocpath) \
+            and os.path.getmtime(binpath) >= os.path.getmtime(path) \
+            and os.path.getmtime(vocpath) >= os.path.getmtime(path):
+        return binpath, vocpath
+    tt = ticktock("wordveccache")
+    tt.tick("converting %s" % path)
+    numwords, dim = 0, None
+    with open(path) as f:
+        for line in f:
+            line = line.rstrip()
+            if len(line) == 0:      # blank lines are skipped
+                continue
+            if dim is None:
+                dim = len(line.split(" ")) - 1
+            numwords += 1
+    vecs = np.lib.format.open_memmap(binpath + ".tmp", mode="w+", dtype=dtype, shape=(numwords, dim))
+    with open(path) as f, open(vocpath + ".tmp", "w") as vocf:
+        i = 0
+        for line in f:
+            line = line.rstrip()
+            if len(line) == 0:
+                continue
+            word, values = line.split(" ", 1)
+            vecs[i] = np.fromstring(values, dtype=dtype, sep=" ")
+            vocf.write(word + "\n")
+            i += 1
+    vecs.flush()
+    del vecs
+    os.rename(binpath + ".tmp", binpath)
+    os.rename(vocpath + ".tmp", vocpath)
+    tt.tock("converted %d vectors of dim %d" % (numwords, dim))
+    return binpath, vocpath
+
+
+def loadwordvocab(path, top=None):
+    """ words of text word vector file in path (through binary cache), only first top if top is not None """
+    _, vocpath = wordveccache(path)
+    with open(vocpath) as f:
+        return [line[:-1] for line in itertools.islice(f, top)]
+
+
+def loadwordvecs(path, top=None):
+    """ words and memory-mapped vector matrix of text word vector file in path (through binary cache).
+        With top, only the first top words and vectors are read """
+    binpath, _ = wordveccache(path)
+    vecs = np.load(binpath, mmap_mode="r")
+    return loadwordvocab(path, top=top), vecs[:top]
 
 
 def unstructurize(x, i=None):
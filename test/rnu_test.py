@@ -4,7 +4,7 @@ from unittest import TestCase
 import numpy as np
 
 from teafacto.blocks.seq.rnu import GRU, LSTM, IFGRU
-from teafacto.core.base import param, Input
+from teafacto.core.base import param, Input, Parameter
 
 
 class TestGRU(TestCase):
@@ -89,6 +89,45 @@ class TestGRU(TestCase):
         data = np.random.random(othershape)
         self.assertRaises(Exception, self.rnu.predict, data)
 
+    def test_precomputed_inputs_same_as_stepwise(self):
+        mask = np.ones((self.batsize, self.seqlen), dtype="float32")
+        for i, l in enumerate(np.random.randint(1, self.seqlen + 1, (self.batsize,))):
+            mask[i, l:] = 0
+        self.assertIsNotNone(self.rnu.precompute(Input(ndim=3, dtype="float32")))
+        pred = self.rnu.predict(self.testdata, mask)
+        self.rnu._precompute = False
+        self.assertIsNone(self.rnu.precompute(Input(ndim=3, dtype="float32")))
+        stepwisepred = self.rnu.predict(self.testdata, mask)
+        self.assertTrue(np.allclose(pred, stepwisepred, atol=1e-6))
+
+    def test_fuse_unfuse_same_predictions(self):
+        if self.rnu.fusespec is None:
+            return
+        pred = self.rnu.predict(self.testdata)
+        separate = self.rnu.get_params()
+        self.rnu.fuse()
+        fusespec = [x for x in self.rnu.fusespec if isinstance(getattr(self.rnu, x[0]), Parameter)]
+        fusedparams = set([getattr(self.rnu, x[0]) for x in fusespec])
+        self.assertTrue(fusedparams.issubset(self.rnu.get_params()))
+        self.assertEqual(len(self.rnu.get_params().intersection(separate)),
+                         len(separate) - sum([len(x[1]) for x in fusespec]))
+        self.assertTrue(np.allclose(pred, self.rnu.predict(self.testdata), atol=1e-6))
+        self.rnu.unfuse()
+        for paramname in self.paramnames:
+            self.assertTrue(hasattr(self.rnu, paramname))
+        self.assertTrue(np.allclose(pred, self.rnu.predict(self.testdata), atol=1e-6))
+
+    def test_fuse_refuses_constrained_params(self):
+        if self.rnu.fusespec is None:
+            return
+        self.rnu.predict(self.testdata)
+        parts = [getattr(self.rnu, x[1][0]) for x in self.rnu.fusespec]
+        [x for x in parts if isinstance(x, Parameter)][-1].clip(-1, 1)     # last fused group
+        self.assertRaises(Exception, self.rnu.fuse)
+        self.assertFalse(self.rnu._fused)
+        for fusedname, partnames in self.rnu.fusespec:      # nothing fused
+            self.assertFalse(hasattr(self.rnu, fusedname))
+
     def test_save_load_predict(self):
         outpv = self.rnu.predict(self.testdata)
         path = self.rnu.save()
@@ -1,5 +1,144 @@
+import os, shutil, tempfile
 from unittest import TestCase
 
+import numpy as np
+
+from teafacto.core.datafeed import DataFeeder, PrefetchFeeder, FeedView, rng
+
 
 class TestDataFeeder(TestCase):
     pass
+
+
+class TestBucketedDataFeeder(TestCase):
+    def setUp(self):
+        self.lens = np.random.randint(1, 30, (200,))
+        self.x = np.zeros((200, 30), dtype="int32")
+        for i, l in enumerate(self.lens):
+            self.x[i, :l] = i + 1
+        self.y = np.arange(200)
+
+    def test_bucketed_batches_trimmed(self):
+        df = DataFeeder(self.x, self.y).bucket(maskid=0, numbuckets=5, seqfeeds=[0]).numbats(20)
+        seen = []
+        spread = []
+        df.reset()
+        while df.hasnextbatch():
+            x, y = df.nextbatch()
+            self.assertEqual(x.shape[1], np.max(self.lens[y]))
+            self.assertTrue(np.all(x[:, 0] == y + 1))
+            spread.append(np.max(self.lens[y]) - np.min(self.lens[y]))
+            seen.extend(list(y))
+        self.assertEqual(sorted(seen), range(200))
+        self.assertLess(np.mean(spread), 15)
+
+    def test_seqfeeds_required(self):
+        self.assertRaises(Exception, DataFeeder(self.x, self.y).bucket, maskid=0)
+        pairs = np.asarray([[3, 0], [2, 5]] * 10, dtype="int32")      # id pairs, 0 is a valid id
+        df = DataFeeder(self.x[:20], pairs).bucket(maskid=0, seqfeeds=[0]).numbats(2)
+        df.reset()
+        while df.hasnextbatch():
+            self.assertEqual(df.nextbatch()[1].shape[1], 2)
+
+    def test_split_keeps_bucketing(self):
+        df = DataFeeder(self.x, self.y).bucket(maskid=0, seqfeeds=[0])
+        dftrain, dfvalid = df.split(4, random=True, df_randoms=(True, False))
+        dftrain.numbats(10)
+        dftrain.reset()
+        x, y = dftrain.nextbatch()
+        self.assertEqual(x.shape[1], np.max(self.lens[y]))
+
+
+class TestMemmapDataFeeder(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.x = np.arange(1000).reshape((500, 2))
+        self.y = np.arange(500)
+        np.save(os.path.join(self.path, "x.npy"), self.x)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_chunk_shuffle(self):
+        idxs = DataFeeder._chunkshuffle(105, 10)
+        self.assertEqual(sorted(idxs), range(105))
+        chunkids = idxs // 10       # every chunk is a shuffled run of consecutive examples
+        self.assertEqual(np.sum(np.diff(chunkids) != 0), 10)
+        self.assertFalse(np.all(np.diff(idxs) == 1))
+
+    def test_batches_aligned(self):
+        df = DataFeeder(os.path.join(self.path, "x.npy"), self.y).numbats(20)
+        self.assertIsInstance(df.feeds[0], np.memmap)
+        self.assertEqual(df.getchunksize(), 250)
+        seen = []
+        df.reset()
+        while df.hasnextbatch():
+            x, y = df.nextbatch()
+            self.assertTrue(np.all(x[:, 0] == 2 * y))
+            self.assertTrue(np.all(np.diff(y) > 0))
+            seen.extend(list(y))
+        self.assertEqual(sorted(seen), range(500))
+
+    def test_split_views(self):
+        df = DataFeeder(os.path.join(self.path, "x.npy"), self.y)
+        dftrain, dfvalid = df.split(5, random=True)
+        self.assertIsInstance(dftrain.feeds[0], FeedView)
+        self.assertEqual(dftrain.feeds[0].shape, (400, 2))
+        self.assertEqual(dfvalid.feeds[1].shape, (100,))
+        tv, vv = dftrain.isplit(np.arange(10))
+        self.assertIsInstance(tv.feeds[0], FeedView)
+        self.assertIs(tv.feeds[0].feed, df.feeds[0])
+        for d in [dftrain, dfvalid, tv, vv]:
+            x, y = d.nextbatch()
+            self.assertTrue(np.all(x[:, 0] == 2 * y))
+        self.assertTrue(np.all(np.asarray(vv.feeds[0]) == self.x[np.sort(dftrain.feeds[1][:10])]))
+
+
+class TestPrefetchFeeder(TestCase):
+    def setUp(self):
+        self.x = np.arange(100).reshape((50, 2))
+        self.y = np.arange(50)
+
+    def getbatches(self, feeder, epochs=2, transform=None):
+        ret = []
+        for _ in range(epochs):
+            feeder.reset()
+            while feeder.hasnextbatch():
+                batch = feeder.nextbatch()
+                ret.append(batch if transform is None else transform(*batch))
+        return ret
+
+    def test_same_as_sequential(self):
+        transform = lambda x, y: (x, y + np.random.randint(0, 1000, y.shape))
+        np.random.seed(1)
+        df = DataFeeder(self.x, self.y).numbats(7)
+        exp = self.getbatches(df, transform=transform)
+        np.random.seed(1)
+        df = DataFeeder(self.x, self.y).numbats(7)
+        pf = PrefetchFeeder(df, transform=transform, depth=3)
+        got = self.getbatches(pf)
+        self.assertEqual(len(exp), 14)
+        self.assertEqual(len(got), len(exp))
+        for e, g in zip(exp, got):
+            for ee, ge in zip(e, g):
+                self.assertTrue(np.all(ee == ge))
+
+    def test_seeded_workers_deterministic(self):
+        transform = lambda x, y: (x, rng().randint(0, 1000, y.shape))
+        runs = []
+        for _ in range(2):
+            df = DataFeeder(self.x, self.y, random=False).numbats(10)
+            pf = PrefetchFeeder(df, transform=transform, depth=4, workers=3, seed=42)
+            runs.append(self.getbatches(pf))
+        self.assertEqual(len(runs[0]), 20)
+        for a, b in zip(*runs):
+            self.assertTrue(np.all(a[0] == b[0]))
+            self.assertTrue(np.all(a[1] == b[1]))
+        self.assertTrue(np.all(np.concatenate([b[0] for b in runs[0][:10]]) == self.x))
+
+    def test_transform_error_raised(self):
+        def transform(x, y):
+            raise ValueError("bad batch")
+        pf = PrefetchFeeder(DataFeeder(self.x, self.y).numbats(5), transform=transform)
+        pf.reset()
+        self.assertRaises(ValueError, pf.hasnextbatch)
@@ -0,0 +1,52 @@
+import shutil, tempfile
+from unittest import TestCase
+
+import numpy as np
+
+from teafacto.blocks.basic import VectorEmbed
+from teafacto.core.base import Val
+from teafacto.scripts.simplequestions.fullrank.fullrank import EncodingCache
+
+
+class IdMap(object):        # id -> row of input ids
+    def __init__(self, mat):
+        self.mat = Val(mat)
+
+    def __call__(self, x):
+        return (self.mat[x],), {}
+
+
+class TestEncodingCache(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.enc = VectorEmbed(indim=20, dim=4)
+        self.ids = np.arange(10)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_fingerprint_once_until_refresh(self):
+        cache = EncodingCache(self.enc, 10, self.dir)
+        exp = self.enc.W.v[self.ids]
+        self.assertTrue(np.allclose(cache(self.ids), exp))
+        fingerprint = cache.fingerprint
+        calls = []
+        cache.getfingerprint = lambda: calls.append(1) or fingerprint
+        cache(self.ids[:5])
+        self.assertEqual(calls, [])         # not recomputed per lookup
+        self.enc.W.value.set_value(self.enc.W.v * 2)
+        self.assertTrue(np.allclose(cache(self.ids), exp))      # stale until refreshed
+        del cache.getfingerprint
+        cache.refresh()
+        self.assertNotEqual(cache.fingerprint, fingerprint)
+        self.assertTrue(np.allclose(cache(self.ids), exp * 2))
+
+    def test_trans_in_fingerprint(self):
+        a = EncodingCache(self.enc, 10, self.dir, trans=IdMap(np.arange(10)))
+        b = EncodingCache(self.enc, 10, self.dir, trans=IdMap(np.arange(10)[::-1]))
+        self.assertNotEqual(a.refresh().fingerprint, b.refresh().fingerprint)
+        self.assertTrue(np.allclose(a(self.ids), self.enc.W.v[self.ids]))
+        self.assertTrue(np.allclose(b(self.ids), self.enc.W.v[self.ids[::-1]]))
+        c = EncodingCache(self.enc, 10, self.dir, trans=IdMap(np.arange(10)))
+        self.assertEqual(c.refresh().fingerprint, a.fingerprint)
+        self.assertTrue(c.valid.all())      # reuses the encodings of a
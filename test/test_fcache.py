@@ -0,0 +1,68 @@
+import shutil, tempfile, os
+from unittest import TestCase
+
+import numpy as np
+
+from teafacto.examples.dummy import Dummy
+from teafacto.blocks.basic import Linear
+from teafacto.core.fcache import FunctionCache, fingerprint
+
+
+class TestFunctionCache(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_same_structure_same_fingerprint(self):
+        data = np.random.random((5, 4)).astype("float32")
+        inpsa, outsa = Linear(4, 3).autobuild(data)
+        inpsb, outsb = Linear(4, 3).autobuild(data)
+        inpsc, outsc = Linear(4, 2).autobuild(data)
+        ka, shareda = fingerprint([x.d for x in inpsa], [x.d for x in outsa])
+        kb, sharedb = fingerprint([x.d for x in inpsb], [x.d for x in outsb])
+        self.assertEqual(ka, kb)
+        self.assertEqual(len(shareda), 2)
+        self.assertEqual(len(sharedb), 2)
+        kc, _ = fingerprint([x.d for x in inpsc], [x.d for x in outsc])
+        self.assertEqual(ka, kc)    # shapes are not part of the structure
+        inpsd, outsd = Linear(4, 3).autobuild(data.astype("float64"))
+        kd, _ = fingerprint([x.d for x in inpsd], [x.d for x in outsd])
+        self.assertNotEqual(ka, kd)
+
+    def test_default_path(self):
+        old = os.environ.get("TEAFACTO_FCACHE")
+        os.environ["TEAFACTO_FCACHE"] = os.path.join(self.path, "default")
+        try:
+            self.assertEqual(FunctionCache(verbose=False).path, os.path.join(self.path, "default"))
+            self.assertTrue(os.path.isdir(os.path.join(self.path, "default")))
+        finally:
+            if old is None:
+                del os.environ["TEAFACTO_FCACHE"]
+            else:
+                os.environ["TEAFACTO_FCACHE"] = old
+
+    def test_predict_rebinds_params(self):
+        data = np.random.random((5, 4)).astype("float32")
+        a = Linear(4, 3)
+        b = Linear(4, 3)
+        apred = a.predict.cachefunctions(self.path)(data)
+        self.assertEqual(len(os.listdir(self.path)), 1)
+        bpred = b.predict.cachefunctions(self.path)(data)
+        self.assertEqual(len(os.listdir(self.path)), 1)
+        self.assertTrue(np.allclose(apred, np.dot(data, a.W.v) + a.b.v))
+        self.assertTrue(np.allclose(bpred, np.dot(data, b.W.v) + b.b.v))
+
+    def test_training_updates_current_params(self):
+        data = np.random.randint(0, 20, (50,)).astype("int32")
+        m = Dummy(20, 5)
+        m.train([data], data).cross_entropy().adadelta().cachefunctions(self.path).train(5, 2)
+        numcached = len(os.listdir(self.path))
+        m = Dummy(20, 5)
+        before = m.W.W.v.copy()
+        _, errs, _, _, _ = m.train([data], data).cross_entropy().adadelta()\
+            .cachefunctions(self.path).train(5, 5, returnerrors=True)
+        self.assertEqual(len(os.listdir(self.path)), numcached)
+        self.assertFalse(np.allclose(before, m.W.W.v))
+        self.assertTrue(errs[-1] < errs[0])
@@ -0,0 +1,49 @@
+from unittest import TestCase
+
+import numpy as np
+
+from teafacto.feed.langtransform import WordToWordId, WordToWordCharTransform, transinner
+from teafacto.feed.langfeeds import WordSeqFeed
+
+
+class TestWordTransforms(TestCase):
+    def setUp(self):
+        self.worddic = {"the": 2, "cat": 3, "sat": 4, "mat": 5}
+        self.data = np.asarray([["The", "cat", "sat", None, "mat"],
+                                ["the", "dog", None, None, None],
+                                ["mat", "Cat", "sat", "the", "cat"]], dtype="object")
+
+    def looped(self, x, numwords, numchars):      # reference: the per-cell loop
+        ret = np.zeros((x.shape[0], numwords, numchars + 1), dtype="int32")
+        for i in range(x.shape[0]):
+            for j in range(x.shape[1]):
+                retword, skip = transinner((x[i, j], numchars, self.worddic, 1))
+                if skip:
+                    break
+                ret[i, j, :] = retword
+        return ret
+
+    def test_wordchar_same_as_loop(self):
+        t = WordToWordCharTransform(self.worddic, unkwordid=1, numwords=6, numchars=4)
+        ret = t.transform(self.data)
+        self.assertEqual(ret.shape, (3, 6, 5))
+        self.assertEqual(ret.dtype, np.dtype("int32"))
+        self.assertTrue(np.all(ret == self.looped(self.data, 6, 4)))
+        self.assertTrue(np.all(ret[1, 1] == [1, ord("d"), ord("o"), ord("g"), 0]))
+
+    def test_wordid(self):
+        t = WordToWordId(self.worddic, numwords=5)
+        ret = t.transform(self.data[[0, 2]])
+        self.assertTrue(np.all(ret == [[2, 3, 4, 0, 0], [5, 3, 4, 2, 3]]))
+        self.assertRaises(KeyError, t.transform, self.data[[1]])
+
+    def test_feed_interned_and_cached(self):
+        exp = self.looped(self.data, 6, 4)
+        for cache in [False, True]:
+            t = WordToWordCharTransform(self.worddic, unkwordid=1, numwords=6, numchars=4)
+            feed = WordSeqFeed(self.data, t, cache=cache)
+            self.assertEqual(feed.shape, (3, 6, 5))
+            self.assertTrue(np.all(feed[1:3] == exp[1:3]))
+            sub = feed.get(np.asarray([2, 0]))
+            self.assertTrue(np.all(sub[:] == exp[[2, 0]]))
+            self.assertEqual(len(t.table), 8)       # padding + 7 distinct raw words, interned once
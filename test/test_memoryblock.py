@@ -4,10 +4,10 @@ import numpy as np
 
 from teafacto.blocks.seq.rnn import SeqEncoder
 from teafacto.blocks.seq.rnu import GRU
-from teafacto.blocks.basic import IdxToOneHot
+from teafacto.blocks.basic import IdxToOneHot, VectorEmbed
 from teafacto.blocks.lang.wordembed import WordEmbedGlove
 from teafacto.blocks.lang.wordvec import Glove
-from teafacto.blocks.memory import MemoryBlock
+from teafacto.blocks.memory import MemoryBlock, MemVec, DotMemAddr, GeneralDotMemAddr, TransDotMemAddr
 
 
 class TestMemoryBlock(TestCase):
@@ -101,3 +101,33 @@ class TestMemoryBlock(TestCase):
         self.assertRaises(AssertionError, lambda: memb.predict(idxs, data))
 
 
+
+
+class TestMemoryIndex(TestCase):
+    def setUp(self):
+        self.memsize, self.dim = 500, 10
+        self.memb = MemVec(VectorEmbed(indim=self.memsize, dim=self.dim))
+        self.memb.load(np.arange(self.memsize))
+        self.crit = np.random.random((7, self.dim)).astype("float32") - 0.5
+
+    def test_exhaustive_probe_is_exact(self):
+        for addrcls in [DotMemAddr, GeneralDotMemAddr, TransDotMemAddr]:
+            addr = addrcls(self.memb, memdim=self.dim, indim=self.dim, attdim=6)
+            dense = addr.predict(self.crit)
+            idx = addr.index(numlists=20, seed=1)
+            idxs, scores = idx.predict(self.crit, k=5, nprobe=20)
+            self.assertEqual(idxs.shape, (7, 5))
+            exp = np.argsort(-dense, axis=1)[:, :5]
+            self.assertTrue(np.all(idxs == exp))
+            self.assertTrue(np.allclose(scores, np.sort(dense, axis=1)[:, ::-1][:, :5], atol=1e-5))
+
+    def test_recall_grows_with_probes(self):
+        addr = DotMemAddr(self.memb)
+        exp = np.argsort(-addr.predict(self.crit), axis=1)[:, :10]
+        idx = addr.index(numlists=20, nprobe=1, seed=1)
+        recalls = []
+        for nprobe in [1, 5, 20]:
+            idxs, _ = idx.predict(self.crit, k=10, nprobe=nprobe)
+            recalls.append(np.mean([len(set(a) & set(b)) for a, b in zip(idxs, exp)]) / 10.)
+        self.assertTrue(recalls[0] <= recalls[1] <= recalls[2])
+        self.assertEqual(recalls[2], 1.)
@@ -0,0 +1,79 @@
+from unittest import TestCase
+
+import numpy as np
+
+from teafacto.eval.metrics import RecallAt, MeanQuantile, ClassAccuracy, MeanReciprocalRank, goldranks, topk
+from teafacto.eval.eval import AllScoreKBCEvaluator
+from teafacto.scripts.rescal import Rescal, TransE
+
+
+class TestScoreMatrixMetrics(TestCase):
+    def setUp(self):
+        self.scores = np.random.randint(0, 8, (50, 20)).astype("float32")     # many ties
+        self.gold = np.random.randint(0, 20, (50,))
+
+    def rankings(self):
+        return [sorted(zip(range(20), row), key=lambda x: x[1], reverse=True) for row in self.scores]
+
+    def test_same_as_list_metrics(self):
+        for mf in [lambda: RecallAt(1), lambda: RecallAt(5), lambda: MeanQuantile()]:
+            listm, matm = mf(), mf()
+            for label, ranking in zip(self.gold, self.rankings()):
+                listm([label], ranking)
+            matm.accumulatescores(self.scores[:20], self.gold[:20])
+            matm.accumulatescores(self.scores[20:], self.gold[20:])
+            self.assertAlmostEqual(listm(), matm())
+        listm, matm = ClassAccuracy(), ClassAccuracy()
+        for label, ranking in zip(self.gold, self.rankings()):
+            listm([label], ranking)
+        matm.accumulatescores(self.scores, self.gold)
+        self.assertAlmostEqual(listm(), matm())
+
+    def test_ranks_and_topk(self):
+        ranks = goldranks(self.scores, self.gold)
+        tops = topk(self.scores, 5)
+        for i, ranking in enumerate(self.rankings()):
+            ids = [x[0] for x in ranking]
+            self.assertEqual(ranks[i], ids.index(self.gold[i]))
+            self.assertEqual(list(tops[i]), ids[:5])
+
+    def test_filtered(self):
+        mask = np.zeros_like(self.scores, dtype="bool")
+        mask[:, :10] = True
+        mask[np.arange(50), self.gold] = False
+        ranks = goldranks(self.scores, self.gold, mask=mask)
+        for i in range(50):
+            cols = [j for j in range(20) if not mask[i, j]]
+            ranking = sorted(cols, key=lambda j: self.scores[i, j], reverse=True)
+            self.assertEqual(ranks[i], ranking.index(self.gold[i]))
+
+
+class TestAllScoreKBCEvaluator(TestCase):
+    def test_same_as_predict_ranking(self):
+        numents, numrels = 30, 4
+        data = np.stack([np.random.randint(0, numents, (25,)), np.random.randint(0, numrels, (25,))], axis=1)
+        labels = np.random.randint(0, numents, (25,))
+        known = np.concatenate([np.concatenate([data, labels[:, None]], axis=1),
+                                np.concatenate([data[:10], ((labels[:10] + 1) % numents)[:, None]], axis=1)])
+        for modelcls in [Rescal, TransE]:
+            m = modelcls(8, numents, numrels)
+            scores = m.predict(np.repeat(data, numents, axis=0).astype("int32"),
+                               np.tile(np.arange(numents), 25).astype("int32")).reshape((25, numents))
+            for filtered in [False, True]:
+                exp = MeanReciprocalRank()
+                for i in range(25):
+                    knownobjs = set(known[(known[:, 0] == data[i, 0]) & (known[:, 1] == data[i, 1]), 2])
+                    cans = [j for j in range(numents) if not (filtered and j in knownobjs and j != labels[i])]
+                    ranking = sorted([(j, scores[i, j]) for j in cans], key=lambda x: x[1], reverse=True)
+                    exp([labels[i]], ranking)
+                evaluator = AllScoreKBCEvaluator(MeanReciprocalRank(), batsize=7,
+                                                 known=known if filtered else None)
+                res = evaluator.run(m, data, labels)
+                self.assertAlmostEqual(res["Mean Reciprocal Rank"], exp(), places=4)
+
+    def test_mask_relation_out_of_known_range(self):
+        known = np.asarray([[0, 0, 1], [0, 1, 2], [1, 0, 3]])
+        evaluator = AllScoreKBCEvaluator(known=known)
+        data = np.asarray([[0, 2], [1, 0], [0, 1]])     # relation 2 has no known triples
+        mask = evaluator.makemask(data, np.asarray([0, 0, 0]), 5)
+        self.assertTrue(np.all(mask == np.asarray([[0, 0, 0, 0, 0], [0, 0, 0, 1, 0], [0, 0, 1, 0, 0]], dtype="bool")))
@@ -0,0 +1,66 @@
+import os, shutil, tempfile
+from unittest import TestCase
+
+import numpy as np
+
+from teafacto.datahelp.ngramindex import NGramIndex
+from teafacto.datahelp.labelsearch import SimpleQuestionsLabelIndex
+
+
+class TestNGramIndex(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        labels = [("m.1", "Barack Obama"),
+                  ("m.2", "Barack Obama Sr."),
+                  ("m.3", "Obama"),
+                  ("m.4", "Running Man"),
+                  ("m.5", "the man who runs the run"),
+                  ("m.6", "Obama Barack")]
+        self.labelp = os.path.join(self.dir, "labels.map")
+        with open(self.labelp, "w") as f:
+            for k, v in labels:
+                f.write("%s\t%s\n" % (k, v))
+        self.idx = SimpleQuestionsLabelIndex(index=os.path.join(self.dir, "idx"), tokenizer=lambda s: s.lower().split())
+        self.idx.index(self.labelp)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_exact(self):
+        res = self.idx.searchallngrams([("barack", "obama")], exact=True)
+        self.assertEqual(res.keys(), ["m.1"])
+        self.assertEqual(res["m.1"][1], "barack obama")
+        self.assertEqual(self.idx.searchallngrams([("runs", "man")], exact=True).keys(), ["m.4"])     # stemmed
+        self.assertEqual(self.idx.searchallngrams([("barack", "nobody")], exact=True), {})
+
+    def test_phrase(self):
+        res = self.idx.searchallngrams([("barack", "obama")], exact=False)
+        self.assertEqual(sorted(res.keys()), ["m.1", "m.2"])
+        self.assertGreater(res["m.1"][0], res["m.2"][0])        # shorter label scores higher
+        res = self.idx.searchallngrams([("run",)], exact=False)
+        self.assertEqual(sorted(res.keys()), ["m.4", "m.5"])
+        # phrase freq 2 in a label of 6 terms vs freq 1 in a label of 2 terms
+        self.assertAlmostEqual(res["m.5"][0] / res["m.4"][0], np.sqrt(2. / 6) / np.sqrt(1. / 2))
+        docs, scores = self.idx.idx.lookup([("the", "run")], exact=False)[0]
+        self.assertEqual(list(docs), [4])
+        self.assertEqual(len(self.idx.searchallngrams([("obama",)], exact=False, top=2)), 2)
+
+    def test_sentences_batched(self):
+        sentences = ["who is barack obama", "what is the running man", "nothing here"]
+        batched = self.idx.searchsentences(sentences, exact=True)
+        for s, b in zip(sentences, batched):
+            self.assertEqual(self.idx.searchsentence(s, exact=True), b)
+        self.assertEqual(sorted(batched[0].keys()), ["m.1", "m.3"])
+        self.assertEqual(sorted(batched[1].keys()), ["m.4"])
+        self.assertEqual(batched[2], {})
+
+    def test_search(self):
+        res = self.idx.search("obama sr.", top=10)
+        self.assertEqual(sorted(res.keys()), ["m.1", "m.2", "m.3", "m.6"])
+        self.assertEqual(max(res.items(), key=lambda (k, v): v[0])[0], "m.2")
+
+    def test_reopen(self):
+        idx = NGramIndex(os.path.join(self.dir, "idx"))
+        self.assertEqual(idx.numdocs, 6)
+        self.assertEqual(idx.key(3), "m.4")
+        self.assertIsInstance(idx._postkeys, np.memmap)
@@ -1,9 +1,12 @@
 from unittest import TestCase
-import numpy as np
+import numpy as np, theano
 from teafacto.blocks.match import MatchScore, CosineDistance
 from teafacto.blocks.basic import VectorEmbed
 from teafacto.blocks.lang.wordvec import Glove
 from teafacto.util import ticktock
+from teafacto.core.trainer import NSModelTrainer
+from teafacto.core.base import GraphNegSampler, Input
+from teafacto.scripts.simplequestions.fullrank.fullrank import NegIdxGen as CloseNegIdxGen
 
 
 class TestNSModelTrainer(TestCase):
@@ -74,3 +77,105 @@ def geteval(predf, num, negrate):
         recat1 /= c
         return mrr, recat1, recat10
     return inner
+
+
+class TestNSTransformSamples(TestCase):
+    def test_one_draw_for_all_negatives(self):
+        calls = []
+
+        def nsamgen(l, r):
+            calls.append(l.shape[0])
+            return l, r + 100
+        trainer = NSModelTrainer(None, None, 3, nsamgen)
+        l, r, g = np.arange(4), np.arange(4) * 2, np.ones((4,))
+        ret = trainer._transformsamples(l, r, g)
+        self.assertEqual(calls, [12])
+        self.assertEqual(len(ret), 5)
+        self.assertTrue(np.all(ret[0] == np.concatenate([l] * 3)))
+        self.assertTrue(np.all(ret[3] == np.concatenate([r] * 3) + 100))
+        self.assertEqual(ret[4].shape, (12,))
+
+
+class TestCloseNegIdxGen(TestCase):
+    def setUp(self):
+        self.close = {0: [1, 2], 1: [0, 2, 3], 3: [7]}      # rows 2 and 4+ empty
+        np.random.seed(1)
+
+    def test_close_draws(self):
+        gen = CloseNegIdxGen(9, 9)
+        lens, draws = gen._draw(gen._csr(self.close, 10), np.asarray([0, 1, 2, 3, 4, 12, -1] * 50))
+        self.assertTrue(np.all(lens == [2, 3, 0, 1, 0, 0, 0] * 50))
+        for row, draw in zip([0, 1, 2, 3, 4, 12, -1] * 50, draws):
+            if row in self.close:
+                self.assertIn(draw, self.close[row])
+            else:
+                self.assertEqual(draw, -1)
+        self.assertEqual(set(draws[1::7]), {0, 2, 3})
+
+    def test_close_draws_exclude_gold(self):
+        gen = CloseNegIdxGen(9, 9)
+        lens, draws = gen._draw(gen._csr(self.close, 10), np.asarray([1, 1, 0, 3] * 100),
+                                excl=np.asarray([2, 5, 0, 7] * 100))
+        self.assertTrue(np.all(lens == [2, 3, 2, 0] * 100))
+        self.assertEqual(set(draws[0::4]), {0, 3})
+        self.assertEqual(set(draws[1::4]), {0, 2, 3})
+        self.assertEqual(set(draws[2::4]), {1, 2})
+        self.assertTrue(np.all(draws[3::4] == -1))
+
+    def test_sample(self):
+        gen = CloseNegIdxGen(9, 9, relclose=self.close)
+        gold = np.asarray([1, 2, 12] * 300)
+        ret = gen.sample(gold, gen.relclose, 9)
+        self.assertEqual(ret.shape, (900, 1))
+        ret = ret[:, 0]
+        self.assertTrue(np.all((ret >= 0) & (ret <= 9)))
+        self.assertTrue(set(ret[0::3]) > {0, 2, 3})       # close set and uniform fallback
+        self.assertLess(np.mean(np.in1d(ret[0::3], [0, 2, 3])), 1.)
+        self.assertEqual(set(ret[1::3]), set(range(10)))    # empty or out of range: uniform
+        self.assertEqual(set(ret[2::3]), set(range(10)))
+
+    def test_sample_all_close(self):
+        gen = CloseNegIdxGen(9, 9, relclose=self.close)
+        gen.samprobf = lambda x: (x > 0) * 1.
+        ret = gen.sample(np.asarray([0, 1, 3] * 100), gen.relclose, 9)[:, 0]
+        self.assertEqual(set(ret[0::3]), {1, 2})
+        self.assertEqual(set(ret[1::3]), {0, 2, 3})
+        self.assertTrue(np.all(ret[2::3] == 7))
+
+    def test_uberclose(self):
+        relsperent = {0: ([4, 5, 6], None), 1: ([0], None)}
+        gen = CloseNegIdxGen(9, 9, relclose=self.close, relsperent=relsperent)
+        gen.samprobf = lambda x: (x > 0) * 1.
+        datas, ret = gen(np.arange(300), np.asarray([[0, 5], [1, 0], [2, 1], [1, 3]] * 75))
+        self.assertEqual(ret.dtype, np.int32)
+        rel = ret[:, 1]
+        self.assertEqual(set(rel[0::4]), {4, 6})        # relations of entity, not gold
+        self.assertEqual(set(rel[1::4]), {1, 2})        # only gold in entity relations: close set
+        self.assertEqual(set(rel[2::4]), {0, 2, 3})     # no entity relations: close set
+        self.assertEqual(set(rel[3::4]), {0})
+        self.assertTrue(np.all(rel != np.asarray([5, 0, 1, 3] * 75)))
+
+
+class TestGraphNegSampler(TestCase):
+    def test_alias_frequencies(self):
+        freqs = np.asarray([1., 0., 3., 6.])
+        sampler = GraphNegSampler(freqs=freqs, seed=1)
+        x = Input(ndim=1, dtype="int32")
+        l, r = sampler(x, x)
+        self.assertIs(l, x)
+        f = theano.function([x.d], r.d)
+        samples = np.concatenate([f(np.zeros((1000,), dtype="int32")) for i in range(10)])
+        self.assertEqual(samples.dtype, np.int32)
+        self.assertTrue(np.allclose(np.bincount(samples, minlength=4) / 10000., freqs / freqs.sum(), atol=0.02))
+
+    def test_ingraph_ns_training(self):
+        num = 50
+        m = MatchScore(VectorEmbed(indim=num, dim=10), VectorEmbed(indim=num, dim=10))
+        idxs = np.arange(num).astype("int32")
+        trainer = m.nstrain([idxs, idxs]).negsamplegen(GraphNegSampler(num, seed=1)).negrate(3)\
+            .objective(lambda p, n: (n - p + 1.).clip(0, np.infty))._maketrainer()
+        self.assertEqual(len(trainer._transformsamples(idxs, idxs, np.ones((num,)))), 3)
+        _, err, _, _, _ = trainer.adagrad(lr=0.5).train(numbats=5, epochs=30, returnerrors=True)
+        self.assertLess(err[-1], err[0])
+        scores = m.predict(np.repeat(idxs, num), np.tile(idxs, num)).reshape((num, num))
+        self.assertGreater(np.mean(np.argmax(scores, axis=1) == idxs), 0.8)
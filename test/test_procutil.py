@@ -20,6 +20,34 @@ class TestProcUtil(TestCase):
         charten = wordmat2chartensor(xids, wdic)
         self.assertEqual(wordcharmat2string(charten[0]), x)
 
+    def test_wordmat2charmat_unknown_rare_truncated(self):
+        wdic = {"this": 0, "is": 1, "<RARE>": 2, "test": 3}
+        xids = np.asarray([[0, -1, 1, 2, 7, 3],
+                           [-1, -1, -1, -1, -1, -1],
+                           [3, 3, 3, 3, 3, 3]], dtype="int32")
+        charids = wordmat2charmat(xids, wdic, maxlen=20, chunksize=2)
+        self.assertEqual(charids.shape, (3, 20))
+        self.assertEqual(charids2string(charids[0]), "this is   <???> test")
+        self.assertTrue(np.all(charids[1] == -1))
+        self.assertEqual(charids2string(charids[2]), "test test test test ")
+
+    def test_wordmatfromdic(self):
+        wdic = {"abc": 0, "ca": 2}
+        wordmat, chardic = wordmatfromdic(wdic, maxwordlen=2)
+        self.assertEqual(chardic, {"a": 0, "b": 1, "c": 2})
+        self.assertTrue(np.all(wordmat == [[0, 1], [-1, -1], [2, 0]]))
+
+    def test_wordcharmat2string_rcd(self):
+        rcd = {1: "a", 2: "bb"}
+        x = np.asarray([[1, 2, -1], [-1, -1, -1], [2, -1, -1]])
+        self.assertEqual(wordcharmat2string(x, rcd=dict(rcd.items() + [(-1, "")])), "abb bb")
+
+    def test_wordcharmat2string_zero_chars_dropped(self):
+        x = np.asarray([[104, 0, 105, -1], [0, 0, -1, -1], [0, 97, 0, -1]])
+        self.assertEqual(wordcharmat2string(x), "hi a")
+        rcd = {104: "h", 0: "\x00", 105: "i\x00", 97: "a", -1: ""}
+        self.assertEqual(wordcharmat2string(x, rcd=rcd), "hi a")
+
     def test_charids2string(self):
         x = "this is a test"
         s = charids2string([ord(xe) for xe in x])
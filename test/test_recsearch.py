@@ -1,6 +1,8 @@
 from unittest import TestCase
+import gc
 from teafacto.blocks.seq.oldseqproc import SimpleSeqTransDec
-from teafacto.use.recsearch import GreedySearch
+from teafacto.use.recsearch import GreedySearch, BeamSearch
+from teafacto.use.modelusers import RecPredictor
 import numpy as np
 
 
@@ -16,3 +18,98 @@ class TestSeqTransDecSearcher(TestCase):
         self.assertTrue(np.all(out[0] == np.zeros_like(out[0])))
 
 
+
+
+class TestBeamSearch(TestCase):
+    def setUp(self):
+        self.m = SimpleSeqTransDec(indim=20, outdim=10, inpembdim=8, outembdim=9, innerdim=11)
+        self.inpseq = np.random.randint(0, 20, (5, 7)).astype("int32")
+
+    def test_beamsize_one_is_greedy(self):
+        greedy = GreedySearch(self.m, startsymbol=0).init(5)
+        gout, gprobs = greedy.search(self.inpseq)
+        beam = BeamSearch(self.m, beamsize=1, startsymbol=0).init(5)
+        bout, bscores = beam.search(self.inpseq)
+        self.assertEqual(bout.shape, (5, 1, gout.shape[1]))
+        self.assertTrue(np.all(bout[:, 0] == gout))
+        self.assertTrue(np.allclose(np.exp(bscores[:, 0]), gprobs, rtol=1e-4))
+
+    def test_topk_sorted(self):
+        beam = BeamSearch(self.m, beamsize=4, startsymbol=0).init(5)
+        out, scores = beam.search(self.inpseq, topk=3)
+        self.assertEqual(out.shape, (5, 3, 7))
+        self.assertEqual(scores.shape, (5, 3))
+        self.assertTrue(np.all(np.diff(scores, axis=1) <= 0))
+        for i in range(5):      # distinct hypotheses per example
+            self.assertEqual(len(set(map(tuple, out[i]))), 3)
+
+    def test_stop_symbol(self):
+        beam = BeamSearch(self.m, beamsize=3, startsymbol=1, stopsymbol=2, lennorm=1.).init(5)
+        out, scores = beam.search(self.inpseq)
+        for seq in out.reshape((-1, out.shape[-1])):
+            stops = np.where(seq == 2)[0]
+            if len(stops) > 0:
+                self.assertTrue(np.all(seq[stops[0]:] == 2))
+
+
+class TestRecPredictorCache(TestCase):
+    def test_compiled_once_per_signature(self):
+        m = SimpleSeqTransDec(indim=20, outdim=10, inpembdim=8, outembdim=9, innerdim=11)
+        inpseq = np.random.randint(0, 20, (5, 7)).astype("int32")
+        out = np.zeros((5,), dtype="int32")
+        a = RecPredictor(m).init(5)
+        aout = a.feed(inpseq[:, 0], out)
+        b = RecPredictor(m).init(3)
+        bout = b.feed(inpseq[:3, 0], out[:3])
+        self.assertIs(a.f, b.f)
+        self.assertEqual(len(RecPredictor._cache[m]["init"]), 1)
+        self.assertTrue(np.allclose(aout[:3], bout))
+        self.assertTrue(np.allclose(a.feed(inpseq[:, 1], out)[:3], b.feed(inpseq[:3, 1], out[:3])))
+        RecPredictor.clearcache(m)
+        self.assertNotIn(m, RecPredictor._cache)
+
+
+    def test_transf_steps_dropped_with_transf(self):
+        m = SimpleSeqTransDec(indim=20, outdim=10, inpembdim=8, outembdim=9, innerdim=11)
+        x = np.random.randint(0, 20, (5,)).astype("int32")
+        out = np.zeros((5,), dtype="int32")
+        for i in range(3):
+            RecPredictor(m).init(5).transf(lambda a, b: (a, b)).feed(x, out)
+        gc.collect()
+        self.assertEqual(len(RecPredictor._cache[m]["transfstep"]), 0)
+        self.assertEqual(len(RecPredictor._cache[m]["step"]), 0)
+        RecPredictor.clearcache(m)
+
+    def test_nonsymbolic_inits_not_stale(self):
+        class Scaled(object):   # non-symbolic nonseq computed from the init value
+            def __init__(self, m):
+                self.m = m
+
+            def get_inits(self, batsize, scale):
+                return self.m.get_inits(batsize), [int(scale.v)]
+
+            def rec(self, x, y, *states):
+                ret = self.m.rec(x, y, *states[:-1])
+                return [ret[0] * states[-1]] + ret[1:]
+
+        m = Scaled(SimpleSeqTransDec(indim=20, outdim=10, inpembdim=8, outembdim=9, innerdim=11))
+        x = np.random.randint(0, 20, (5,)).astype("int32")
+        out = np.zeros((5,), dtype="int32")
+        a = RecPredictor(m).init(5, 1).feed(x, out)
+        b = RecPredictor(m).init(5, 3).feed(x, out)
+        self.assertTrue(np.allclose(a * 3, b))
+        RecPredictor.clearcache(m)
+
+    def test_rebuilt_after_fuse(self):
+        m = SimpleSeqTransDec(indim=20, outdim=10, inpembdim=8, outembdim=9, innerdim=11)
+        x = np.random.randint(0, 20, (5,)).astype("int32")
+        out = np.zeros((5,), dtype="int32")
+        a = RecPredictor(m).init(5)
+        aout = a.feed(x, out)
+        m.rnn[0].fuse()
+        b = RecPredictor(m).init(5)
+        self.assertTrue(np.allclose(aout, b.feed(x, out), atol=1e-6))
+        self.assertIsNot(a.f, b.f)
+        m.rnn[0].wfused.value.set_value(np.zeros_like(m.rnn[0].wfused.value.get_value()))
+        self.assertFalse(np.allclose(aout, RecPredictor(m).init(5).feed(x, out)))
+        RecPredictor.clearcache(m)
@@ -2,6 +2,7 @@ from unittest import TestCase, main
 from teafacto.examples.dummy import Dummy
 from teafacto.blocks.seq.encdec import SimpleSeqEncDecAtt
 import numpy as np
+import os, shutil, tempfile
 
 class TestSaveable(TestCase):
     def test_continued_training_dummy(self):
@@ -40,5 +41,39 @@ class TestSaveable(TestCase):
         self.assertTrue(b[0] < a[-1])
 
 
+class TestParamCheckpoint(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def makeencdec(self):
+        return SimpleSeqEncDecAtt(inpvocsize=20, outvocsize=20, inpembdim=5, outembdim=5, encdim=10, decdim=10)
+
+    def test_names_stable(self):
+        a = self.makeencdec().namedparams()
+        b = self.makeencdec().namedparams()
+        self.assertEqual(a.keys(), b.keys())
+        self.assertGreater(len(a), 5)
+        self.assertEqual(len(set(a.values())), len(a))
+
+    def test_save_load_predict(self):
+        m = self.makeencdec()
+        data = np.random.randint(0, 20, (10, 7))
+        pred = m.predict(data, data[:, :-1])
+        m.saveparams(self.path)
+        self.assertTrue(os.path.exists(os.path.join(self.path, "meta.json")))
+        n = self.makeencdec().loadparams(self.path)
+        for name, p in n.namedparams().items():
+            self.assertIsInstance(p.value.get_value(borrow=True), np.memmap)
+        self.assertTrue(np.allclose(pred, n.predict(data, data[:, :-1])))
+
+    def test_mismatch_raises(self):
+        Dummy(20, 5).saveparams(self.path)
+        self.assertRaises(Exception, Dummy(20, 6).loadparams, self.path)
+        self.assertRaises(Exception, self.makeencdec().loadparams, self.path)
+
+
 if __name__ == "__main__":
     main()
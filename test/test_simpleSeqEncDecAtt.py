@@ -102,4 +102,24 @@ class TestSimpleSeqEncDecAtt(TestCase):
             self.assertTrue(not np.allclose(trainednewencparamvals[k], originalnewencparamvals[k]))
             print "{} {}".format(k, np.linalg.norm(trainednewencparamvals[k] - originalnewencparamvals[k]))
 
-        #print "\n".join(["{} {}".format(x, x.lrmul) for x in encdec.get_params()])
\ No newline at end of file
+        #print "\n".join(["{} {}".format(x, x.lrmul) for x in encdec.get_params()])
+
+    def test_greedy_decode_same_as_prefix_predict(self):
+        encdec = SimpleSeqEncDecAtt(inpvocsize=19, outvocsize=17, outconcat=False, encdim=30, decdim=30)
+        inpseq = np.random.randint(0, 19, (3, 6)).astype("int32")
+        acc = np.zeros((3, 1)).astype("int32")
+        for i in range(inpseq.shape[1]):      # quadratic: re-decodes the whole prefix every step
+            probs = encdec.predict(inpseq, acc)
+            acc = np.concatenate([acc, np.argmax(probs, axis=2)[:, -1:].astype("int32")], axis=1)
+        ret, accprobs = encdec.greedy_decode(inpseq, inpseq.shape[1], startsymbol=0)
+        self.assertEqual(ret.shape, inpseq.shape)
+        self.assertTrue(np.all(ret == acc[:, 1:]))
+        self.assertTrue(np.allclose(accprobs, np.max(probs, axis=2).prod(axis=1)))
+
+    def test_greedy_decode_padded_after_stop(self):
+        encdec = SimpleSeqEncDecAtt(inpvocsize=19, outvocsize=17, outconcat=False, encdim=30, decdim=30)
+        inpseq = np.repeat(np.random.randint(0, 19, (1, 6)), 3, axis=0).astype("int32")
+        ret, _ = encdec.greedy_decode(inpseq, 6, startsymbol=0)
+        stopped, _ = encdec.greedy_decode(inpseq, 6, startsymbol=0, stopsymbol=ret[0, 0])
+        self.assertEqual(stopped.shape, (3, 6))
+        self.assertTrue(np.all(stopped == ret[0, 0]))
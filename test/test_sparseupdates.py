@@ -0,0 +1,42 @@
+from unittest import TestCase
+
+import numpy as np
+
+from teafacto.examples.dummy import Dummy
+from teafacto.core.base import Input
+from teafacto.core.sparse import find_sparse_params
+
+
+class TestSparseUpdates(TestCase):
+    def setUp(self):
+        self.vocabsize = 50
+        self.data = np.random.randint(0, 20, (100,)).astype("int32")    # rows 20+ never touched
+
+    def train(self, m, optimizer, sparse):
+        np.random.seed(1337)
+        trainer = getattr(m.train([self.data], self.data).cross_entropy(), optimizer)(lr=0.1)
+        return trainer.sparse_updates(sparse).train(10, 3)
+
+    def test_finds_embedding_only(self):
+        m = Dummy(self.vocabsize, 5)
+        x = Input(ndim=1, dtype="int32")
+        out = m(x)
+        sparse = find_sparse_params(out.d.sum(), list(out.allparams))
+        self.assertEqual(len(sparse), 1)
+        self.assertIs(sparse.keys()[0], m.W.W)
+
+    def test_sgd_adagrad_same_as_dense(self):
+        for optimizer in ["sgd", "adagrad"]:
+            m = Dummy(self.vocabsize, 5)
+            mcopy = Dummy.unfreeze(m.freeze())
+            self.train(m, optimizer, False)
+            self.train(mcopy, optimizer, True)
+            self.assertTrue(np.allclose(m.W.W.v, mcopy.W.W.v))
+            self.assertTrue(np.allclose(m.O.v, mcopy.O.v))
+
+    def test_untouched_rows_unchanged(self):
+        m = Dummy(self.vocabsize, 5)
+        before = m.W.W.v.copy()
+        self.train(m, "adam", True)
+        self.assertTrue(np.allclose(before[20:], m.W.W.v[20:]))
+        self.assertFalse(np.allclose(before[:20], m.W.W.v[:20]))
@@ -0,0 +1,70 @@
+import random, shutil, tempfile
+from unittest import TestCase
+
+import numpy as np
+
+from teafacto.datahelp.subjectindex import SubjectIndex
+
+
+def editdistance(a, b):
+    prev = range(len(b) + 1)
+    for i, ca in enumerate(a):
+        cur = [i + 1]
+        for j, cb in enumerate(b):
+            cur.append(min(prev[j + 1] + 1, cur[j] + 1, prev[j] + (ca != cb)))
+        prev = cur
+    return prev[-1]
+
+
+class TestSubjectIndex(TestCase):
+    def setUp(self):
+        random.seed(1)
+        names = [u"".join(random.choice(u"abcd ") for _ in range(random.randint(1, 8))).strip() or u"a"
+                 for _ in range(300)]
+        names += [u"barack obama"] * 3 + [u"john ' s band"]
+        self.names = names
+        self.triplecounts = [random.randint(0, 3) for _ in names]
+        self.fb_ids = ["m.%d" % i for i in range(len(names))]
+        self.type_ids = [None if i % 3 else "t.%d" % i for i in range(len(names))]
+        self.type_names = [None if i % 2 else u"type %d" % i for i in range(len(names))]
+        self.idx = SubjectIndex.build(names, self.fb_ids, self.triplecounts, self.type_ids, self.type_names)
+        self.labels = sorted(set(names))
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_neighbours_same_as_bruteforce(self):
+        queries = [u"barak obama", u"barack obamaa", u"john s band", u"xyz"] \
+                  + [random.choice(self.labels) + random.choice([u"", u"a", u"d"]) for _ in range(50)] \
+                  + [random.choice(self.labels)[1:] for _ in range(50)]
+        for q in queries:
+            exp = set([i for i, label in enumerate(self.labels) if editdistance(label.replace(" '", ""), q) <= 1])
+            got = self.idx.neighbours(q)
+            self.assertTrue(exp.issubset(got))
+            got = set([i for i in got if editdistance(self.labels[i].replace(" '", ""), q) <= 1])
+            self.assertEqual(got, exp)
+
+    def test_find_and_top_entries(self):
+        for i, label in enumerate(self.labels):
+            self.assertEqual(self.idx.find(label), i)
+        self.assertIsNone(self.idx.find(u"not a label"))
+        for label in set(self.names):
+            exp = [{"fb_id": self.fb_ids[i], "triplecount": self.triplecounts[i],
+                    "type_id": self.type_ids[i], "type_name": self.type_names[i]}
+                   for i in range(len(self.names)) if self.names[i] == label]
+            exp = sorted(exp, key=lambda x: x["triplecount"], reverse=True)    # stable: ties in input order
+            self.assertEqual(self.idx.entries(self.idx.find(label)), exp)
+            self.assertEqual(self.idx.entries(self.idx.find(label), top=2), exp[:2])
+
+    def test_save_load(self):
+        self.idx.save(self.dir)
+        loaded = SubjectIndex.load(self.dir)
+        self.assertIsInstance(loaded.delhashes, np.memmap)
+        self.assertEqual(len(loaded.labels), len(self.labels))
+        for i, label in enumerate(self.labels):
+            self.assertEqual(loaded.labels[i], label)
+            self.assertEqual(loaded.find(label), i)
+            self.assertEqual(loaded.entries(i), self.idx.entries(i))
+        for q in [u"barak obama", u"john s band", self.labels[5]]:
+            self.assertEqual(loaded.neighbours(q), self.idx.neighbours(q))
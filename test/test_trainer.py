@@ -3,7 +3,7 @@ from unittest import TestCase
 import numpy as np
 
 from teafacto.examples.dummy import *
-from teafacto.core.trainer import ModelTrainer
+from teafacto.core.trainer import ModelTrainer, ParamSnapshot
 
 from teafacto.core.base import Block
 from teafacto.blocks.match import MatchScore, DotDistance, CosineDistance, EuclideanDistance
@@ -250,3 +250,26 @@ class TestInterleavedTrainer(TestCase):
 
 
 
+
+
+class TestTakeBest(TestCase):
+    def test_snapshot_restore(self):
+        m = Dummy(20, 5)
+        before = m.W.W.v.copy()
+        snap = ParamSnapshot([m.W.W, m.O]).take()
+        m.W.W.value.set_value(np.zeros_like(before))
+        snap.restore()
+        self.assertTrue(np.allclose(before, m.W.W.v))
+
+    def test_restores_best(self):
+        data = np.random.randint(0, 20, (50,)).astype("int32")
+        m = Dummy(20, 5)
+        mcopy = Dummy.unfreeze(m.freeze())
+        np.random.seed(1)
+        m.train([data], data).cross_entropy().adagrad(lr=0.5).train(5, 1)
+        np.random.seed(1)
+        ret = mcopy.train([data], data).cross_entropy().adagrad(lr=0.5)\
+            .takebest(lambda x: x[-1]).train(5, 4)    # first epoch is best
+        self.assertIs(ret, mcopy)
+        self.assertTrue(np.allclose(m.W.W.v, mcopy.W.W.v))
+        self.assertTrue(np.allclose(m.O.v, mcopy.O.v))
@@ -1,8 +1,9 @@
 from unittest import TestCase
 
 from teafacto.util import ticktock as TT, argparsify, loadlexidtsv, \
-    unstructurize, restructurize
-import os
+    unstructurize, restructurize, loadwordvecs, loadwordvocab, tsvchunks, readlines, parsetsv
+import os, shutil, tempfile, time
+import numpy as np
 
 class TestUtils(TestCase):
     def test_ticktock_duration_string(self):
@@ -46,6 +47,58 @@ class TestIDTSVLoader(TestCase):
         self.assertEqual(fbids.shape, (10000,))
 
 
+class TestParallelTSVLoader(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "lex.tsv")
+        with open(self.path, "w") as f:
+            for i in range(300):
+                numwords = i % 4 + 1
+                f.write("%s\t%s\t%d\n" % (" ".join([str(i + j) for j in range(numwords)]),
+                                           ", ".join([" ".join(["97"] * (j + 1)) for j in range(numwords)]), i))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_chunks_at_line_boundaries(self):
+        chunks = tsvchunks(self.path, 7)
+        self.assertEqual(len(chunks), 7)
+        lines = []
+        for start, end in chunks:
+            lines.extend(readlines(self.path, start, end))
+        self.assertEqual(lines, readlines(self.path))
+        self.assertEqual(len(lines), 300)
+
+    def test_parallel_same_as_sequential(self):
+        seq = loadlexidtsv(self.path, numwords=3, numchars=2, workers=1, cache=False)
+        par = loadlexidtsv(self.path, numwords=3, numchars=2, workers=3, cache=False, chunksize=1000)
+        for s, p in zip(seq, par):
+            self.assertEqual(s.dtype, np.dtype("int32"))
+            self.assertTrue(np.all(s == p))
+        gids, charten, fbids = seq
+        self.assertTrue(np.all(fbids == np.arange(300)))
+        self.assertEqual(list(gids[3]), [3, 4, 5])          # 4 words, truncated to 3
+        self.assertEqual(charten[3].tolist(), [[97, 0], [97, 97], [97, 97]])
+        self.assertEqual(list(gids[4]), [4, 0, 0])
+
+    def test_small_file_parsed_in_process(self):
+        pids = lambda lines: np.asarray([os.getpid()] * len(lines))
+        self.assertTrue(np.all(parsetsv(self.path, pids, workers=3) == os.getpid()))
+        ret = parsetsv(self.path, pids, workers=3, chunksize=1000)
+        self.assertEqual(len(ret), 300)
+        self.assertTrue(np.all(ret != os.getpid()))
+
+    def test_cached(self):
+        gids, _, _ = loadlexidtsv(self.path, numwords=3, numchars=2)
+        cachepath = self.path + ".lexid-3-2.0.npy"
+        self.assertTrue(os.path.exists(cachepath))
+        np.save(cachepath, gids + 1)        # the cache is used while the tsv file is not newer
+        self.assertTrue(np.all(loadlexidtsv(self.path, numwords=3, numchars=2)[0] == gids + 1))
+        t = time.time() + 10
+        os.utime(self.path, (t, t))
+        self.assertTrue(np.all(loadlexidtsv(self.path, numwords=3, numchars=2)[0] == gids))
+
+
 class TestFlatNestF(TestCase):
     def test_f(self):
         s = ["a", "b", ["c", "d"], {"e": ["f", ("g", "h")]}]
@@ -55,3 +108,41 @@ class TestFlatNestF(TestCase):
         self.assertEqual(rs, s)
 
 
+
+
+class TestWordVecCache(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "vecs.txt")
+        with open(self.path, "w") as f:
+            f.write("the 0.1 0.2 0.3\nof -1 2.5 3\nand 4 5 6\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_load(self):
+        words, vecs = loadwordvecs(self.path)
+        self.assertEqual(words, ["the", "of", "and"])
+        self.assertIsInstance(vecs, np.memmap)
+        self.assertTrue(np.allclose(vecs, [[0.1, 0.2, 0.3], [-1, 2.5, 3], [4, 5, 6]]))
+        words, vecs = loadwordvecs(self.path, top=2)
+        self.assertEqual(words, ["the", "of"])
+        self.assertEqual(vecs.shape, (2, 3))
+        self.assertEqual(loadwordvocab(self.path, top=1), ["the"])
+
+    def test_rebuilt_when_text_newer(self):
+        loadwordvecs(self.path)
+        with open(self.path, "w") as f:
+            f.write("a 1 2\n")
+        t = time.time() + 10
+        os.utime(self.path, (t, t))
+        words, vecs = loadwordvecs(self.path)
+        self.assertEqual(words, ["a"])
+        self.assertTrue(np.allclose(vecs, [[1, 2]]))
+
+    def test_blank_lines_skipped(self):
+        with open(self.path, "w") as f:
+            f.write("\nthe 0.1 0.2\n\nof 1 2 \n\n")
+        words, vecs = loadwordvecs(self.path)
+        self.assertEqual(words, ["the", "of"])
+        self.assertTrue(np.allclose(vecs, [[0.1, 0.2], [1, 2]]))